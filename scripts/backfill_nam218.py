@@ -26,63 +26,336 @@
     from 201512311800
 11:Total Precipitation:kg m**-2 (accum):lambert:surface:level 0:
     fcst time 0 hrs (accum):from 201512311800
+
+The tar files are read as a stream, each wanted GRIB member is handed to a
+process pool in memory, and only the wanted messages are written out, with
+their gribindex sidecar.  Nothing else touches the disk.  With --crop the
+messages are cropped to the analysis domain plus a halo, and the source
+grid definition is kept in a `.grid.json` sidecar.
+
+Usage: python backfill_nam218.py /path/to/tars --workers 8
 """
 
+import argparse
 import glob
+import json
 import os
-import subprocess
 import sys
+import tarfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import pygrib
+from gribindex import describe, split_messages, write_index
+from griddef import GRID
+from pyiem.util import logger
 
+LOG = logger()
 WANT = [
     "10 metre U wind component",
     "10 metre V wind component",
     "2 metre temperature",
     "Relative humidity",
+    "2 metre relative humidity",
     "Visibility",
     "Total Precipitation",
 ]
-WANTLVL = [10, 10, 2, 2, 0, 0]
+WANTLVL = [10, 10, 2, 2, 2, 0, 0]
+# The analysis grid's cells, which --crop pads with --halo degrees
+BBOX = tuple(
+    round(float(x), 6)
+    for x in (
+        GRID.xaxis[0],
+        GRID.yaxis[0],
+        GRID.xaxis[-1] + GRID.dx,
+        GRID.yaxis[-1] + GRID.dy,
+    )
+)
+HALO = 1.0
+# Source grid definition kept in the .grid.json sidecar when cropping
+GRID_KEYS = [
+    "gridType",
+    "Nx",
+    "Ny",
+    "latitudeOfFirstGridPointInDegrees",
+    "longitudeOfFirstGridPointInDegrees",
+    "LaDInDegrees",
+    "LoVInDegrees",
+    "Latin1InDegrees",
+    "Latin2InDegrees",
+    "DxInMetres",
+    "DyInMetres",
+    "iScansNegatively",
+    "jScansPositively",
+    "shapeOfTheEarth",
+]
+# Crop windows, keyed by (md5GridSection, bbox)
+_WINDOWS = {}
 
 
-def process(fn):
-    """Process a grib file into a smaller, grib file..."""
+def archive_name(member):
+    """Return the archive (directory, filename) for this tar member.
 
+    Returns:
+      tuple or None when the member is not wanted
+    """
     # nam_218_20151231_1800_000.grb2
-    (_, _, yyyymmdd, hhmi, hhh) = fn.split(".")[0].split("_")
+    base = os.path.basename(member)
+    if not base.startswith("nam_218_") or not base.endswith(".grb2"):
+        return None
+    (_, _, yyyymmdd, hhmi, hhh) = base.split(".")[0].split("_")
     if int(hhh) % 3 != 0:
-        os.unlink(fn)
-        return
-    newfn = "%s%sF%s.grib2" % (yyyymmdd, hhmi, hhh)
+        return None
     newdir = ("%s/%s/%s/grib2/ncep/NAM218/%s") % (
         yyyymmdd[:4],
         yyyymmdd[4:6],
         yyyymmdd[6:],
         hhmi[:2],
     )
-    if not os.path.isdir(newdir):
-        os.makedirs(newdir)
     # 201611101200F003.grib2
-    print(f"{fn} -> {newdir} {newfn}")
-    with open("%s/%s" % (newdir, newfn), "wb") as o, pygrib.open(fn) as grbs:
-        for grb in grbs:
-            if grb.name in WANT and grb.level == WANTLVL[WANT.index(grb.name)]:
-                o.write(grb.tostring())
-    os.unlink(fn)
+    return newdir, "%s%sF%s.grib2" % (yyyymmdd, hhmi, hhh)
+
+
+def crop_window(grb, bbox):
+    """Compute the smallest grid window holding every point within bbox.
+
+    Returns:
+      (j0, j1, i0, i1) slice bounds and the lat, lon of its first point
+    """
+    key = (grb["md5GridSection"], bbox)
+    if key not in _WINDOWS:
+        lats, lons = grb.latlons()
+        west, south, east, north = bbox
+        mask = (
+            (lons >= west) & (lons <= east) & (lats >= south) & (lats <= north)
+        )
+        if not mask.any():
+            raise ValueError(f"No grid points within {bbox}")
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+        j0, j1, i0, i1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+        _WINDOWS[key] = (
+            int(j0),
+            int(j1),
+            int(i0),
+            int(i1),
+            float(lats[j0, i0]),
+            float(lons[j0, i0]),
+        )
+    return _WINDOWS[key]
+
+
+def grid_metadata(grb, bbox):
+    """Describe the source grid and the window cropped from it."""
+    j0, j1, i0, i1, _, _ = crop_window(grb, bbox)
+    return {
+        "source": {key: grb[key] for key in GRID_KEYS if grb.has_key(key)},
+        "bbox": list(bbox),
+        "window": {"j0": j0, "j1": j1, "i0": i0, "i1": i1},
+    }
+
+
+def crop(grb, bbox):
+    """Crop this message to the grid window holding bbox.
+
+    The projection parameters are unchanged, only the grid dimensions and
+    first grid point move, so the result is the same grid, just smaller.
+
+    Returns:
+      bytes of the cropped GRIB message
+    """
+    j0, j1, i0, i1, lat0, lon0 = crop_window(grb, bbox)
+    vals = grb.values[j0:j1, i0:i1]
+    grb["Nx"] = i1 - i0
+    grb["Ny"] = j1 - j0
+    grb["latitudeOfFirstGridPointInDegrees"] = lat0
+    grb["longitudeOfFirstGridPointInDegrees"] = lon0 % 360.0
+    grb["values"] = vals
+    return grb.tostring()
+
+
+def subset(buf, bbox=None):
+    """Return the wanted messages within these GRIB bytes.
+
+    Args:
+      buf (bytes): the GRIB file
+      bbox (tuple,optional): crop to this (west, south, east, north)
+
+    Returns:
+      list of (message bytes, gribindex entry fields), and the source grid
+      metadata when cropping, else None
+    """
+    res = []
+    grid = None
+    view = memoryview(buf)
+    for offset, length in split_messages(buf):
+        raw = bytes(view[offset : offset + length])
+        grb = pygrib.fromstring(raw)
+        if grb.name not in WANT or grb.level != WANTLVL[WANT.index(grb.name)]:
+            continue
+        if bbox is not None:
+            if grid is None:
+                grid = grid_metadata(grb, bbox)
+            raw = crop(grb, bbox)
+        res.append((raw, describe(grb)))
+    return res, grid
+
+
+def process(member, buf, outdir, bbox=None):
+    """Write the wanted messages of this GRIB file into the archive.
 
+    Args:
+      member (str): tar member name
+      buf (bytes): the GRIB file
+      outdir (str): archive root
+      bbox (tuple,optional): crop to this (west, south, east, north) and
+        record the source grid in a `.grid.json` sidecar
 
-def dodir(mydir):
-    os.chdir(mydir)
-    for tarfn in glob.glob("*.tar"):
-        subprocess.call(["tar", "-xf", tarfn])
-        for grib2fn in glob.glob("*.grb2"):
-            process(grib2fn)
+    Returns:
+      number of messages written
+    """
+    newdir, newfn = archive_name(member)
+    newdir = os.path.join(outdir, newdir)
+    os.makedirs(newdir, exist_ok=True)
+    fn = os.path.join(newdir, newfn)
+    messages, grid = subset(buf, bbox)
+    entries = []
+    offset = 0
+    tmpfn = f"{fn}.{os.getpid()}.tmp"
+    with open(tmpfn, "wb") as fh:
+        for raw, meta in messages:
+            fh.write(raw)
+            entries.append({"offset": offset, "length": len(raw), **meta})
+            offset += len(raw)
+    os.replace(tmpfn, fn)
+    write_index(fn, entries)
+    if grid is not None:
+        with open(f"{fn}.grid.json", "w", encoding="ascii") as fh:
+            json.dump(grid, fh)
+    return len(entries)
+
+
+class Progress:
+    """Track members and bytes processed, logging the throughput."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.members = 0
+        self.nbytes = 0
+        self.messages = 0
+
+    def update(self, member, nbytes, messages):
+        """Record this completed member."""
+        self.members += 1
+        self.nbytes += nbytes
+        self.messages += messages
+        elapsed = time.perf_counter() - self.start
+        LOG.info(
+            "%s -> %s msgs, %s members %.1f GB in %.0fs, %.1f MB/s",
+            member,
+            messages,
+            self.members,
+            self.nbytes / 1e9,
+            elapsed,
+            self.nbytes / 1e6 / max(elapsed, 1e-9),
+        )
+
+
+def dotar(tarfn, pool, outdir, inflight, progress, bbox=None):
+    """Stream this tar file's wanted members through the pool."""
+    pending = deque()
+
+    def _finish():
+        member, nbytes, future = pending.popleft()
+        progress.update(member, nbytes, future.result())
+
+    # r|* reads the tar sequentially, without seeking or an index
+    with tarfile.open(tarfn, "r|*") as tar:
+        for member in tar:
+            if not member.isfile() or archive_name(member.name) is None:
+                continue
+            buf = tar.extractfile(member).read()
+            future = pool.submit(process, member.name, buf, outdir, bbox)
+            pending.append((member.name, len(buf), future))
+            if len(pending) >= inflight:
+                _finish()
+    while pending:
+        _finish()
+
+
+def dodir(mydir, workers=1, outdir=None, inflight=None, bbox=None):
+    """Process every tar file in this directory.
+
+    Args:
+      mydir (str): directory holding the tar files
+      workers (int): number of processes subsetting GRIB files
+      outdir (str,optional): archive root, defaults to mydir
+      inflight (int,optional): GRIB files held in memory at once,
+        defaults to twice the number of workers
+      bbox (tuple,optional): crop to this (west, south, east, north)
+    """
+    outdir = mydir if outdir is None else outdir
+    inflight = workers * 2 if inflight is None else max(inflight, 1)
+    progress = Progress()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for tarfn in sorted(glob.glob(os.path.join(mydir, "*.tar"))):
+            LOG.info("Processing %s", tarfn)
+            dotar(tarfn, pool, outdir, inflight, progress, bbox)
 
 
 def main(argv):
     """Go Main Go"""
-    dodir(argv[1])
+    parser = argparse.ArgumentParser(description="Archive NAM218 tar files")
+    parser.add_argument("mydir", help="directory holding the tar files")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--outdir", help="archive root, default mydir")
+    parser.add_argument(
+        "--inflight",
+        type=int,
+        help="GRIB files held in memory at once, default 2 x workers",
+    )
+    parser.add_argument(
+        "--crop",
+        action="store_true",
+        help="only archive the grid around the analysis domain",
+    )
+    parser.add_argument(
+        "--bbox",
+        type=float,
+        nargs=4,
+        default=BBOX,
+        metavar=("WEST", "SOUTH", "EAST", "NORTH"),
+        help="domain to crop to, default the analysis domain",
+    )
+    parser.add_argument(
+        "--halo",
+        type=float,
+        default=HALO,
+        help="degrees added around the cropped domain",
+    )
+    args = parser.parse_args(argv[1:])
+    bbox = None
+    if args.crop:
+        west, south, east, north = args.bbox
+        bbox = (
+            west - args.halo,
+            south - args.halo,
+            east + args.halo,
+            north + args.halo,
+        )
+    dodir(args.mydir, args.workers, args.outdir, args.inflight, bbox)
+
+
+def test_archive_name():
+    """Only the 3 hourly GRIB members are archived."""
+    assert archive_name("x/nam_218_20151231_1800_003.grb2") == (
+        "2015/12/31/grib2/ncep/NAM218/18",
+        "201512311800F003.grib2",
+    )
+    assert archive_name("nam_218_20151231_1800_004.grb2") is None
+    assert archive_name("README") is None
 
 
 if __name__ == "__main__":
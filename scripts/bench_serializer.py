@@ -0,0 +1,153 @@
+"""Benchmark the serializer against the original per-cell loops.
+
+Usage: python bench_serializer.py
+
+Synthetic grids are used, so no data sources are required.  The legacy
+loops below are verbatim copies of what the gridders used to do and are
+also used to verify the output is byte-identical, with the wawa bitset grid
+expanded into the old string grid for them.
+"""
+
+import time
+from io import StringIO
+
+import numpy as np
+from griddef import GRID
+from serializer import ANALYSIS_COLUMNS, write_analysis, write_forecast
+from wawa import bitset_codes, code_bit
+
+SHAPE = GRID.shape
+
+
+def legacy_analysis(out, grids):
+    """The original i5gridder.write_grids record loop."""
+    fmt = (
+        '{"gid": %s, "tmpc": %.2f, "wawa": %s, "ptype": %i, "dwpc": %.2f, '
+        '"smps": %.1f, "drct": %i, "vsby": %.3f, "roadtmpc": %.2f,'
+        '"srad": %.2f, "snwd": %.2f, "pcpn": %.2f}'
+    )
+    i = 1
+    ar = []
+    for row in range(SHAPE[0]):
+        for col in range(SHAPE[1]):
+            a = grids["wawastr"][row, col][:-1]
+            ar.append(
+                fmt
+                % (
+                    i,
+                    grids["tmpc"][row, col],
+                    repr(a.split(",")).replace("'", '"'),
+                    grids["ptype"][row, col],
+                    grids["dwpc"][row, col],
+                    grids["smps"][row, col],
+                    grids["drct"][row, col],
+                    grids["vsby"][row, col],
+                    grids["roadtmpc"][row, col],
+                    grids["srad"][row, col],
+                    grids["snwd"][row, col],
+                    grids["pcpn"][row, col],
+                )
+            )
+            i += 1
+    out.write(",\n".join(ar))
+
+
+def legacy_forecast(fp, d):
+    """The original fxgridder.write_grids record loop."""
+    fmt = (
+        '{"gid": %s, "tmpc": %s, "dwpc": %s, '
+        '"smps": %s, "drct": %s, "vsby": %s, "pcpn": %s}'
+    )
+    i = 1
+    ar = []
+
+    def f(label, row, col, fmt):
+        if label not in d:
+            return "null"
+        return fmt % d[label][row, col]
+
+    for row in range(SHAPE[0]):
+        for col in range(SHAPE[1]):
+            ar.append(
+                fmt
+                % (
+                    i,
+                    f("tmpc", row, col, "%.2f"),
+                    f("dwpc", row, col, "%.2f"),
+                    f("smps", row, col, "%.1f"),
+                    f("drct", row, col, "%i"),
+                    f("vsby", row, col, "%.3f"),
+                    f("pcpn", row, col, "%.2f"),
+                )
+            )
+            i += 1
+    fp.write(",\n".join(ar))
+
+
+def blocky(rng, loc, scale, block=12):
+    """Generate a field of constant blocks, like a nearest neighbour grid."""
+    coarse = rng.normal(loc, scale, (SHAPE[0] // block, SHAPE[1] // block))
+    return np.kron(coarse, np.ones((block, block))).astype(np.float32)
+
+
+def synthetic_grids(rng):
+    """Generate analysis grids resembling the real thing."""
+    grids = {}
+    for label in ANALYSIS_COLUMNS:
+        grids[label] = blocky(rng, 10, 15)
+    grids["ptype"] = rng.choice([-3, 0, 1, 3, 10], SHAPE)
+    grids["drct"] = blocky(rng, 180, 90)
+    wawa = np.zeros(SHAPE, np.uint64)
+    wawa[100:200, 200:400] |= code_bit("WS.W")
+    wawa[150:250, 300:500] |= code_bit("WC.Y")
+    grids["wawa"] = wawa
+    wawastr = np.empty(SHAPE, dtype="<U25")
+    for bitset in np.unique(wawa):
+        wawastr[wawa == bitset] = "".join(
+            f"{code}," for code in bitset_codes(bitset)
+        )
+    grids["wawastr"] = wawastr
+    return grids
+
+
+def timeit(func, *args):
+    """Return the output and elapsed seconds for this writer."""
+    fp = StringIO()
+    sts = time.perf_counter()
+    func(fp, *args)
+    return fp.getvalue(), time.perf_counter() - sts
+
+
+def main():
+    """Go Main Go"""
+    rng = np.random.default_rng(42)
+    grids = synthetic_grids(rng)
+    old, oldtime = timeit(legacy_analysis, grids)
+    new, newtime = timeit(write_analysis, grids)
+    assert old == new, "analysis output differs!"
+    print(
+        f"analysis: legacy {oldtime:.3f}s new {newtime:.3f}s "
+        f"speedup {oldtime / newtime:.1f}x"
+    )
+    # Forecast hour with a missing variable
+    d = {k: grids[k] for k in ["tmpc", "dwpc", "smps", "drct", "pcpn"]}
+    old, oldtime = timeit(legacy_forecast, d)
+    new, newtime = timeit(write_forecast, d, grids["tmpc"].size)
+    assert old == new, "forecast output differs!"
+    print(
+        f"forecast: legacy {oldtime:.3f}s new {newtime:.3f}s "
+        f"speedup {oldtime / newtime:.1f}x"
+    )
+    # Worst case of every cell holding a distinct value
+    d = {k: rng.normal(10, 15, SHAPE) for k in d}
+    old, oldtime = timeit(legacy_forecast, d)
+    new, newtime = timeit(write_forecast, d, grids["tmpc"].size)
+    assert old == new, "forecast output differs!"
+    print(
+        f"forecast (all distinct): legacy {oldtime:.3f}s "
+        f"new {newtime:.3f}s speedup {oldtime / newtime:.1f}x"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+"""Offline stand-ins for the gridders' data sources.
+
+Every fixture is generated from a fixed seed, so each run benchmarks the
+same inputs: station frames shaped like the IEM queries, canned warning
+polygons, hand-encoded GRIB samples and a fake get_sqlalchemy_conn that
+answers the gridders' queries from them.
+"""
+
+import gzip
+import os
+import sys
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import gribsample
+import numpy as np
+import pandas as pd
+import pytest
+from geopandas import GeoDataFrame
+from shapely.geometry import Point
+
+# the scripts are not a package, so are imported from their directory
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# Stations come from the analysis domain and the surrounding states
+REGION = (-104.0, 36.0, -87.0, 49.5)
+STATIONS = {"asos": 420, "rwis": 330, "isusm": 30, "coop": 1100}
+
+
+def _lonlat(rng, count, bbox=REGION):
+    west, south, east, north = bbox
+    return rng.uniform(west, east, count), rng.uniform(south, north, count)
+
+
+def station_frames(seed=0):
+    """Return synthetic station frames keyed by network class."""
+    rng = np.random.default_rng(seed)
+    frames = {}
+    lon, lat = _lonlat(rng, STATIONS["asos"])
+    tmpf = 20.0 + (lat - 36.0) * -1.5 + rng.normal(0, 3, lon.size)
+    frames["asos"] = pd.DataFrame(
+        {
+            "lon": lon,
+            "lat": lat,
+            "tmpf": tmpf,
+            "dwpf": tmpf - rng.uniform(0, 15, lon.size),
+            "sknt": rng.gamma(2.0, 5.0, lon.size).round(),
+            "drct": (rng.integers(0, 36, lon.size) * 10).astype(float),
+            "vsby": rng.choice([0.25, 1.0, 3.0, 7.0, 10.0], lon.size),
+        }
+    )
+    lon, lat = _lonlat(rng, STATIONS["rwis"])
+    frames["rwis"] = pd.DataFrame(
+        {"lon": lon, "lat": lat, "tsf0": rng.normal(28, 6, lon.size)}
+    )
+    # ISU Soil Moisture stations are all in Iowa
+    lon, lat = _lonlat(rng, STATIONS["isusm"], (-96.4, 40.6, -90.4, 43.4))
+    frames["isusm"] = pd.DataFrame(
+        {"lon": lon, "lat": lat, "srad": rng.uniform(0, 900, lon.size)}
+    )
+    lon, lat = _lonlat(rng, STATIONS["coop"])
+    frames["coop"] = pd.DataFrame(
+        {
+            "lon": lon,
+            "lat": lat,
+            "snow": np.clip(rng.normal(4, 5, lon.size), 0, 40).round(),
+        }
+    )
+    return frames
+
+
+def warning_frame(seed=0):
+    """Return canned active warnings, as wwa() selects them."""
+    rng = np.random.default_rng(seed)
+    codes = ["TO.W", "SV.W", "FF.W", "WS.W", "WW.Y", "TO.A", "SV.A", "FL.W"]
+    rows = []
+    # county sized blobs, some overlapping and some with holes in coverage
+    for i in range(120):
+        lon, lat = _lonlat(rng, 1, (-97.5, 39.8, -89.5, 44.2))
+        radius = rng.uniform(0.1, 0.5)
+        geom = Point(lon[0], lat[0]).buffer(radius, 16)
+        rows.append((geom, codes[i % len(codes)], f"IAC{i:03d}", i + 1))
+    geoms, code, ugc, gid = zip(*rows, strict=True)
+    return GeoDataFrame(
+        {"code": code, "ugc": ugc, "gid": gid},
+        geometry=list(geoms),
+        crs="EPSG:4326",
+    )
+
+
+class FakeResult:
+    """The result of FakeConnection.execute()."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def scalar(self):
+        return self.value
+
+    def one(self):
+        return self.value
+
+
+class FakeConnection:
+    """Answers the gridders' queries from canned frames."""
+
+    def __init__(self, frames, warnings):
+        self.frames = frames
+        self.warnings = warnings
+        self.queries = []
+
+    def execute(self, sql, *_args, **_kwargs):
+        """Answer the scalar queries, the ugcs revision or latest time."""
+        self.queries.append(str(sql))
+        if "ugcs" in str(sql):
+            return FakeResult((len(self.warnings), self.warnings["gid"].max()))
+        return FakeResult(datetime(2024, 1, 1, 12, tzinfo=timezone.utc))
+
+    def answer(self, sql):
+        """Return the frame this query would have selected."""
+        text = str(sql)
+        self.queries.append(text)
+        if "ugcs" in text:
+            return self.warnings.copy()
+        if "warnings_" in text:
+            return pd.DataFrame(self.warnings[["code", "gid"]])
+        for key, frame in (
+            ("summary", "coop"),
+            ("tsf0", "rwis"),
+            ("srad", "isusm"),
+            ("tmpf", "asos"),
+        ):
+            if key in text:
+                return self.frames[frame].copy()
+        raise ValueError(f"No canned answer for {text}")
+
+
+@pytest.fixture(scope="session")
+def frames():
+    """Synthetic station frames."""
+    return station_frames()
+
+
+@pytest.fixture(scope="session")
+def warnings():
+    """Canned warning polygons."""
+    return warning_frame()
+
+
+@pytest.fixture
+def fakedb(monkeypatch, frames, warnings):
+    """Route i5gridder's and ugcindex's database access to a FakeConnection."""
+    import i5gridder
+    from resultcache import ResultCache
+
+    conn = FakeConnection(frames, warnings)
+
+    @contextmanager
+    def get_sqlalchemy_conn(*_args, **_kwargs):
+        yield conn
+
+    def read_sql(sql, _conn, *_args, **_kwargs):
+        return conn.answer(sql)
+
+    monkeypatch.setattr(i5gridder, "get_sqlalchemy_conn", get_sqlalchemy_conn)
+    # every call should do the work, rather than reuse cached grids
+    monkeypatch.setattr(i5gridder, "RESULTS", ResultCache(0))
+    monkeypatch.setattr(i5gridder.pd, "read_sql", read_sql)
+    monkeypatch.setattr(GeoDataFrame, "from_postgis", staticmethod(read_sql))
+    return conn
+
+
+@pytest.fixture(scope="session")
+def mrms_samples():
+    """Gzipped MRMS-like GRIB files, keyed by product."""
+    return {
+        product: gzip.compress(gribsample.mrms_grib(product), 1)
+        for product in ("PrecipFlag", "PrecipRate")
+    }
+
+
+@pytest.fixture
+def fakemrms(monkeypatch, tmp_path, mrms_samples):
+    """Serve the MRMS samples in place of mrms_util.fetch().
+
+    Returns:
+      function clearing the read cache and staging the files once more, as
+      read_window() removes each file once read
+    """
+    import mrmsreader
+
+    def fetch_latest(product, valid, minutes=10):
+        return str(tmp_path / f"{product}.grib2.gz")
+
+    def stage():
+        mrmsreader._CACHE.clear()
+        for product, buf in mrms_samples.items():
+            (tmp_path / f"{product}.grib2.gz").write_bytes(buf)
+
+    monkeypatch.setattr(mrmsreader, "fetch_latest", fetch_latest)
+    stage()
+    return stage
+
+
+@pytest.fixture(scope="session")
+def nam_sample():
+    """A NAM218 GRIB2 file holding the fxgridder fields."""
+    return gribsample.nam_grib()
+
+
+@pytest.fixture
+def fakenam(monkeypatch, tmp_path, nam_sample):
+    """Place the NAM218 sample where fxgridder looks for forecast hours."""
+    import fxgridder
+
+    monkeypatch.setattr(fxgridder, "TMP", str(tmp_path))
+
+    def stage(valid, fhours):
+        for fhour in fhours:
+            with open(fxgridder.gribname(valid, fhour), "wb") as fh:
+                fh.write(nam_sample)
+
+    return stage
+
+
+def peak_memory(func, *args, **kwargs):
+    """Return the peak bytes allocated by one call of func."""
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.fixture
+def measure(benchmark):
+    """Benchmark func, recording its peak allocation in extra_info.
+
+    The memory is traced in a separate, untimed call, as tracing slows
+    down allocation heavy code.  setup, when given, runs before every call
+    and is untimed.
+    """
+
+    def _measure(func, *args, setup=None, rounds=5):
+        if setup is not None:
+            setup()
+        benchmark.extra_info["peak_mib"] = round(
+            peak_memory(func, *args) / 2**20, 2
+        )
+        if setup is None:
+            return benchmark.pedantic(func, args, rounds=rounds)
+
+        def _setup():
+            setup()
+            return args, {}
+
+        return benchmark.pedantic(func, setup=_setup, rounds=rounds)
+
+    return _measure
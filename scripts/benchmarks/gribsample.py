@@ -0,0 +1,182 @@
+"""Small GRIB2 samples, encoded by hand, for the offline benchmarks.
+
+Only what the gridders read is encoded: a NAM218 Lambert conformal grid
+holding the fxgridder fields and a regular lat/lon grid shaped like an
+MRMS CONUS product, cut down to the analysis domain.  Values are simple
+packed into 16 bits.
+"""
+
+import struct
+
+import numpy as np
+
+# NAM218 fields: (discipline, category, number, surface type, level,
+# decimal scale)
+NAM_FIELDS = {
+    "tmpk": (0, 0, 0, 103, 2, 2),
+    "rh": (0, 1, 1, 103, 2, 2),
+    "uwnd": (0, 2, 2, 103, 10, 2),
+    "vwnd": (0, 2, 3, 103, 10, 2),
+    "pcpn": (0, 1, 8, 1, 0, 2),
+    "vsby": (0, 19, 0, 1, 0, 0),
+}
+NAM_SHAPE = (428, 614)
+# MRMS grids are 0.01 degree, the sample covers 39 to 45N, 99 to 89W
+MRMS_SHAPE = (600, 1000)
+MRMS_FIRST = (44.995, 261.005)
+
+
+def _sm(value, nbytes):
+    """Encode a GRIB sign and magnitude integer."""
+    value = int(value)
+    if value < 0:
+        value = (1 << (8 * nbytes - 1)) | -value
+    return value.to_bytes(nbytes, "big")
+
+
+def _micro(degrees):
+    """Encode degrees as GRIB2 microdegrees."""
+    return _sm(round(degrees * 1e6), 4)
+
+
+def lambert_section():
+    """Section 3 of the NAM218 grid, template 3.30."""
+    ny, nx = NAM_SHAPE
+    return (
+        struct.pack(">IBBIBBH", 81, 3, 0, nx * ny, 0, 0, 30)
+        + bytes([6])
+        + bytes(15)
+        + struct.pack(">II", nx, ny)
+        + _micro(12.19)
+        + _micro(226.541)
+        + bytes([8])
+        + _micro(25.0)
+        + _micro(265.0)
+        + struct.pack(">II", 12191000, 12191000)
+        + bytes([0, 0x40])
+        + _micro(25.0)
+        + _micro(25.0)
+        + _micro(-90.0)
+        + _micro(0.0)
+    )
+
+
+def latlon_section():
+    """Section 3 of the MRMS sample grid, template 3.0."""
+    ny, nx = MRMS_SHAPE
+    lat0, lon0 = MRMS_FIRST
+    return (
+        struct.pack(">IBBIBBH", 72, 3, 0, nx * ny, 0, 0, 0)
+        + bytes([6])
+        + bytes(15)
+        + struct.pack(">II", nx, ny)
+        + bytes(4)
+        + b"\xff" * 4
+        + _micro(lat0)
+        + _micro(lon0)
+        + bytes([0x30])
+        + _micro(lat0 - (ny - 1) * 0.01)
+        + _micro(lon0 + (nx - 1) * 0.01)
+        + struct.pack(">II", 10000, 10000)
+        + bytes([0])
+    )
+
+
+def encode(vals, grid, discipline, category, number, sfc, level, dscale=0):
+    """Encode one GRIB2 message of these (rows, cols) values.
+
+    Args:
+      vals (array): values, rows in the grid's scanning order
+      grid (bytes): section 3
+      discipline (int): product discipline
+      category (int): parameter category
+      number (int): parameter number
+      sfc (int): type of first fixed surface
+      level (int): scaled value of first fixed surface
+      dscale (int): decimal scale factor, the precision kept
+
+    Returns:
+      bytes of the message
+    """
+    scaled = np.rint(np.asarray(vals, dtype=np.float64) * 10**dscale)
+    ref = float(scaled.min())
+    packed = scaled - ref
+    if packed.max() >= 2**16:
+        raise ValueError("values exceed 16 bits at this decimal scale")
+    sec1 = struct.pack(
+        ">IBHHBBBHBBBBBBB", 21, 1, 7, 0, 2, 1, 1, 2024, 1, 1, 0, 0, 0, 0, 1
+    )
+    sec4 = struct.pack(
+        ">IBHHBBBBBHBBIBBIBBI",
+        34,
+        4,
+        0,
+        0,
+        category,
+        number,
+        2,
+        0,
+        84,
+        0,
+        0,
+        1,
+        0,
+        sfc,
+        0,
+        level,
+        255,
+        0,
+        0,
+    )
+    sec5 = (
+        struct.pack(">IBIHf", 21, 5, packed.size, 0, ref)
+        + _sm(0, 2)
+        + _sm(dscale, 2)
+        + bytes([16, 0])
+    )
+    sec6 = struct.pack(">IBB", 6, 6, 255)
+    data = packed.astype(">u2").tobytes()
+    sec7 = struct.pack(">IB", 5 + len(data), 7) + data
+    body = sec1 + grid + sec4 + sec5 + sec6 + sec7 + b"7777"
+    return (
+        b"GRIB\x00\x00"
+        + bytes([discipline, 2])
+        + struct.pack(">Q", 16 + len(body))
+        + body
+    )
+
+
+def nam_fields(seed=0):
+    """Return plausible NAM218 values for each fxgridder field."""
+    rng = np.random.default_rng(seed)
+    ny, nx = NAM_SHAPE
+    jj, ii = np.mgrid[0:ny, 0:nx]
+    wave = np.sin(ii / 40.0) * np.cos(jj / 30.0)
+    return {
+        "tmpk": 270.0 + 15.0 * wave + rng.normal(0, 1, NAM_SHAPE),
+        "rh": np.clip(60.0 + 30.0 * wave, 5, 100),
+        "uwnd": 8.0 * wave + rng.normal(0, 2, NAM_SHAPE),
+        "vwnd": -6.0 * wave + rng.normal(0, 2, NAM_SHAPE),
+        "pcpn": np.clip(rng.gamma(0.3, 2.0, NAM_SHAPE) - 0.5, 0, 60),
+        "vsby": np.clip(24000.0 * (1.2 + wave) / 2.2, 100, 24100),
+    }
+
+
+def nam_grib(seed=0):
+    """Return a NAM218 GRIB2 file holding the fxgridder fields."""
+    grid = lambert_section()
+    return b"".join(
+        encode(vals, grid, *NAM_FIELDS[field])
+        for field, vals in nam_fields(seed).items()
+    )
+
+
+def mrms_grib(product, seed=0):
+    """Return an MRMS-like GRIB2 message of this product."""
+    rng = np.random.default_rng(seed)
+    if product == "PrecipFlag":
+        codes = np.array([-3, 0, 1, 3, 6, 7, 10, 91, 96])
+        vals = codes[rng.integers(0, len(codes), MRMS_SHAPE)]
+        return encode(vals, latlon_section(), 209, 1, 0, 1, 0)
+    vals = np.clip(rng.gamma(0.4, 5.0, MRMS_SHAPE) - 1.0, 0, 300)
+    return encode(vals, latlon_section(), 209, 6, 1, 1, 0, 2)
@@ -0,0 +1,141 @@
+"""Benchmarks of each gridder stage, run fully offline.
+
+Usage, from this directory:
+
+    python -m pytest --benchmark-autosave
+    python -m pytest --benchmark-compare --benchmark-compare-fail=mean:10%
+
+Saved runs are compared between revisions with `pytest-benchmark compare`.
+The peak memory allocated by one call, as traced by tracemalloc, is kept
+in each benchmark's extra_info.  Station stages are timed with a cold
+StationPlan, as the station set changes from one cycle to the next, and
+warnings both with and without building the ugc index.
+"""
+
+import os
+import shutil
+from datetime import datetime, timezone
+
+import fxgridder
+import i5gridder
+import mrmsreader
+import numpy as np
+import pytest
+import regrid
+import ugcindex
+import wawa
+from griddef import GRID
+
+pytest.importorskip("pytest_benchmark")
+
+VALID = datetime(2024, 1, 1, 12, tzinfo=timezone.utc)
+STATION_STAGES = {
+    "simple": ["tmpc", "dwpc", "smps", "drct", "vsby"],
+    "snowd": ["snwd"],
+    "roadtmpc": ["roadtmpc"],
+    "srad": ["srad"],
+}
+
+
+def analysis_grids(seed=0):
+    """Return analysis grids filled with plausible values."""
+    rng = np.random.default_rng(seed)
+    grids = i5gridder.init_grids()
+    for label, grid in grids.items():
+        if label == "wawa":
+            bits = [wawa.code_bit(c) for c in ("TO.W", "SV.A", "WS.W")]
+            grid[:] = rng.choice([0, *bits], GRID.shape)
+        else:
+            grid[:] = rng.uniform(-20, 40, GRID.shape)
+    return grids
+
+
+@pytest.mark.parametrize("engine", ["nearest", "idw", "barnes"])
+@pytest.mark.parametrize("stage", list(STATION_STAGES))
+def test_station_stage(measure, fakedb, monkeypatch, stage, engine):
+    """Station query, plan and interpolation of one stage."""
+    for label in STATION_STAGES[stage]:
+        monkeypatch.setitem(i5gridder.DOMAIN[label], "engine", engine)
+    grids = i5gridder.init_grids()
+    measure(
+        getattr(i5gridder, stage),
+        grids,
+        VALID,
+        False,
+        setup=regrid._PLANS.clear,
+    )
+    for label in STATION_STAGES[stage]:
+        assert np.isfinite(grids[label]).all()
+
+
+@pytest.mark.parametrize("index", ["cold", "warm"])
+def test_wwa(measure, fakedb, monkeypatch, tmp_path, index):
+    """Warnings gathered from the ugc index, built anew when cold."""
+    cachedir = str(tmp_path / "ugcindex")
+    monkeypatch.setattr(ugcindex, "CACHEDIR", cachedir)
+    monkeypatch.setattr(ugcindex, "_INDICES", {})
+    grids = i5gridder.init_grids()
+
+    def _reset():
+        ugcindex._INDICES.clear()
+        shutil.rmtree(cachedir, ignore_errors=True)
+
+    def _wwa():
+        grids["wawa"][:] = 0
+        i5gridder.wwa(grids, VALID, False)
+
+    measure(_wwa, setup=_reset if index == "cold" else None)
+    assert grids["wawa"].any()
+
+
+@pytest.mark.parametrize("stage", ["ptype", "pcpn"])
+def test_mrms_stage(measure, fakemrms, stage):
+    """MRMS decode and window extraction."""
+    grids = i5gridder.init_grids()
+    measure(getattr(i5gridder, stage), grids, VALID, False, setup=fakemrms)
+    assert grids[stage].shape == GRID.shape
+
+
+def test_mrms_window_index(benchmark, mrms_samples):
+    """Locating the analysis window within an MRMS grid."""
+    import gzip
+
+    import pygrib
+
+    grb = pygrib.fromstring(gzip.decompress(mrms_samples["PrecipFlag"]))
+    rows, cols = benchmark(
+        mrmsreader.window_index, grb, GRID.xaxis, GRID.yaxis
+    )
+    assert (rows.size, cols.size) == GRID.shape
+
+
+def test_analysis_write_grids(measure, monkeypatch):
+    """Serialization of the analysis document to disk."""
+    monkeypatch.setattr(i5gridder, "upload_s3", lambda fn: True)
+    measure(i5gridder.write_grids, analysis_grids(), VALID, False)
+
+
+@pytest.mark.parametrize("index", ["cold", "warm"])
+def test_forecast_write_grids(measure, fakenam, monkeypatch, tmp_path, index):
+    """Decode, regrid and serialization of one NAM forecast hour."""
+    cachedir = str(tmp_path / "regrid")
+    monkeypatch.setattr(regrid, "CACHEDIR", cachedir)
+    monkeypatch.setattr(regrid, "_INDICES", {})
+    fakenam(VALID, [3])
+
+    def _reset():
+        # the source grid index is built once per process and disk cached
+        fxgridder.G["INDEX"] = None
+        regrid._INDICES.clear()
+        shutil.rmtree(cachedir, ignore_errors=True)
+
+    _reset()
+    with open(os.devnull, "w") as fp:
+        measure(
+            fxgridder.write_grids,
+            fp,
+            VALID,
+            3,
+            setup=_reset if index == "cold" else None,
+        )
+    _reset()
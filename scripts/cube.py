@@ -0,0 +1,284 @@
+"""Append-only, tiled time-series cube of the analyses.
+
+Each variable has one file per UTC day, holding a slot for every 5 minute
+analysis of that day.  The file is laid out as (tile row, tile column,
+slot, row within tile, column within tile), so:
+
+ - appending an analysis writes one small contiguous block per tile
+ - a cell's series for the day lies within its tile's block, so reading
+   long per-cell series via a memory map touches few pages
+
+A per-day slot index for each variable records which analyses have been
+appended.  Appends take an exclusive flock on the day, so concurrent
+backfill workers are safe and a slot is only marked present once its data
+is written.
+
+    {cubedir}/%Y/%m/%d/{variable}.cube
+    {cubedir}/%Y/%m/%d/{variable}.slots
+    {cubedir}/%Y/%m/%d/wawa.json
+
+wawa.json is the code table of the day's wawa bitsets.  Appends re-encode
+their bitsets with it, adding any code it lacks, as processes assign the
+bits of codes outside the reserved ones in differing orders.
+"""
+
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+import wawa
+from griddef import GRID
+from gridstore import resolve_gids
+
+INTERVAL = 5
+SLOTS = 24 * 60 // INTERVAL
+# 324 x 660 grid as 27 x 55 tiles of 12 x 12 cells
+TILE = (12, 12)
+
+
+def dtype_for(label):
+    """Storage dtype of this variable."""
+    return wawa.DTYPE if label == "wawa" else np.float32
+
+
+def day_dir(cubedir, valid):
+    """Directory holding this day of the cube."""
+    return os.path.join(cubedir, f"{valid:%Y/%m/%d}")
+
+
+def on_cadence(valid):
+    """Is this analysis time one of the cube's slots?"""
+    return not (valid.minute % INTERVAL or valid.second or valid.microsecond)
+
+
+def slot_for(valid):
+    """Slot of this analysis time within its day."""
+    if not on_cadence(valid):
+        raise ValueError(f"{valid} is not on a {INTERVAL} minute boundary")
+    return (valid.hour * 60 + valid.minute) // INTERVAL
+
+
+def cube_shape():
+    """Shape of a day file: tile rows, tile cols, slots, tile shape."""
+    th, tw = TILE
+    return (GRID.ny // th, GRID.nx // tw, SLOTS, th, tw)
+
+
+def open_day(cubedir, valid, label, mode="r"):
+    """Memory map this variable's day file, None when it does not exist."""
+    fn = os.path.join(day_dir(cubedir, valid), f"{label}.cube")
+    if mode == "r" and not os.path.isfile(fn):
+        return None
+    return np.memmap(fn, dtype=dtype_for(label), mode=mode, shape=cube_shape())
+
+
+def read_slots(cubedir, valid, label=None):
+    """Return the boolean slot index of this day and variable.
+
+    Without a variable, the slots holding any variable are returned.
+    """
+    ddir = day_dir(cubedir, valid)
+    res = np.zeros(SLOTS, bool)
+    if not os.path.isdir(ddir):
+        return res
+    for fn in os.listdir(ddir):
+        if fn.endswith(".slots") and label in (None, fn[:-6]):
+            path = os.path.join(ddir, fn)
+            res |= np.fromfile(path, dtype=np.uint8).astype(bool)
+    return res
+
+
+@contextmanager
+def locked(cubedir, valid):
+    """Hold the exclusive lock on this day of the cube."""
+    ddir = day_dir(cubedir, valid)
+    os.makedirs(ddir, exist_ok=True)
+    with open(os.path.join(ddir, ".lock"), "a") as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield ddir
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def read_codes(cubedir, valid):
+    """Return the wawa code table of this day, None if not saved."""
+    fn = os.path.join(day_dir(cubedir, valid), "wawa.json")
+    if not os.path.isfile(fn):
+        return None
+    with open(fn) as fh:
+        return json.load(fh)
+
+
+def align_codes(cubedir, valid, grid):
+    """Re-encode a wawa grid with the day's code table, extending it.
+
+    Only call while holding the day's lock.
+    """
+    ours = wawa.code_table()
+    saved = read_codes(cubedir, valid)
+    table = list(ours) if saved is None else saved
+    extra = [code for code in ours if code not in table]
+    if len(table) + len(extra) > np.iinfo(wawa.DTYPE).bits:
+        raise ValueError(f"No wawa bits left in the cube for {extra}")
+    if saved is None or extra:
+        table.extend(extra)
+        fn = os.path.join(day_dir(cubedir, valid), "wawa.json")
+        with open(f"{fn}.tmp", "w") as fh:
+            json.dump(table, fh)
+        os.replace(f"{fn}.tmp", fn)
+    return wawa.remap(grid, ours, table)
+
+
+def to_tiles(grid):
+    """Reshape a (rows, cols) grid into (tile row, tile col, th, tw)."""
+    th, tw = TILE
+    ny, nx = grid.shape
+    return grid.reshape(ny // th, th, nx // tw, tw).transpose(0, 2, 1, 3)
+
+
+def append(cubedir, grids, valid, variables):
+    """Append this analysis to the cube, replacing any prior copy.
+
+    Args:
+      cubedir (str): cube root
+      grids (dict): the analysis grids
+      valid (datetime): analysis time, on a 5 minute boundary
+      variables (list): grid labels to store
+    """
+    slot = slot_for(valid)
+    with locked(cubedir, valid) as ddir:
+        for label in variables:
+            fn = os.path.join(ddir, f"{label}.cube")
+            mode = "r+" if os.path.isfile(fn) else "w+"
+            mm = open_day(cubedir, valid, label, mode)
+            grid = np.asarray(grids[label], dtype=dtype_for(label))
+            if label == "wawa":
+                grid = align_codes(cubedir, valid, grid)
+            mm[:, :, slot] = to_tiles(grid)
+            mm.flush()
+            del mm
+            slotsfn = os.path.join(ddir, f"{label}.slots")
+            if not os.path.isfile(slotsfn):
+                np.zeros(SLOTS, np.uint8).tofile(slotsfn)
+            with open(slotsfn, "r+b") as fh:
+                fh.seek(slot)
+                fh.write(b"\x01")
+
+
+def available(cubedir, sts, ets):
+    """Return the analysis times in the cube with sts <= valid < ets."""
+    res = []
+    day = sts.replace(hour=0, minute=0, second=0, microsecond=0)
+    while day < ets:
+        for slot in np.flatnonzero(read_slots(cubedir, day)):
+            valid = day + timedelta(minutes=int(slot) * INTERVAL)
+            if sts <= valid < ets:
+                res.append(valid)
+        day += timedelta(days=1)
+    return res
+
+
+def read_series(cubedir, label, sts, ets, gids):
+    """Read the series of these cells over sts <= valid < ets.
+
+    Returns:
+      (list of valid times, array of shape (times, cells))
+    """
+    gids = np.asarray(gids, dtype=np.int64)
+    rows, cols = GRID.gid_to_rowcol(np.maximum(gids, 1))
+    th, tw = TILE
+    ty, iy = np.divmod(rows, th)
+    tx, ix = np.divmod(cols, tw)
+    valids = []
+    blocks = []
+    day = sts.replace(hour=0, minute=0, second=0, microsecond=0)
+    while day < ets:
+        mm = open_day(cubedir, day, label)
+        slots = np.flatnonzero(read_slots(cubedir, day, label))
+        times = [day + timedelta(minutes=int(s) * INTERVAL) for s in slots]
+        keep = [i for i, t in enumerate(times) if sts <= t < ets]
+        if mm is not None and keep:
+            slots = slots[keep]
+            valids.extend(times[i] for i in keep)
+            blocks.append(
+                np.asarray(
+                    mm[ty[None], tx[None], slots[:, None], iy[None], ix[None]]
+                )
+            )
+        day += timedelta(days=1)
+    if not blocks:
+        return [], np.empty((0, len(gids)), dtype=dtype_for(label))
+    return valids, np.concatenate(blocks)
+
+
+def query(cubedir, sts, ets, variables, gids=None, lons=None, lats=None):
+    """Query the cube, returning the same frame as gridstore.query()."""
+    cells = resolve_gids(gids, lons, lats)
+    columns = {}
+    valids = available(cubedir, sts, ets)
+    for label in variables:
+        times, vals = read_series(cubedir, label, sts, ets, cells)
+        # a variable may be absent from times the others have
+        series = dict(zip(times, vals, strict=True))
+        data = []
+        for valid in valids:
+            row = series.get(valid)
+            if row is None:
+                data.extend([None if label == "wawa" else np.nan] * len(cells))
+            elif label == "wawa":
+                table = read_codes(cubedir, valid)
+                data.extend(
+                    wawa.bitset_codes(int(b), table) if gid > 0 else None
+                    for b, gid in zip(row, cells, strict=True)
+                )
+            else:
+                data.extend(np.where(cells > 0, row, np.nan))
+        columns[label] = data
+    return pd.DataFrame(
+        {
+            "valid": np.repeat(np.array(valids, dtype=object), len(cells)),
+            "gid": np.tile(cells, len(valids)),
+            **columns,
+        },
+        columns=["valid", "gid", *variables],
+    )
+
+
+def test_cube(tmp_path, monkeypatch):
+    """Appended analyses are read back as per cell series."""
+    from datetime import datetime, timezone
+
+    cubedir = str(tmp_path)
+    # the series spans midnight, so two day files
+    valid = datetime(2024, 1, 1, 23, 55, tzinfo=timezone.utc)
+    valids = [valid + timedelta(minutes=5 * i) for i in range(3)]
+    for i, now in enumerate(valids):
+        grids = {
+            "tmpc": np.arange(GRID.size).reshape(GRID.shape) + i * 0.5,
+            "wawa": GRID.zeros(wawa.DTYPE),
+        }
+        grids["wawa"][-1, -1] = wawa.code_bit("TO.W")
+        # wawa is missing for the second time
+        append(cubedir, grids, now, ["tmpc"] if i == 1 else ["tmpc", "wawa"])
+    sts = valid - timedelta(hours=1)
+    ets = valid + timedelta(hours=1)
+    assert available(cubedir, sts, ets) == valids
+    times, vals = read_series(cubedir, "tmpc", sts, ets, [1, GRID.size])
+    assert times == valids
+    np.testing.assert_array_equal(vals[:, 0], [0, 0.5, 1])
+    df = query(cubedir, sts, ets, ["tmpc", "wawa"], [GRID.size, 0])
+    assert df["tmpc"].tolist()[::2] == [GRID.size - 1 + x for x in (0, 0.5, 1)]
+    assert df["wawa"].tolist() == [["TO.W"], None, None, None, ["TO.W"], None]
+    # a process with other bits has its bitsets re-encoded on append
+    monkeypatch.setattr(wawa, "BITS", {"SQ.W": 0, "TO.W": 1})
+    grids["wawa"][-1, -1] = 3
+    append(cubedir, grids, valids[1], ["wawa"])
+    monkeypatch.undo()
+    df = query(cubedir, valids[1], valids[2], ["wawa"], [GRID.size])
+    assert df["wawa"].tolist() == [["TO.W", "SQ.W"]]
+    assert not on_cadence(valid + timedelta(minutes=1))
@@ -0,0 +1,48 @@
+"""Database connections drawn from long lived engine pools.
+
+pyiem's get_sqlalchemy_conn creates and disposes an engine, so a new
+database connection, for every query.  This drop in replacement keeps one
+engine per database and process, so a resident process such as i5daemon
+reuses its open connections from one cycle to the next.
+"""
+
+import os
+import threading
+from contextlib import contextmanager
+
+from pyiem.database import get_dbconnstr
+from sqlalchemy import create_engine
+
+# Engines keyed by (database name, pid), as forked children must not share
+# their parent's connections
+_ENGINES = {}
+_LOCK = threading.Lock()
+
+
+def get_engine(name):
+    """Return this process's engine for this database."""
+    key = (name, os.getpid())
+    with _LOCK:
+        if key not in _ENGINES:
+            connstr = get_dbconnstr(name).replace(
+                "postgresql", "postgresql+psycopg"
+            )
+            # connections idle between cycles may have been dropped
+            _ENGINES[key] = create_engine(
+                connstr, pool_pre_ping=True, pool_recycle=3600
+            )
+        return _ENGINES[key]
+
+
+@contextmanager
+def get_sqlalchemy_conn(name):
+    """Yield a pooled connection to this database."""
+    with get_engine(name).connect() as conn:
+        yield conn
+
+
+def dispose():
+    """Close every pooled connection of this process."""
+    with _LOCK:
+        for key in [key for key in _ENGINES if key[1] == os.getpid()]:
+            _ENGINES.pop(key).dispose()
@@ -0,0 +1,200 @@
+"""Concurrent, resumable HTTP downloads over a pooled session.
+
+Files are streamed to a `.part` file alongside the target and only renamed
+into place once their size is verified, so a file that exists is always
+complete.  A failed transfer is retried with a Range request continuing
+from the bytes already on disk.
+"""
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from pyiem.util import logger
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError
+
+LOG = logger()
+CHUNK = 1024 * 1024
+
+
+class Downloader:
+    """Download files with a bounded number of concurrent transfers.
+
+    Args:
+      workers (int): maximum number of concurrent transfers
+      retries (int): attempts per file
+      backoff (float): seconds to wait after the first failed attempt,
+        doubled for each further attempt
+      timeout (float): connect and read timeout in seconds
+      session (requests.Session,optional): session to use
+    """
+
+    def __init__(
+        self, workers=4, retries=5, backoff=1.0, timeout=60, session=None
+    ):
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=workers, pool_maxsize=workers
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self.session = session
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def _attempt(self, uri, partfn):
+        """Make one attempt to complete partfn, returning True when done.
+
+        Returns False when the server does not have the file.
+        """
+        offset = os.path.getsize(partfn) if os.path.isfile(partfn) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        with self.session.get(
+            uri, headers=headers, stream=True, timeout=self.timeout
+        ) as resp:
+            if resp.status_code == 404:
+                return False
+            if resp.status_code == 416:
+                # our partial file is not a prefix of theirs, start over
+                os.unlink(partfn)
+                raise OSError(f"Range not satisfiable for {uri}")
+            resp.raise_for_status()
+            length = resp.headers.get("Content-Length")
+            if resp.status_code == 206:
+                mode = "ab"
+                crange = resp.headers.get("Content-Range")
+                if crange is None:
+                    # we can not tell what the part continues, start over
+                    os.unlink(partfn)
+                    raise OSError(f"No Content-Range for {uri}")
+                total = crange.split("/")[-1]
+                total = None if total == "*" else int(total)
+            else:
+                mode = "wb"
+                total = None if length is None else int(length)
+            with open(partfn, mode) as fh:
+                for chunk in resp.raw.stream(CHUNK, decode_content=False):
+                    fh.write(chunk)
+        size = os.path.getsize(partfn)
+        if total is not None and size != total:
+            raise OSError(f"{uri} has {size} of {total} bytes")
+        return True
+
+    def fetch(self, uri, fn, post=None):
+        """Download uri to fn, unless fn already exists.
+
+        Args:
+          uri (str): what to download
+          fn (str): where to save it
+          post (callable,optional): called with fn once it is complete, a
+            failure removes fn, such as a corrupt file it can not read
+
+        Returns:
+          fn, or None when the download or post failed
+        """
+        if not os.path.isfile(fn) and not self._download(uri, fn):
+            return None
+        if post is None:
+            return fn
+        try:
+            post(fn)
+        except Exception as exp:
+            LOG.warning("Removing %s, as %s failed: %s", fn, post, exp)
+            os.unlink(fn)
+            return None
+        return fn
+
+    def _download(self, uri, fn):
+        """Download uri to fn with retries, returning success."""
+        partfn = f"{fn}.part"
+        for attempt in range(self.retries):
+            try:
+                if not self._attempt(uri, partfn):
+                    LOG.warning("%s not found", uri)
+                    return False
+                os.replace(partfn, fn)
+                return True
+            except (requests.RequestException, HTTPError, OSError) as exp:
+                LOG.info("attempt %s for %s failed: %s", attempt + 1, uri, exp)
+            if attempt + 1 < self.retries:
+                time.sleep(self.backoff * 2**attempt)
+        LOG.warning("download of %s failed", uri)
+        return False
+
+    def submit(self, uri, fn, post=None):
+        """Queue this download, returning a future resolving to fetch()."""
+        return self.pool.submit(self.fetch, uri, fn, post)
+
+    def close(self, wait=True):
+        """Stop taking downloads, cancelling those not started unless wait."""
+        self.pool.shutdown(wait=wait, cancel_futures=not wait)
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(wait=exc_type is None)
+
+
+def test_download(tmp_path):
+    """A truncated transfer is resumed and files are only renamed whole."""
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    payload = os.urandom(300_000)
+    ranges = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/file":
+                self.send_error(404)
+                return
+            rng = self.headers.get("Range")
+            ranges.append(rng)
+            if rng is None:
+                # advertise everything, send half, then hang up
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload[: len(payload) // 2])
+                self.close_connection = True
+                return
+            start = int(rng.split("=")[1].rstrip("-"))
+            self.send_response(206)
+            self.send_header(
+                "Content-Range",
+                f"bytes {start}-{len(payload) - 1}/{len(payload)}",
+            )
+            self.send_header("Content-Length", str(len(payload) - start))
+            self.end_headers()
+            self.wfile.write(payload[start:])
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    try:
+        with Downloader(workers=2, backoff=0) as dl:
+            good = dl.submit(f"{base}/file", str(tmp_path / "a.bin"))
+            bad = dl.submit(f"{base}/missing", str(tmp_path / "b.bin"))
+            assert good.result() == str(tmp_path / "a.bin")
+            assert bad.result() is None
+            # an unreadable file is removed, rather than raising
+            (tmp_path / "c.bin").write_bytes(b"GRIB")
+            post = dl.submit(f"{base}/c", str(tmp_path / "c.bin"), post=int)
+            assert post.result() is None
+    finally:
+        server.shutdown()
+    assert (tmp_path / "a.bin").read_bytes() == payload
+    # the retry continued from whatever reached the disk
+    assert len(ranges) == 2 and ranges[0] is None
+    assert 0 < int(ranges[1][6:-1]) <= len(payload) // 2
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["a.bin"]
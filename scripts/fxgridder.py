@@ -1,38 +1,61 @@
 """Generate forecast grids"""
 
+import argparse
 import glob
 import os
 import socket
 import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timezone
+from io import StringIO
 
-import boto3
-import numpy as np
-import pygrib
-import requests
+import instrument
 from botocore.exceptions import ClientError
-from pyiem import reference
+from download import Downloader
+from gribindex import load_index, read_fields
+from griddef import GRID
+from instrument import count
+from ncwriter import ForecastNC
 from pyiem.datatypes import humidity, speed, temperature
 from pyiem.meteorology import dewpoint, drct
 from pyiem.reference import ISO8601
-from pyiem.util import exponential_backoff, logger
-from scipy.interpolate import NearestNDInterpolator
+from pyiem.util import logger
+from regrid import get_index, regrid
+from s3sink import BUCKET, EXTENSIONS, S3Sink, get_s3_client
+from serializer import write_forecast
 
 LOG = logger()
 TMP = "/mesonet/tmp"
 PROGRAM_VERSION = "2"
-XAXIS = np.arange(reference.IA_WEST, reference.IA_EAST - 0.01, 0.01)
-YAXIS = np.arange(reference.IA_SOUTH, reference.IA_NORTH - 0.01, 0.01)
-XI, YI = np.meshgrid(XAXIS, YAXIS)
-G = {"LATS": None, "LONS": None}
-
-
-def dl(valid):
-    for fhour in range(0, 85, 3):
-        fn = "%s/%sF%03i.grib2" % (TMP, valid.strftime("%Y%m%d%H%M"), fhour)
-        if os.path.isfile(fn):
-            continue
-        # Go Fetch it!
+XAXIS = GRID.xaxis
+YAXIS = GRID.yaxis
+XI, YI = GRID.xi, GRID.yi
+G = {"LATS": None, "LONS": None, "INDEX": None}
+FHOURS = range(0, 85, 3)
+DOMAIN = {
+    "tmpc": {"units": "C", "format": "%.2f"},
+    "dwpc": {"units": "C", "format": "%.2f"},
+    "smps": {"units": "mps", "format": "%.1f"},
+    "drct": {"units": "deg", "format": "%i"},
+    "vsby": {"units": "km", "format": "%.3f"},
+    "pcpn": {"units": "mm", "format": "%.2f"},
+}
+
+
+def gribname(valid, fhour):
+    """Local filename of this forecast hour's GRIB file."""
+    return "%s/%sF%03i.grib2" % (TMP, valid.strftime("%Y%m%d%H%M"), fhour)
+
+
+def dl(valid, downloader):
+    """Queue the NAM GRIB file downloads from mtarchive.
+
+    Returns:
+      dict of forecast hour -> future resolving to the filename or None
+    """
+    res = {}
+    for fhour in FHOURS:
         uri = valid.strftime(
             (
                 "http://mtarchive.geol.iastate.edu/%Y/%m/%d/"
@@ -41,108 +64,184 @@ def dl(valid):
                 + ".grib2"
             )
         )
-        r = exponential_backoff(requests.get, uri, timeout=60)
-        if r is None or r.status_code != 200:
-            print("fxgridder dl error for: %s" % (uri,))
-            continue
-        with open(fn, "wb") as o:
-            o.write(r.content)
+        # index the messages while the file is still in the page cache
+        res[fhour] = downloader.submit(
+            uri, gribname(valid, fhour), post=load_index
+        )
+    return res
 
 
-def write_grids(fp, valid, fhour):
-    """Do the write to disk"""
-    gribfn = "%s/%sF%03i.grib2" % (TMP, valid.strftime("%Y%m%d%H%M"), fhour)
+def wait_for(downloads, fhour):
+    """Block until this forecast hour's download, if any, has finished."""
+    if downloads is None:
+        return
+    with instrument.stage("download"):
+        try:
+            fn = downloads[fhour].result()
+        except Exception as exp:
+            LOG.exception(exp)
+            fn = None
+        if fn is None:
+            print("fxgridder dl error for forecast hour: %s" % (fhour,))
+            return
+        count("bytes", os.path.getsize(fn))
+
+
+def grid_hour(valid, fhour):
+    """Decode and regrid this forecast hour, None if its file is missing."""
+    gribfn = gribname(valid, fhour)
     if not os.path.isfile(gribfn):
         print("Skipping write_grids because of missing fn: %s" % (gribfn,))
-        return
-    gribs = pygrib.open(gribfn)
-    grids = dict()
-    for grib in gribs:
-        grids[grib.name] = grib
+        return None
+    with instrument.stage("grid"):
+        return _grid_hour(gribfn)
+
+
+def _grid_hour(gribfn):
+    # Only the messages we need are read and decoded
+    msgs = read_fields(gribfn)
+    count("messages", len(msgs))
+    if G["INDEX"] is None and msgs:
+        G["LATS"], G["LONS"] = next(iter(msgs.values())).latlons()
+        G["INDEX"] = get_index(G["LONS"], G["LATS"], XI, YI)
     d = dict()
-    if "2 metre temperature" in grids:
-        g = grids["2 metre temperature"]
-        if G["LATS"] is None:
-            G["LATS"], G["LONS"] = g.latlons()
-        vals = temperature(g.values, "K").value("C")
-        nn = NearestNDInterpolator(
-            (G["LONS"].flatten(), G["LATS"].flatten()), vals.flatten()
-        )
-        d["tmpc"] = nn(XI, YI)
-        if "2 metre relative humidity" in grids:
-            g = grids["2 metre relative humidity"]
-            vals = g.values
-            nn = NearestNDInterpolator(
-                (G["LONS"].flatten(), G["LATS"].flatten()), vals.flatten()
-            )
-            rh = nn(XI, YI)
+    if "tmpk" in msgs:
+        vals = temperature(regrid(msgs["tmpk"].values, G["INDEX"]), "K")
+        d["tmpc"] = vals.value("C")
+        if "rh" in msgs:
+            rh = regrid(msgs["rh"].values, G["INDEX"])
             d["dwpc"] = dewpoint(
                 temperature(d["tmpc"], "C"), humidity(rh, "%")
             ).value("C")
-    if (
-        "10 metre U wind component" in grids
-        and "10 metre V wind component" in grids
-    ):
-        u = grids["10 metre U wind component"].values
-        v = grids["10 metre V wind component"].values
-        vals = ((u**2) + (v**2)) ** 0.5
-        nn = NearestNDInterpolator(
-            (G["LONS"].flatten(), G["LATS"].flatten()), vals.flatten()
-        )
-        d["smps"] = nn(XI, YI)
-        vals = drct(speed(u, "MPS"), speed(v, "MPS")).value("deg")
-        nn = NearestNDInterpolator(
-            (G["LONS"].flatten(), G["LATS"].flatten()), vals.flatten()
-        )
-        d["drct"] = nn(XI, YI)
-    if "Total Precipitation" in grids:
-        vals = grids["Total Precipitation"].values
-        nn = NearestNDInterpolator(
-            (G["LONS"].flatten(), G["LATS"].flatten()), vals.flatten()
-        )
-        d["pcpn"] = nn(XI, YI)
-    if "Visibility" in grids:
-        vals = grids["Visibility"].values / 1000.0  # km
-        nn = NearestNDInterpolator(
-            (G["LONS"].flatten(), G["LATS"].flatten()), vals.flatten()
-        )
-        d["vsby"] = nn(XI, YI)
+    if "uwnd" in msgs and "vwnd" in msgs:
+        # nearest neighbour, so regridding the components first is exact
+        u = regrid(msgs["uwnd"].values, G["INDEX"])
+        v = regrid(msgs["vwnd"].values, G["INDEX"])
+        d["smps"] = ((u**2) + (v**2)) ** 0.5
+        d["drct"] = drct(speed(u, "MPS"), speed(v, "MPS")).value("deg")
+    if "pcpn" in msgs:
+        d["pcpn"] = regrid(msgs["pcpn"].values, G["INDEX"])
+    if "vsby" in msgs:
+        d["vsby"] = regrid(msgs["vsby"].values, G["INDEX"]) / 1000.0  # km
+    return d
+
 
+def write_hour(fp, fhour, d):
+    """Write the JSON for this forecast hour's grids.
+
+    Hours may be skipped, so the caller separates the hours written.
+    """
+    with instrument.stage("serialize"):
+        _write_hour(fp, fhour, d)
+
+
+def _write_hour(fp, fhour, d):
     fp.write(
         """{"forecast_hour": "%03i",
     "gids": [
 """
         % (fhour,)
     )
-    fmt = (
-        '{"gid": %s, "tmpc": %s, "dwpc": %s, '
-        '"smps": %s, "drct": %s, "vsby": %s, "pcpn": %s}'
-    )
-    i = 1
-    ar = []
-
-    def f(label, row, col, fmt):
-        if label not in d:
-            return "null"
-        return fmt % d[label][row, col]
-
-    for row in range(len(YAXIS)):
-        for col in range(len(XAXIS)):
-            ar.append(
-                fmt
-                % (
-                    i,
-                    f("tmpc", row, col, "%.2f"),
-                    f("dwpc", row, col, "%.2f"),
-                    f("smps", row, col, "%.1f"),
-                    f("drct", row, col, "%i"),
-                    f("vsby", row, col, "%.3f"),
-                    f("pcpn", row, col, "%.2f"),
-                )
-            )
-            i += 1
-    fp.write(",\n".join(ar))
-    fp.write("]}%s\n" % ("," if fhour != 84 else "",))
+    write_forecast(fp, d, GRID.size)
+    fp.write("]}\n")
+
+
+def write_grids(fp, valid, fhour, nc=None, first=True):
+    """Do the write to disk, and to the optional ForecastNC
+
+    Args:
+      first (bool): no hour was written before this one, else this one
+        starts with the separator
+
+    Returns:
+      bool whether the hour was written
+    """
+    d = grid_hour(valid, fhour)
+    if d is None:
+        return False
+    if nc is not None:
+        with instrument.stage("netcdf"):
+            nc.write_hour(fhour, d)
+    if not first:
+        fp.write(",")
+    write_hour(fp, fhour, d)
+    return True
+
+
+def render_grids(valid, fhour, keepgrids=False):
+    """Grid this forecast hour within a worker process.
+
+    Returns:
+      its JSON, optionally its grids, and the metrics of its stages
+    """
+    metrics = instrument.Metrics(f"fx_{valid:%Y%m%d%H}_F{fhour:03d}")
+    with metrics.activate():
+        d = grid_hour(valid, fhour)
+        if d is None:
+            return "", None, metrics.stage_dicts()
+        fp = StringIO()
+        write_hour(fp, fhour, d)
+    return fp.getvalue(), (d if keepgrids else None), metrics.stage_dicts()
+
+
+def write_grids_serial(fp, valid, nc=None, downloads=None):
+    """Grid and write out each forecast hour in turn.
+
+    Args:
+      fp (file): file object to write to
+      valid (datetime): model initialization time
+      nc (ForecastNC,optional): also write the grids to this file
+      downloads (dict,optional): dl() futures to wait on
+    """
+    first = True
+    for fhour in FHOURS:
+        wait_for(downloads, fhour)
+        if write_grids(fp, valid, fhour, nc, first):
+            first = False
+
+
+def write_grids_pool(
+    fp, valid, workers, inflight=None, nc=None, downloads=None
+):
+    """Grid forecast hours in a process pool, writing them out in order.
+
+    Args:
+      fp (file): file object to write to
+      valid (datetime): model initialization time
+      workers (int): number of worker processes
+      inflight (int,optional): maximum number of forecast hours submitted
+        but not yet written, defaults to twice the number of workers
+      nc (ForecastNC,optional): also write the grids to this file
+      downloads (dict,optional): dl() futures, each forecast hour is
+        submitted once its file has landed
+    """
+    inflight = workers * 2 if inflight is None else max(inflight, 1)
+    pending = deque()
+    written = []
+
+    def _write():
+        fhour, future = pending.popleft()
+        text, d, stages = future.result()
+        instrument.merge(stages)
+        if not text:
+            return
+        if written:
+            fp.write(",")
+        fp.write(text)
+        written.append(fhour)
+        if d is not None:
+            with instrument.stage("netcdf"):
+                nc.write_hour(fhour, d)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for fhour in FHOURS:
+            wait_for(downloads, fhour)
+            future = pool.submit(render_grids, valid, fhour, nc is not None)
+            pending.append((fhour, future))
+            if len(pending) >= inflight:
+                _write()
+        while pending:
+            _write()
 
 
 def write_header(fp, valid):
@@ -164,18 +263,26 @@ def write_header(fp, valid):
     )
 
 
-def write_footer(fp):
-    fp.write("]}")
+def write_footer(fp, metrics=None):
+    """Finalize the file, with a trailing metrics key when given.
+
+    Unlike the analysis, which grids everything before writing, the header
+    here is written, and possibly streamed to S3, before any forecast hour
+    is gridded, so the metrics can only follow the data.
+    """
+    if metrics is None:
+        fp.write("]}")
+        return
+    fp.write('],\n"metrics": %s}' % (metrics.to_json(),))
 
 
 def upload_s3(fn):
-    session = boto3.Session(profile_name="ntrans")
-    s3 = session.client("s3")
+    s3 = get_s3_client()
     sname = fn.split("/")[-1]
     LOG.info("uploading %s to S3 as %s", fn, sname)
     try:
         # Does not return metadata :/
-        s3.upload_file(fn, "intrans-weather-feed", sname)
+        s3.upload_file(fn, BUCKET, sname)
         os.unlink(fn)
         return True
     except ClientError as e:
@@ -184,44 +291,144 @@ def upload_s3(fn):
 
 
 def cleanup(valid):
-    files = glob.glob("%s/%sF???.grib2" % (TMP, valid.strftime("%Y%m%d%H%M")))
+    files = glob.glob("%s/%sF???.grib2*" % (TMP, valid.strftime("%Y%m%d%H%M")))
     for fn in files:
         os.unlink(fn)
 
 
-def run(valid):
+def run(
+    valid,
+    workers=1,
+    inflight=None,
+    stream=None,
+    keep=False,
+    ncdir=None,
+    dlworkers=4,
+):
     """Do the work for this valid time"""
-    # 1. Download NAM grib files from mtarchive
-    dl(valid)
+    # 1. Download NAM grib files from mtarchive, gridding each forecast
+    # hour as soon as its file lands
+    downloader = Downloader(workers=dlworkers)
+    downloads = dl(valid, downloader)
     # 2. create header
     fn = f"{TMP}/fx_{valid:%Y%m%d%H%M}.json"
-    with open(fn, "w") as fp:
-        write_header(fp, valid)
-        # 3. write grids
-        for fhour in range(0, 85, 3):
-            write_grids(fp, valid, fhour)
-        # 4. finalize file
-        write_footer(fp)
-    # 5. save to shared drive
-    upload_s3(fn)
+    if stream is None:
+        fp = open(fn, "w")
+    else:
+        localfn = f"{fn}{EXTENSIONS[stream]}" if keep else None
+        fp = S3Sink(os.path.basename(fn), stream, localfn=localfn)
+    nc = None
+    if ncdir is not None:
+        nc = ForecastNC(
+            f"{ncdir}/fx_{valid:%Y%m%d%H%M}.nc",
+            valid,
+            FHOURS,
+            DOMAIN,
+            XAXIS,
+            YAXIS,
+            PROGRAM_VERSION,
+        )
+    metrics = instrument.Metrics(f"fx_{valid:%Y%m%d%H}")
+    with metrics.activate():
+        with downloader, fp:
+            write_header(fp, valid)
+            # 3. write grids
+            if workers > 1:
+                write_grids_pool(fp, valid, workers, inflight, nc, downloads)
+            else:
+                write_grids_serial(fp, valid, nc, downloads)
+            # 4. finalize file, the metrics cover everything but the upload
+            write_footer(fp, metrics)
+        if stream is not None:
+            count("bytes", fp.nbytes)
+        if nc is not None:
+            with instrument.stage("netcdf"):
+                nc.close()
+        # 5. save to shared drive, unless it was streamed there
+        if stream is None:
+            with instrument.stage("upload"):
+                count("bytes", os.path.getsize(fn))
+                upload_s3(fn)
+    metrics.log()
     # 6. cleanup cached gribs
     cleanup(valid)
 
 
 def main(argv):
-    if len(argv) != 5:
-        print("Usage: python fxgridder.py YYYY mm dd HH")
-        return
+    """Go Main Go"""
+    parser = argparse.ArgumentParser(description="Generate forecast grids")
+    parser.add_argument("year", type=int)
+    parser.add_argument("month", type=int)
+    parser.add_argument("day", type=int)
+    parser.add_argument("hour", type=int)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes gridding forecast hours",
+    )
+    parser.add_argument(
+        "--inflight",
+        type=int,
+        help="maximum forecast hours held in memory, default 2 x workers",
+    )
+    parser.add_argument(
+        "--stream",
+        choices=list(EXTENSIONS),
+        help="stream compressed output directly to S3",
+    )
+    parser.add_argument(
+        "--keep",
+        action="store_true",
+        help="keep a local copy of the streamed output",
+    )
+    parser.add_argument(
+        "--ncdir", help="also write a NetCDF file to this directory"
+    )
+    parser.add_argument(
+        "--dlworkers",
+        type=int,
+        default=4,
+        help="number of concurrent GRIB downloads",
+    )
+    args = parser.parse_args(argv[1:])
     valid = datetime(
-        int(argv[1]),
-        int(argv[2]),
-        int(argv[3]),
-        int(argv[4]),
-        0,
-        tzinfo=timezone.utc,
+        args.year, args.month, args.day, args.hour, 0, tzinfo=timezone.utc
+    )
+    run(
+        valid,
+        args.workers,
+        args.inflight,
+        args.stream,
+        args.keep,
+        args.ncdir,
+        args.dlworkers,
     )
-    run(valid)
 
 
 if __name__ == "__main__":
     main(sys.argv)
+
+
+def test_missing_last_hour(monkeypatch):
+    """Skipped forecast hours, the last included, leave valid JSON."""
+    import json
+    from datetime import datetime, timezone
+
+    valid = datetime(2024, 1, 1, 12, tzinfo=timezone.utc)
+    monkeypatch.setitem(globals(), "FHOURS", range(0, 12, 3))
+
+    def _grid_hour(_valid, fhour):
+        return None if fhour in (3, 9) else {}
+
+    monkeypatch.setitem(globals(), "grid_hour", _grid_hour)
+    for workers in (1, 2):
+        fp = StringIO()
+        write_header(fp, valid)
+        if workers > 1:
+            write_grids_pool(fp, valid, workers)
+        else:
+            write_grids_serial(fp, valid)
+        write_footer(fp)
+        res = json.loads(fp.getvalue())
+        assert [x["forecast_hour"] for x in res["data"]] == ["000", "006"]
@@ -0,0 +1,164 @@
+"""Selective access to GRIB2 messages through a sidecar byte offset index.
+
+The index is a small JSON file next to the GRIB file, listing the offset,
+length, name, type of level and level of each message.  It is written once,
+when the file is downloaded or archived, so later readers seek straight to
+the messages they need and only decode those.
+
+Which message supplies a field is decided by the FIELDS table: the first
+acceptable name, in table order, at the wanted level wins, and among
+duplicates the first in the file.
+"""
+
+import json
+import os
+import struct
+
+import pygrib
+from pyiem.util import logger
+
+LOG = logger()
+# field -> (acceptable names in order of preference, typeOfLevel, level)
+FIELDS = {
+    "tmpk": (("2 metre temperature",), "heightAboveGround", 2),
+    "rh": (
+        ("2 metre relative humidity", "Relative humidity"),
+        "heightAboveGround",
+        2,
+    ),
+    "uwnd": (("10 metre U wind component",), "heightAboveGround", 10),
+    "vwnd": (("10 metre V wind component",), "heightAboveGround", 10),
+    "vsby": (("Visibility",), "surface", 0),
+    "pcpn": (("Total Precipitation",), "surface", 0),
+}
+
+
+def split_messages(buf):
+    """Yield the (offset, length) of each GRIB message within buf.
+
+    Only section 0 of each message is read, for the edition and length.
+    """
+    offset = 0
+    while True:
+        offset = buf.find(b"GRIB", offset)
+        if offset < 0 or offset + 16 > len(buf):
+            return
+        edition = buf[offset + 7]
+        if edition == 2:
+            (length,) = struct.unpack(">Q", buf[offset + 8 : offset + 16])
+        else:
+            length = int.from_bytes(buf[offset + 4 : offset + 7], "big")
+        if length < 16 or offset + length > len(buf):
+            LOG.warning("Truncated GRIB message at offset %s", offset)
+            return
+        yield offset, length
+        offset += length
+
+
+def describe(msg):
+    """Return the index entry fields of this decoded GRIB message."""
+    return {
+        "name": msg.name,
+        "typeOfLevel": msg.typeOfLevel,
+        "level": int(msg.level),
+    }
+
+
+def build_index(buf):
+    """Build the index entries for the GRIB messages in buf."""
+    res = []
+    for offset, length in split_messages(buf):
+        msg = pygrib.fromstring(bytes(buf[offset : offset + length]))
+        res.append({"offset": offset, "length": length, **describe(msg)})
+    return res
+
+
+def index_name(fn):
+    """Filename of the sidecar index for this GRIB file."""
+    return f"{fn}.idx.json"
+
+
+def write_index(fn, entries):
+    """Write the sidecar index for fn."""
+    idxfn = index_name(fn)
+    tmpfn = f"{idxfn}.{os.getpid()}.tmp"
+    with open(tmpfn, "w", encoding="ascii") as fh:
+        json.dump(entries, fh)
+    os.replace(tmpfn, idxfn)
+
+
+def load_index(fn):
+    """Return the index entries for fn, building the sidecar if needed."""
+    idxfn = index_name(fn)
+    if os.path.isfile(idxfn) and os.path.getmtime(idxfn) >= os.path.getmtime(
+        fn
+    ):
+        with open(idxfn, encoding="ascii") as fh:
+            return json.load(fh)
+    with open(fn, "rb") as fh:
+        entries = build_index(fh.read())
+    try:
+        write_index(fn, entries)
+    except OSError as exp:
+        LOG.warning("Failed to write %s: %s", idxfn, exp)
+    return entries
+
+
+def select(entries, fields=None):
+    """Pick the index entry supplying each field.
+
+    Returns:
+      dict of field -> entry, omitting fields that are not present
+    """
+    fields = FIELDS if fields is None else fields
+    res = {}
+    for field, (names, level_type, level) in fields.items():
+        for name in names:
+            match = [
+                entry
+                for entry in entries
+                if entry["name"] == name
+                and entry["typeOfLevel"] == level_type
+                and entry["level"] == level
+            ]
+            if match:
+                res[field] = match[0]
+                break
+    return res
+
+
+def read_fields(fn, fields=None):
+    """Read only the messages supplying the wanted fields.
+
+    Returns:
+      dict of field -> pygrib message, omitting fields that are not present
+    """
+    wanted = select(load_index(fn), fields)
+    res = {}
+    with open(fn, "rb") as fh:
+        for field, entry in wanted.items():
+            fh.seek(entry["offset"])
+            res[field] = pygrib.fromstring(fh.read(entry["length"]))
+    return res
+
+
+def test_select():
+    """Messages are split on section 0 and fields picked by preference."""
+    msg = b"GRIB\x00\x00\x00\x02" + struct.pack(">Q", 20) + b"7777"
+    assert list(split_messages(b"xx" + msg + msg + msg[:10])) == [
+        (2, 20),
+        (22, 20),
+    ]
+    entries = [
+        {"name": "Relative humidity", "typeOfLevel": "isobaricInhPa"},
+        {"name": "Relative humidity", "typeOfLevel": "heightAboveGround"},
+        {"name": "2 metre relative humidity"},
+        {"name": "Visibility", "typeOfLevel": "surface"},
+    ]
+    for i, entry in enumerate(entries):
+        entry.setdefault("typeOfLevel", "heightAboveGround")
+        entry.update({"offset": i, "level": 2 if i < 3 else 0})
+    res = select(entries)
+    assert sorted(res) == ["rh", "vsby"]
+    assert res["rh"]["offset"] == 2
+    assert select(entries[:2])["rh"]["offset"] == 1
@@ -0,0 +1,216 @@
+"""The analysis grid definition, shared by every script.
+
+The grid is a regular lon/lat grid of 0.01 degree cells, referenced by
+their lower left corner.  Cells are numbered by gid starting at 1 in the
+lower left and running west to east along each row, then south to north.
+Rows and columns here are zero based.
+"""
+
+from functools import cached_property
+
+import numpy as np
+from pyiem import reference
+from rasterio.transform import Affine
+from serializer import gid_strings, write_records
+
+XML_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<grid>
+<title>IEM Weather Analysis Grid</title>
+<revision>%s</revision>
+<projection>EPSG:4326</projection>
+<cellreference>lowerleft</cellreference>
+<cells>
+"""
+XML_CELL = (
+    '<cell row="%s" col="%s" gid="%s"><lon>%.2f</lon><lat>%.2f</lat></cell>\n'
+)
+GEOJSON_FEATURE = (
+    '{"type": "Feature", "id": %s, "properties": {"row": %s, "col": %s}, '
+    '"geometry": {"type": "Polygon", "coordinates": [[[%.2f, %.2f], '
+    "[%.2f, %.2f], [%.2f, %.2f], [%.2f, %.2f], [%.2f, %.2f]]]}}"
+)
+
+
+class GridDefinition:
+    """A regular lon/lat grid covering west, south, east, north.
+
+    Args:
+      west (float): western edge
+      south (float): southern edge
+      east (float): eastern edge
+      north (float): northern edge
+      dx (float): cell width in degrees
+      dy (float): cell height in degrees
+    """
+
+    def __init__(self, west, south, east, north, dx=0.01, dy=0.01):
+        self.west = west
+        self.south = south
+        self.dx = dx
+        self.dy = dy
+        self.nx = int(round((east - west) / dx))
+        self.ny = int(round((north - south) / dy))
+        self.east = west + self.nx * dx
+        self.north = south + self.ny * dy
+
+    @property
+    def shape(self):
+        """(rows, columns) of the grid."""
+        return (self.ny, self.nx)
+
+    @property
+    def size(self):
+        """Number of cells."""
+        return self.ny * self.nx
+
+    @cached_property
+    def xaxis(self):
+        """Longitude of each column's lower left corner."""
+        # the stop only bounds the count, arange fixes the values
+        return np.arange(
+            self.west, self.west + (self.nx - 0.5) * self.dx, self.dx
+        )
+
+    @cached_property
+    def yaxis(self):
+        """Latitude of each row's lower left corner."""
+        return np.arange(
+            self.south, self.south + (self.ny - 0.5) * self.dy, self.dy
+        )
+
+    @cached_property
+    def xi(self):
+        """Longitude of each cell's lower left corner, (rows, columns)."""
+        return np.meshgrid(self.xaxis, self.yaxis)[0]
+
+    @cached_property
+    def yi(self):
+        """Latitude of each cell's lower left corner, (rows, columns)."""
+        return np.meshgrid(self.xaxis, self.yaxis)[1]
+
+    @cached_property
+    def transform(self):
+        """Affine transform of a north up raster over the grid.
+
+        Rasters using this start at the north edge, so are flipped in the
+        vertical relative to our grids.
+        """
+        return Affine.translation(self.west, self.north) * Affine.scale(
+            self.dx, -self.dy
+        )
+
+    def zeros(self, dtype=np.float32):
+        """Return a zero filled grid."""
+        return np.zeros(self.shape, dtype)
+
+    def rowcol_to_gid(self, rows, cols):
+        """Convert rows and columns to gids."""
+        return np.asarray(rows) * self.nx + np.asarray(cols) + 1
+
+    def gid_to_rowcol(self, gids):
+        """Convert gids to (rows, columns)."""
+        return np.divmod(np.asarray(gids) - 1, self.nx)
+
+    def rowcol_to_lonlat(self, rows, cols, center=False):
+        """Convert rows and columns to the lower left corner, or center."""
+        offset = 0.5 if center else 0.0
+        return (
+            self.west + (np.asarray(cols) + offset) * self.dx,
+            self.south + (np.asarray(rows) + offset) * self.dy,
+        )
+
+    def lonlat_to_rowcol(self, lons, lats):
+        """Find the (rows, columns) holding these points, -1 if outside."""
+        # a point on a cell corner should land in that cell, despite the
+        # floating point error in computing the corner
+        cols = np.floor((np.asarray(lons) - self.west) / self.dx + 1e-9)
+        rows = np.floor((np.asarray(lats) - self.south) / self.dy + 1e-9)
+        outside = (
+            (cols < 0) | (cols >= self.nx) | (rows < 0) | (rows >= self.ny)
+        )
+        cols = np.where(outside, -1, cols).astype(np.int64)
+        rows = np.where(outside, -1, rows).astype(np.int64)
+        return rows, cols
+
+    def lonlat_to_gid(self, lons, lats):
+        """Find the gids holding these points, 0 if outside."""
+        rows, cols = self.lonlat_to_rowcol(lons, lats)
+        return np.where(rows < 0, 0, self.rowcol_to_gid(rows, cols))
+
+    def gid_to_lonlat(self, gids, center=False):
+        """Convert gids to the lower left corner, or center, lon and lat."""
+        rows, cols = self.gid_to_rowcol(gids)
+        return self.rowcol_to_lonlat(rows, cols, center)
+
+    def _cells(self):
+        """Return the 1 based row, column and gid strings plus corners."""
+        rows, cols = np.divmod(np.arange(self.size), self.nx)
+        return (
+            rows + 1,
+            cols + 1,
+            gid_strings(self.size),
+            np.ravel(self.xi),
+            np.ravel(self.yi),
+        )
+
+    def to_xml(self, fp, revision):
+        """Write the grid definition as our XML document."""
+        fp.write(XML_HEADER % (revision,))
+        write_records(fp, XML_CELL, list(self._cells()), sep="")
+        fp.write("</cells></grid>")
+
+    def to_geojson(self, fp):
+        """Write the grid cells as a GeoJSON FeatureCollection of polygons."""
+        rows, cols, gids, lons, lats = self._cells()
+        east = lons + self.dx
+        north = lats + self.dy
+        fp.write('{"type": "FeatureCollection", "features": [\n')
+        write_records(
+            fp,
+            GEOJSON_FEATURE,
+            [gids, rows, cols]
+            + [lons, lats, east, lats, east, north, lons, north, lons, lats],
+        )
+        fp.write("\n]}\n")
+
+    def to_geoparquet(self, fn):
+        """Write the grid cells as GeoParquet polygons."""
+        import shapely
+        from geopandas import GeoDataFrame
+
+        rows, cols, _, lons, lats = self._cells()
+        GeoDataFrame(
+            {"gid": np.arange(1, self.size + 1), "row": rows, "col": cols},
+            geometry=shapely.box(lons, lats, lons + self.dx, lats + self.dy),
+            crs="EPSG:4326",
+        ).to_parquet(fn)
+
+
+GRID = GridDefinition(
+    reference.IA_WEST,
+    reference.IA_SOUTH,
+    reference.IA_EAST,
+    reference.IA_NORTH,
+)
+
+
+def test_grid():
+    """The grid matches the historical layout and conversions round trip."""
+    assert GRID.shape == (324, 660)
+    np.testing.assert_array_equal(
+        GRID.xaxis,
+        np.arange(reference.IA_WEST, reference.IA_EAST - 0.01, 0.01),
+    )
+    np.testing.assert_array_equal(
+        GRID.yaxis,
+        np.arange(reference.IA_SOUTH, reference.IA_NORTH - 0.01, 0.01),
+    )
+    gids = np.array([1, 660, 661, GRID.size])
+    rows, cols = GRID.gid_to_rowcol(gids)
+    np.testing.assert_array_equal(rows, [0, 0, 1, 323])
+    np.testing.assert_array_equal(cols, [0, 659, 0, 659])
+    lons, lats = GRID.gid_to_lonlat(gids)
+    np.testing.assert_array_equal(GRID.lonlat_to_gid(lons, lats), gids)
+    lons, lats = GRID.gid_to_lonlat(gids, center=True)
+    np.testing.assert_array_equal(GRID.lonlat_to_gid(lons, lats), gids)
+    assert GRID.lonlat_to_gid(GRID.east, GRID.south) == 0
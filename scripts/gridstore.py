@@ -0,0 +1,306 @@
+"""Point and gid queries over a store of archived analyses.
+
+The gridders optionally write each analysis into the store as one `.npy`
+file per variable, in a directory per timestep::
+
+    {storedir}/%Y/%m/%d/%H%M/{variable}.npy
+    {storedir}/%Y/%m/%d/%H%M/wawa.json
+
+The wawa bitsets are decoded with the code table saved alongside them,
+as codes outside the reserved ones get their bit at runtime.
+
+Queries memory-map these files, so only the pages holding the requested
+cells are read, rather than parsing 213,840 JSON records per timestep.
+
+A small HTTP entry point serves the same queries as JSON, from this store
+or, with --cube, from the time-series cube of cube.py:
+
+    python gridstore.py /mesonet/data/iemgrid --port 8080
+    GET /query?sts=2024-01-01T00:00&ets=2024-01-02T00:00&gid=1,2&vars=tmpc
+    GET /query?sts=...&ets=...&lon=-93.6&lat=42.0
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+import wawa
+from griddef import GRID
+from pyiem.util import logger
+
+LOG = logger()
+
+
+def timestep_dir(storedir, valid):
+    """Directory holding this timestep's grids."""
+    return os.path.join(storedir, f"{valid:%Y/%m/%d/%H%M}")
+
+
+def write_store(storedir, grids, valid, variables):
+    """Write these grids into the store, replacing any prior copy.
+
+    Args:
+      storedir (str): store root
+      grids (dict): the analysis grids
+      valid (datetime): analysis time
+      variables (list): grid labels to store
+    """
+    final = timestep_dir(storedir, valid)
+    tmpdir = f"{final}.{os.getpid()}.tmp"
+    os.makedirs(tmpdir, exist_ok=True)
+    for label in variables:
+        dtype = wawa.DTYPE if label == "wawa" else np.float32
+        np.save(
+            os.path.join(tmpdir, f"{label}.npy"),
+            np.asarray(grids[label], dtype=dtype),
+        )
+        if label == "wawa":
+            with open(os.path.join(tmpdir, "wawa.json"), "w") as fh:
+                json.dump(wawa.code_table(), fh)
+    # Readers only ever see complete timesteps
+    if os.path.isdir(final):
+        shutil.rmtree(final)
+    os.rename(tmpdir, final)
+
+
+def timesteps(storedir, sts, ets):
+    """Return the stored timesteps with sts <= valid < ets, in order."""
+    res = []
+    day = sts.replace(hour=0, minute=0, second=0, microsecond=0)
+    while day < ets:
+        daydir = os.path.join(storedir, f"{day:%Y/%m/%d}")
+        if os.path.isdir(daydir):
+            for hhmi in sorted(os.listdir(daydir)):
+                if len(hhmi) != 4 or not hhmi.isdigit():
+                    continue
+                valid = day.replace(hour=int(hhmi[:2]), minute=int(hhmi[2:]))
+                if sts <= valid < ets:
+                    res.append(valid)
+        day += timedelta(days=1)
+    return res
+
+
+def resolve_gids(gids=None, lons=None, lats=None):
+    """Return the gids for the given gids and/or points, 0 when outside."""
+    res = []
+    if gids is not None:
+        gids = np.asarray(gids, dtype=np.int64)
+        res.append(np.where((gids >= 1) & (gids <= GRID.size), gids, 0))
+    if lons is not None:
+        res.append(GRID.lonlat_to_gid(lons, lats))
+    return np.concatenate(res) if res else np.array([], dtype=np.int64)
+
+
+def read_cells(storedir, valid, label, gids):
+    """Read these cells of one stored grid, None when not stored."""
+    fn = os.path.join(timestep_dir(storedir, valid), f"{label}.npy")
+    if not os.path.isfile(fn):
+        return None
+    data = np.load(fn, mmap_mode="r").reshape(-1)
+    return data[np.maximum(gids, 1) - 1]
+
+
+def read_codes(storedir, valid):
+    """Return the wawa code table of this timestep, None if not saved."""
+    fn = os.path.join(timestep_dir(storedir, valid), "wawa.json")
+    if not os.path.isfile(fn):
+        return None
+    with open(fn) as fh:
+        return json.load(fh)
+
+
+def query(storedir, sts, ets, variables, gids=None, lons=None, lats=None):
+    """Query stored analyses for these cells and time range.
+
+    Args:
+      storedir (str): store root
+      sts (datetime): start time, inclusive
+      ets (datetime): end time, exclusive
+      variables (list): grid labels wanted
+      gids (list,optional): grid cell ids
+      lons (list,optional): point longitudes, mapped to the holding cell
+      lats (list,optional): point latitudes
+
+    Returns:
+      DataFrame with valid, gid and one column per variable, with wawa
+      as a list of VTEC codes.  Points outside the grid have gid 0 and
+      missing values.
+    """
+    cells = resolve_gids(gids, lons, lats)
+    frames = []
+    for valid in timesteps(storedir, sts, ets):
+        df = pd.DataFrame({"valid": valid, "gid": cells})
+        for label in variables:
+            vals = read_cells(storedir, valid, label, cells)
+            if vals is None:
+                df[label] = None
+                continue
+            if label == "wawa":
+                table = read_codes(storedir, valid)
+                vals = [
+                    wawa.bitset_codes(int(b), table) if gid > 0 else None
+                    for b, gid in zip(vals, cells, strict=True)
+                ]
+            else:
+                vals = np.where(cells > 0, vals, np.nan)
+            df[label] = vals
+        frames.append(df)
+    if not frames:
+        return pd.DataFrame(columns=["valid", "gid", *variables])
+    return pd.concat(frames, ignore_index=True)
+
+
+def parse_time(text):
+    """Parse a YYYY-mm-ddTHH:MI UTC timestamp."""
+    return datetime.strptime(text, "%Y-%m-%dT%H:%M").replace(
+        tzinfo=timezone.utc
+    )
+
+
+def _floats(params, key):
+    """Parse a comma separated list of floats from the query string."""
+    if key not in params:
+        return None
+    return [float(x) for x in ",".join(params[key]).split(",") if x]
+
+
+def handle_query(storedir, qs, variables, reader=None):
+    """Run the query described by this query string, returning records.
+
+    Args:
+      storedir (str): store root
+      qs (str): URL query string
+      variables (list): the variables that may be queried
+      reader (callable,optional): query() or a compatible function such as
+        cube.query(), defaults to query()
+    """
+    reader = query if reader is None else reader
+    params = parse_qs(qs)
+    wanted = ",".join(params.get("vars", [])).split(",")
+    wanted = [v for v in wanted if v] or list(variables)
+    unknown = set(wanted) - set(variables)
+    if unknown:
+        raise ValueError(f"Unknown variables: {','.join(sorted(unknown))}")
+    gids = _floats(params, "gid")
+    lons = _floats(params, "lon")
+    lats = _floats(params, "lat")
+    if (lons is None) != (lats is None) or (
+        lons is not None and len(lons) != len(lats)
+    ):
+        raise ValueError("lon and lat must be given in pairs")
+    if gids is None and lons is None:
+        raise ValueError("gid or lon/lat is required")
+    df = reader(
+        storedir,
+        parse_time(params["sts"][0]),
+        parse_time(params["ets"][0]),
+        wanted,
+        gids,
+        lons,
+        lats,
+    )
+    df["valid"] = df["valid"].map(lambda x: x.strftime("%Y-%m-%dT%H:%MZ"))
+    df = df.astype(object).where(df.notna(), None)
+    return df.to_dict(orient="records")
+
+
+def make_handler(storedir, variables, reader=None):
+    """Build the request handler class serving this store."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != "/query":
+                self.send_error(404)
+                return
+            try:
+                res = handle_query(storedir, url.query, variables, reader)
+            except (KeyError, ValueError) as exp:
+                self.send_error(400, str(exp))
+                return
+            body = json.dumps(res).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            LOG.info(fmt, *args)
+
+    return Handler
+
+
+def main(argv):
+    """Go Main Go"""
+    # imported here, as both import this module
+    from i5gridder import DOMAIN
+
+    parser = argparse.ArgumentParser(description="Serve grid store queries")
+    parser.add_argument("storedir")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--cube",
+        action="store_true",
+        help="storedir is a time-series cube written with --cubedir",
+    )
+    args = parser.parse_args(argv[1:])
+    reader = None
+    if args.cube:
+        from cube import query as reader
+    server = ThreadingHTTPServer(
+        (args.host, args.port),
+        make_handler(args.storedir, list(DOMAIN), reader),
+    )
+    LOG.info("Serving %s on %s:%s", args.storedir, args.host, args.port)
+    server.serve_forever()
+
+
+def test_query(tmp_path):
+    """Stored grids are read back by gid and by point."""
+    valid = datetime(2024, 1, 1, 12, tzinfo=timezone.utc)
+    tmpc = np.arange(GRID.size, dtype=np.float32).reshape(GRID.shape)
+    grids = {"tmpc": tmpc, "wawa": GRID.zeros(wawa.DTYPE)}
+    grids["wawa"][0, 1] = wawa.code_bit("TO.W")
+    write_store(str(tmp_path), grids, valid, ["tmpc", "wawa"])
+    write_store(
+        str(tmp_path), grids, valid + timedelta(hours=1), ["tmpc", "wawa"]
+    )
+    lons, lats = GRID.gid_to_lonlat([661], center=True)
+    df = query(
+        str(tmp_path),
+        valid,
+        valid + timedelta(minutes=5),
+        ["tmpc", "wawa"],
+        gids=[1, 2],
+        lons=lons,
+        lats=lats,
+    )
+    assert df["gid"].tolist() == [1, 2, 661]
+    assert df["tmpc"].tolist() == [0, 1, 660]
+    assert df["wawa"].tolist() == [[], ["TO.W"], []]
+    # decoded with the table saved by the writer, not the reader's
+    fn = os.path.join(timestep_dir(str(tmp_path), valid), "wawa.json")
+    with open(fn, "w") as fh:
+        json.dump(["XX.W"] * len(wawa.BITS), fh)
+    ets = valid + timedelta(minutes=5)
+    df = query(str(tmp_path), valid, ets, ["wawa"], gids=[2])
+    assert df["wawa"].tolist() == [["XX.W"]]
+    qs = "sts=2024-01-01T00:00&ets=2024-01-02T00:00&gid=5&lon=0&lat=0"
+    res = handle_query(str(tmp_path), qs, ["tmpc", "wawa"])
+    assert [r["valid"] for r in res] == ["2024-01-01T12:00Z"] * 2 + [
+        "2024-01-01T13:00Z"
+    ] * 2
+    assert res[1]["gid"] == 0 and res[1]["tmpc"] is None
+
+
+if __name__ == "__main__":
+    main(sys.argv)
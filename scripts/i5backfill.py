@@ -0,0 +1,214 @@
+"""Run i5gridder over a range of timestamps, for backfilling the archive.
+
+Timesteps are grouped into chunks of consecutive times that are spread
+over a process pool, with each chunk's archive observations prefetched by
+one query per source.  The workers live for the whole backfill, so imports,
+regrid indices and other caches stay warm.  Completed timesteps are
+appended to a checkpoint file, so an interrupted backfill can be resumed
+by running the same command again.
+
+Usage: python i5backfill.py 2024-01-01T00:00 2024-02-01T00:00 --workers 8
+"""
+
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+
+import cube
+import i5gridder
+import obsprefetch
+from pyiem.util import logger
+
+LOG = logger()
+
+
+def parse_time(text):
+    """Parse a YYYY-mm-ddTHH:MI UTC timestamp."""
+    return datetime.strptime(text, "%Y-%m-%dT%H:%M").replace(
+        tzinfo=timezone.utc
+    )
+
+
+def timesteps(sts, ets, interval):
+    """Return the timesteps from sts up to, but not including, ets."""
+    res = []
+    now = sts
+    while now < ets:
+        res.append(now)
+        now += timedelta(minutes=interval)
+    return res
+
+
+def read_checkpoint(fn):
+    """Return the set of timesteps already completed."""
+    if fn is None or not os.path.isfile(fn):
+        return set()
+    with open(fn, encoding="ascii") as fh:
+        return {parse_time(line.strip()) for line in fh if line.strip()}
+
+
+def plan(valids, done, chunksize):
+    """Group the remaining timesteps into chunks of consecutive times."""
+    todo = [valid for valid in valids if valid not in done]
+    return [todo[i : i + chunksize] for i in range(0, len(todo), chunksize)]
+
+
+def process_chunk(valids, runargs, prefetch=True, cachedir=None):
+    """Run this chunk of timesteps within a worker process.
+
+    Returns:
+      list of (valid, failed stage names)
+    """
+    results = []
+    if prefetch:
+        try:
+            obsprefetch.prefetch_all(valids[0], valids[-1], cachedir)
+        except Exception as exp:
+            # the per timestep queries are used instead
+            LOG.warning("Prefetch failed: %s", exp)
+    for valid in valids:
+        try:
+            failures = i5gridder.run(valid, **runargs)
+        except Exception as exp:
+            LOG.exception(exp)
+            failures = {"run": exp}
+        results.append((valid, sorted(failures)))
+    obsprefetch.clear()
+    return results
+
+
+def backfill(
+    chunks, workers, runargs, checkpoint=None, prefetch=True, cachedir=None
+):
+    """Process the chunks, recording completed timesteps in checkpoint.
+
+    Returns:
+      list of (valid, failed stage names) for timesteps that failed
+    """
+    failed = []
+    ckfh = None if checkpoint is None else open(checkpoint, "a")
+    total = sum(len(chunk) for chunk in chunks)
+    completed = 0
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                pool.submit(process_chunk, chunk, runargs, prefetch, cachedir)
+                for chunk in chunks
+            ]
+            for future in as_completed(futures):
+                for valid, stages in future.result():
+                    completed += 1
+                    if stages:
+                        failed.append((valid, stages))
+                        continue
+                    if ckfh is not None:
+                        ckfh.write(f"{valid:%Y-%m-%dT%H:%M}\n")
+                        ckfh.flush()
+                LOG.info("%s/%s timesteps processed", completed, total)
+    finally:
+        if ckfh is not None:
+            ckfh.close()
+    return failed
+
+
+def main(argv):
+    """Go Main Go"""
+    parser = argparse.ArgumentParser(description="Backfill i5gridder")
+    parser.add_argument("start", type=parse_time, help="YYYY-mm-ddTHH:MI")
+    parser.add_argument(
+        "end", type=parse_time, help="YYYY-mm-ddTHH:MI, exclusive"
+    )
+    parser.add_argument(
+        "--interval", type=int, default=5, help="minutes between analyses"
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=288,
+        help="consecutive timesteps handed to a worker at once",
+    )
+    parser.add_argument(
+        "--no-prefetch",
+        action="store_true",
+        help="query observations per timestep instead of per chunk",
+    )
+    parser.add_argument(
+        "--obscache", help="directory to cache prefetched obs as Parquet"
+    )
+    parser.add_argument(
+        "--checkpoint", help="file recording completed timesteps"
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only print the plan"
+    )
+    parser.add_argument(
+        "--stage-workers",
+        type=int,
+        default=1,
+        help="threads running the source stages of each timestep",
+    )
+    parser.add_argument("--stream", choices=["gzip", "zstd"])
+    parser.add_argument("--keep", action="store_true")
+    parser.add_argument("--ncdir")
+    parser.add_argument("--storedir")
+    parser.add_argument("--cubedir")
+    args = parser.parse_args(argv[1:])
+    if args.cubedir is not None and (
+        args.interval % cube.INTERVAL or not cube.on_cadence(args.start)
+    ):
+        parser.error(
+            f"--cubedir needs --interval and start on {cube.INTERVAL} minute "
+            "multiples"
+        )
+    valids = timesteps(args.start, args.end, args.interval)
+    done = read_checkpoint(args.checkpoint)
+    chunks = plan(valids, done, args.chunksize)
+    todo = sum(len(chunk) for chunk in chunks)
+    print(
+        f"{len(valids)} timesteps, {len(valids) - todo} already done, "
+        f"{todo} in {len(chunks)} chunks over {args.workers} workers"
+    )
+    if args.dry_run:
+        for chunk in chunks:
+            print(f"{chunk[0]:%Y-%m-%dT%H:%M} -> {chunk[-1]:%Y-%m-%dT%H:%M}")
+        return
+    runargs = {
+        "stream": args.stream,
+        "keep": args.keep,
+        "ncdir": args.ncdir,
+        "workers": args.stage_workers,
+        "storedir": args.storedir,
+        "cubedir": args.cubedir,
+    }
+    failed = backfill(
+        chunks,
+        args.workers,
+        runargs,
+        args.checkpoint,
+        not args.no_prefetch,
+        args.obscache,
+    )
+    for valid, stages in failed:
+        print(f"{valid:%Y-%m-%dT%H:%M} failed: {','.join(stages)}")
+
+
+def test_failed_upload(tmp_path, monkeypatch):
+    """A timestep whose upload failed is not checkpointed."""
+    monkeypatch.setattr(i5gridder, "run_stages", lambda *args: {})
+    monkeypatch.setattr(i5gridder, "upload_s3", lambda fn: False)
+    valid = datetime(2024, 1, 1, 12, tzinfo=timezone.utc)
+    ckfn = str(tmp_path / "done.txt")
+    failed = backfill([[valid]], 1, {}, ckfn, prefetch=False)
+    assert failed == [(valid, ["upload"])]
+    assert read_checkpoint(ckfn) == set()
+    # the retry uploads, removing the file, so the timestep is done
+    monkeypatch.setattr(i5gridder, "upload_s3", lambda fn: True)
+    assert backfill([[valid]], 1, {}, ckfn, prefetch=False) == []
+    assert read_checkpoint(ckfn) == {valid}
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,264 @@
+"""Run the realtime analyses from one resident process.
+
+Rather than starting a fresh i5gridder process every cycle, paying for the
+imports, a new S3 session, new database connections and cold caches each
+time, the daemon wakes on the cadence and calls i5gridder.run() in
+process, keeping all of these warm.
+
+ - cycles run one at a time, so a slow cycle never overlaps the next
+ - cycles that came due while one was running, for instance after a
+   slow database or the host sleeping, are caught up oldest first, up to
+   --catchup of them
+ - an exclusive lock on --lockfile keeps a second daemon from starting
+ - SIGTERM and SIGINT let the running cycle finish, then exit
+ - --plans bounds the station plans, the bulk of the memory held between
+   cycles
+
+Usage: python i5daemon.py --interval 5 --delay 2 --stream gzip
+"""
+
+import argparse
+import fcntl
+import signal
+import sys
+import threading
+from datetime import datetime, timedelta, timezone
+
+import cube
+import dbpool
+import i5gridder
+import regrid
+from pyiem.util import logger
+from s3sink import EXTENSIONS, get_s3_client
+
+LOG = logger()
+
+
+def latest_cycle(now, interval, delay):
+    """Return the latest analysis time due at now."""
+    ready = now - timedelta(minutes=delay)
+    return ready.replace(
+        minute=ready.minute - ready.minute % interval, second=0, microsecond=0
+    )
+
+
+def due_cycles(last, now, interval, delay, catchup):
+    """Return the analysis times to run, oldest first.
+
+    Args:
+      last (datetime): the last analysis time run, None at startup
+      now (datetime): current time
+      interval (int): minutes between analyses
+      delay (int): minutes after an analysis time before it is run, for the
+        observations to arrive
+      catchup (int): most missed analyses run, besides the latest
+
+    Returns:
+      list of datetime
+    """
+    latest = latest_cycle(now, interval, delay)
+    if last is None:
+        return [latest]
+    res = []
+    valid = latest
+    while valid > last and len(res) <= catchup:
+        res.insert(0, valid)
+        valid -= timedelta(minutes=interval)
+    if valid > last:
+        LOG.warning("Skipping missed cycles %s through %s", last, valid)
+    return res
+
+
+def seconds_until(valid, now, interval, delay):
+    """Seconds from now until the cycle after valid is due."""
+    due = valid + timedelta(minutes=interval + delay)
+    return max((due - now).total_seconds(), 0)
+
+
+class Daemon:
+    """Schedule i5gridder.run() on a cadence until stopped.
+
+    Args:
+      interval (int): minutes between analyses
+      delay (int): minutes after an analysis time before it is run
+      catchup (int): most missed analyses run, besides the latest
+      runargs (dict): keyword arguments passed to i5gridder.run()
+    """
+
+    def __init__(self, interval=5, delay=2, catchup=3, runargs=None):
+        self.interval = interval
+        self.delay = delay
+        self.catchup = catchup
+        self.runargs = {} if runargs is None else runargs
+        self.stopping = threading.Event()
+        self.last = None
+
+    def stop(self, signum=None, _frame=None):
+        """Finish the running cycle, if any, then exit."""
+        LOG.warning("Stopping after the current cycle (signal %s)", signum)
+        self.stopping.set()
+
+    def warm(self):
+        """Create the S3 client up front, rather than in the first cycle."""
+        try:
+            get_s3_client()
+        except Exception as exp:
+            LOG.warning("Failed to create the S3 client: %s", exp)
+
+    def run_cycle(self, valid):
+        """Run one analysis, a failure only costs this cycle."""
+        try:
+            failures = i5gridder.run(valid, **self.runargs)
+        except Exception as exp:
+            LOG.exception(exp)
+            failures = {"run": exp}
+        if failures:
+            LOG.warning("%s failed stages: %s", valid, ",".join(failures))
+        self.last = valid
+
+    def loop(self, now=None):
+        """Run the due cycles, then sleep until the next, until stopped.
+
+        Args:
+          now (callable,optional): returns the current UTC time
+        """
+        now = (lambda: datetime.now(timezone.utc)) if now is None else now
+        while not self.stopping.is_set():
+            for valid in due_cycles(
+                self.last, now(), self.interval, self.delay, self.catchup
+            ):
+                if self.stopping.is_set():
+                    break
+                self.run_cycle(valid)
+            if self.last is not None:
+                self.stopping.wait(
+                    seconds_until(self.last, now(), self.interval, self.delay)
+                )
+
+
+def main(argv):
+    """Go Main Go"""
+    parser = argparse.ArgumentParser(description="Realtime analysis daemon")
+    parser.add_argument(
+        "--interval", type=int, default=5, help="minutes between analyses"
+    )
+    parser.add_argument(
+        "--delay",
+        type=int,
+        default=2,
+        help="minutes after the analysis time to wait for observations",
+    )
+    parser.add_argument(
+        "--catchup",
+        type=int,
+        default=3,
+        help="most missed analyses caught up, older ones are skipped",
+    )
+    parser.add_argument(
+        "--lockfile",
+        default="/tmp/i5daemon.lock",
+        help="held while running, so only one daemon runs",
+    )
+    parser.add_argument(
+        "--plans",
+        type=int,
+        default=regrid._PLANS_SIZE,
+        help="station plans kept between cycles, default IEMGRID_PLANS or 16",
+    )
+    parser.add_argument(
+        "--stream",
+        choices=list(EXTENSIONS),
+        help="stream compressed output directly to S3",
+    )
+    parser.add_argument(
+        "--keep",
+        action="store_true",
+        help="keep a local copy of the streamed output",
+    )
+    parser.add_argument(
+        "--ncdir", help="also write a NetCDF file to this directory"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of threads running the source stages",
+    )
+    parser.add_argument(
+        "--storedir", help="also write the grids to this query store"
+    )
+    parser.add_argument(
+        "--cubedir", help="also append the grids to this time-series cube"
+    )
+    args = parser.parse_args(argv[1:])
+    if 60 % args.interval != 0:
+        parser.error("--interval must divide the hour")
+    if args.cubedir is not None and args.interval % cube.INTERVAL:
+        parser.error(
+            f"--cubedir needs an --interval multiple of {cube.INTERVAL}"
+        )
+    regrid._PLANS_SIZE = args.plans
+    daemon = Daemon(
+        args.interval,
+        args.delay,
+        args.catchup,
+        {
+            "stream": args.stream,
+            "keep": args.keep,
+            "ncdir": args.ncdir,
+            "workers": args.workers,
+            "storedir": args.storedir,
+            "cubedir": args.cubedir,
+        },
+    )
+    with open(args.lockfile, "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            LOG.error("Another daemon holds %s", args.lockfile)
+            return 1
+        signal.signal(signal.SIGTERM, daemon.stop)
+        signal.signal(signal.SIGINT, daemon.stop)
+        daemon.warm()
+        try:
+            daemon.loop()
+        finally:
+            dbpool.dispose()
+    return 0
+
+
+def test_due_cycles():
+    """Missed cycles are caught up, up to a limit."""
+    now = datetime(2024, 1, 1, 12, 13, 30, tzinfo=timezone.utc)
+    assert due_cycles(None, now, 5, 2, 3) == [now.replace(minute=10, second=0)]
+    last = now.replace(minute=0, second=0)
+    assert [v.minute for v in due_cycles(last, now, 5, 2, 3)] == [5, 10]
+    assert [v.minute for v in due_cycles(last, now, 5, 2, 0)] == [10]
+    valid = now.replace(minute=10, second=0)
+    assert due_cycles(valid, now, 5, 2, 3) == []
+    assert seconds_until(valid, now, 5, 2) == 210
+
+
+def test_loop():
+    """The daemon runs each cycle once and stops when asked."""
+    daemon = Daemon(5, 2, 3)
+    clock = [datetime(2024, 1, 1, 12, 13, tzinfo=timezone.utc)]
+    runs = []
+
+    def _run(valid):
+        runs.append(valid)
+        daemon.last = valid
+
+    def _wait(seconds):
+        clock[0] += timedelta(seconds=seconds)
+        if len(runs) >= 3:
+            daemon.stopping.set()
+
+    daemon.run_cycle = _run
+    daemon.stopping.wait = _wait
+    daemon.loop(lambda: clock[0])
+    assert [v.minute for v in runs] == [10, 15, 20]
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
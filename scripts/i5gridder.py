@@ -12,160 +12,158 @@
 [o] "pcpn"     Precipitation
 """
 
-import gzip
+import argparse
 import os
 import socket
 import sys
-import tempfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime, timedelta, timezone
 
-import boto3
+import cube
+import instrument
 import numpy as np
+import objan
 import pandas as pd
 import pygrib
-import pyiem.mrms as mrms_util
-from geopandas import GeoDataFrame
-from pyiem import meteorology, reference
-from pyiem.database import get_sqlalchemy_conn, sql_helper
+import ugcindex
+import wawa
+from dbpool import get_sqlalchemy_conn
+from griddef import GRID
+from gridstore import write_store
+from instrument import count
+from mrmsreader import read_window
+from ncwriter import write_analysis_nc
+from obsprefetch import archive_obs
+from pyiem import meteorology
+from pyiem.database import sql_helper
 from pyiem.datatypes import direction, distance, speed, temperature
-from pyiem.network import Table as NetworkTable
 from pyiem.reference import ISO8601
 from pyiem.util import logger
-from rasterio import features
-from rasterio.transform import Affine
-from scipy.interpolate import NearestNDInterpolator
+from regrid import get_index, get_plan, regrid
+from resultcache import CACHEDIR as RESULTCACHEDIR
+from resultcache import ResultCache
+from s3sink import BUCKET, EXTENSIONS, S3Sink, get_s3_client
+from serializer import write_analysis
+from stationmeta import attach_latlon
 
 LOG = logger()
-XAXIS = np.arange(reference.IA_WEST, reference.IA_EAST - 0.01, 0.01)
-YAXIS = np.arange(reference.IA_SOUTH, reference.IA_NORTH - 0.01, 0.01)
-XI, YI = np.meshgrid(XAXIS, YAXIS)
+XAXIS = GRID.xaxis
+YAXIS = GRID.yaxis
+XI, YI = GRID.xi, GRID.yi
 PROGRAM_VERSION = 0.8
 DOMAIN = {
     "wawa": {"units": "1", "format": "%s"},
     "ptype": {"units": "1", "format": "%i"},
-    "tmpc": {"units": "C", "format": "%.2f"},
-    "dwpc": {"units": "C", "format": "%.2f"},
-    "smps": {"units": "mps", "format": "%.1f"},
-    "drct": {"units": "deg", "format": "%i"},
-    "vsby": {"units": "km", "format": "%.3f"},
-    "roadtmpc": {"units": "C", "format": "%.2f"},
-    "srad": {"units": "Wm*{-2}", "format": "%.2f"},
-    "snwd": {"units": "mm", "format": "%.2f"},
+    "tmpc": {"units": "C", "format": "%.2f", "engine": "nearest"},
+    "dwpc": {"units": "C", "format": "%.2f", "engine": "nearest"},
+    "smps": {"units": "mps", "format": "%.1f", "engine": "nearest"},
+    "drct": {"units": "deg", "format": "%i", "engine": "nearest"},
+    "vsby": {"units": "km", "format": "%.3f", "engine": "nearest"},
+    "roadtmpc": {"units": "C", "format": "%.2f", "engine": "nearest"},
+    "srad": {"units": "Wm*{-2}", "format": "%.2f", "engine": "nearest"},
+    "snwd": {"units": "mm", "format": "%.2f", "engine": "nearest"},
     "pcpn": {"units": "mm", "format": "%.2f"},
 }
-# This is not used at the moment
-WWA_CODES = {
-    "AS.Y": 5,  # Air Stagnation Advisory
-    "EH.A": 6,  # Excessive Heat Watch
-    "EC.W": 50,  # Extreme Cold Warning
-    "FA.A": 51,  # Areal Flood Watch
-    "EH.W": 52,  # Excessive Heat Warning
-    "XH.W": 52,  # Excessive Heat Warning
-    "HT.Y": 53,  # Heat Advisory
-    "FZ.W": 54,  # Freeze Warning
-    "FR.Y": 55,  # Freeze Advisory
-    "FW.A": 56,  # Fire Weather Watch
-    "FW.W": 57,  # Fire Weather Warning
-    "FZ.A": 58,  # Freeze Watch
-    "HZ.W": 129,  # Hard Freeze Warning
-    "WS.A": 130,  # Winter Storm Watch
-    "BZ.A": 140,  # Blizzard Watch
-    "SV.A": 145,  # Severe Thunderstorm Watch
-    "TO.A": 146,  # Tornado Watch
-    "FL.A": 147,  # Flood Watch
-    "FL.S": 148,  # Flood Statement
-    "WC.A": 149,  # Wind Chill Watch
-    "FL.Y": 150,  # Flood Advisory
-    "HW.A": 167,  # High Wind Watch
-    "WC.W": 168,  # Wind Chill Warning
-    "FL.W": 169,  # Flood Warning
-    "BS.Y": 170,  # Blowing Snow Advisory
-    "WI.Y": 171,  # Wind Advisory
-    "WC.Y": 172,  # Wind Chill Advisory
-    "FA.W": 173,  # Areal Flood Warning
-    "FA.Y": 174,  # Areal Flood Advisory
-    "FF.A": 175,  # Flas Flood Advisory
-    "FF.W": 176,  # Flash Flood Warning
-    "FG.Y": 177,  # Fog Advisory
-    "HW.W": 224,  # High Wind Warning
-    "SN.Y": 225,  # Snow Advisory
-    "SB.Y": 226,  # Snow and Blowing Snow Advisory
-    "WW.Y": 227,  # Winter Weather Advisory
-    "SV.W": 228,  # Severe Thunderstorm Warning
-    "HS.W": 229,  # Heavy Snow Warning
-    "WS.W": 230,  # Winter Storm Warning
-    "ZF.Y": 231,  # Freezing Fog Advisory
-    "ZR.Y": 232,  # Freezing Rain Advisory
-    "BZ.W": 240,  # Blizzard Warning
-    "TO.W": 241,  # Tornado Warning
-    "IS.W": 242,  # Ice Storm Warning
-}
+
+RWIS_NETWORKS = [
+    "IA_RWIS",
+    "MN_RWIS",
+    "WI_RWIS",
+    "IL_RWIS",
+    "MO_RWIS",
+    "KS_RWIS",
+    "NE_RWIS",
+    "SD_RWIS",
+]
+WWA_WFOS = "('FSD', 'ARX', 'DVN', 'DMX', 'EAX', 'OAX', 'MPX')"
+# Seconds cached grids stay fresh for an unchanged fingerprint, so late
+# reports or edited UGC geometries are still picked up
+RESULT_TTL = {"wwa": 6 * 3600, "snowd": 3600, "srad": 3600}
+RESULTS = ResultCache(cachedir=RESULTCACHEDIR)
+# MRMS PrecipFlag is available from this time
+PTYPE_FLOOR = datetime(2016, 1, 21, tzinfo=timezone.utc)
+
+
+class NoDataError(Exception):
+    """Raised when a source stage lacks the data to produce its grids."""
 
 
 def upload_s3(fn):
     """Send file to S3 bucket."""
-    session = boto3.Session(profile_name="ntrans")
-    s3 = session.client("s3")
+    s3 = get_s3_client()
     sname = fn.split("/")[-1]
     LOG.info("Uploading %s to S3 as %s", fn, sname)
     try:
         # Does not return any metadata :/
-        s3.upload_file(fn, "intrans-weather-feed", sname)
+        s3.upload_file(fn, BUCKET, sname)
         return True
     except Exception as exp:
         LOG.error(exp)
     return False
 
 
-def write_grids(grids, valid, iarchive):
-    """Do the write to disk"""
-    fn = f"/tmp/wx_{valid:%Y%m%d%H%M}.json"
-    with open(fn, "w") as out:
-        out.write(
-            """{"time": "%s",
+def write_document(out, grids, valid, metrics=None):
+    """Write the analysis JSON document.
+
+    Args:
+      out (file): file object to write to
+      grids (dict): the analysis grids
+      valid (datetime): analysis time
+      metrics (instrument.Metrics,optional): written into the header, so
+        covering the stages run before writing
+    """
+    out.write(
+        """{"time": "%s",
         "type": "analysis",
         "revision": "%s",
         "hostname": "%s",
-        "data": [
+        %s"data": [
         """
-            % (
-                valid.strftime(ISO8601),
-                PROGRAM_VERSION,
-                socket.gethostname(),
-            )
+        % (
+            valid.strftime(ISO8601),
+            PROGRAM_VERSION,
+            socket.gethostname(),
+            "" if metrics is None else f'"metrics": {metrics.to_json()},\n',
         )
-        fmt = (
-            '{"gid": %s, "tmpc": %.2f, "wawa": %s, "ptype": %i, "dwpc": %.2f, '
-            '"smps": %.1f, "drct": %i, "vsby": %.3f, "roadtmpc": %.2f,'
-            '"srad": %.2f, "snwd": %.2f, "pcpn": %.2f}'
-        )
-        i = 1
-        ar = []
-        for row in range(len(YAXIS)):
-            for col in range(len(XAXIS)):
-                a = grids["wawa"][row, col][:-1]
-                ar.append(
-                    fmt
-                    % (
-                        i,
-                        grids["tmpc"][row, col],
-                        repr(a.split(",")).replace("'", '"'),
-                        grids["ptype"][row, col],
-                        grids["dwpc"][row, col],
-                        grids["smps"][row, col],
-                        grids["drct"][row, col],
-                        grids["vsby"][row, col],
-                        grids["roadtmpc"][row, col],
-                        grids["srad"][row, col],
-                        grids["snwd"][row, col],
-                        grids["pcpn"][row, col],
-                    )
-                )
-                i += 1
-        out.write(",\n".join(ar))
-        out.write("]}\n")
-    if upload_s3(fn):
+    )
+    write_analysis(out, grids)
+    out.write("]}\n")
+
+
+def write_grids(grids, valid, iarchive, stream=None, keep=False, metrics=None):
+    """Do the write to disk and upload, or stream compressed to S3.
+
+    Args:
+      grids (dict): the analysis grids
+      valid (datetime): analysis time
+      iarchive (bool): is this an archive analysis
+      stream (str,optional): `gzip` or `zstd` to stream compressed output
+        directly to S3 instead of writing and uploading a file
+      keep (bool,optional): keep a local copy of the streamed output
+      metrics (instrument.Metrics,optional): written into the header, the
+        serialize and upload stages are recorded into the active Metrics
+
+
+    Returns:
+      bool whether the output reached S3
+    """
+    fn = f"/tmp/wx_{valid:%Y%m%d%H%M}.json"
+    if stream is not None:
+        localfn = f"{fn}{EXTENSIONS[stream]}" if keep else None
+        with instrument.stage("stream"):
+            with S3Sink(os.path.basename(fn), stream, localfn=localfn) as out:
+                write_document(out, grids, valid, metrics)
+            count("bytes", out.nbytes)
+        return True
+    with instrument.stage("serialize"):
+        with open(fn, "w") as out:
+            write_document(out, grids, valid, metrics)
+        count("bytes", os.path.getsize(fn))
+    with instrument.stage("upload"):
+        if not upload_s3(fn):
+            return False
         os.unlink(fn)
+    return True
 
 
 def init_grids():
@@ -173,61 +171,86 @@ def init_grids():
     grids = {}
     for label in DOMAIN:
         if label == "wawa":
-            grids[label] = np.empty([324, 660], dtype="<U25")
+            grids[label] = GRID.zeros(wawa.DTYPE)
         else:
-            grids[label] = np.zeros((324, 660), np.float32)
+            grids[label] = GRID.zeros()
 
     return grids
 
 
-def transform_from_corner(ulx, uly, dx, dy):
-    return Affine.translation(ulx, uly) * Affine.scale(dx, -dy)
+def grid_stations(plan, columns):
+    """Analyze station values with the engine DOMAIN sets for each grid.
+
+    Variables sharing an engine are analyzed together as one stack.
+
+    Args:
+      plan (regrid.StationPlan): station to grid neighbour plan
+      columns (dict): grid label -> station values
+
+    Returns:
+      dict of grid label -> analysis grid
+    """
+    byengine = {}
+    for label, vals in columns.items():
+        byengine.setdefault(DOMAIN[label]["engine"], {})[label] = vals
+    res = {}
+    for engine, stack in byengine.items():
+        out = objan.analyze(
+            plan, np.column_stack(list(stack.values())), engine
+        )
+        res.update(zip(stack.keys(), out, strict=True))
+    return res
 
 
 def wwa(grids, valid, _iarchive):
-    """An attempt at rasterizing the WWA"""
-    table = "warnings_%s" % (valid.year,)
+    """Gather the WWA from the ugc index, unless the warnings are unchanged"""
     with get_sqlalchemy_conn("postgis") as conn:
-        df = GeoDataFrame.from_postgis(
+        active = pd.read_sql(
             sql_helper(
                 """
-        SELECT geom as geom, phenomena ||'.'|| significance as code, w.ugc from
-        {table} w JOIN ugcs u on (w.gid = u.gid) WHERE
-        issue <= :valid and expire > :valid
-        and w.wfo in ('FSD', 'ARX', 'DVN', 'DMX', 'EAX', 'FSD', 'OAX', 'MPX')
+        SELECT phenomena ||'.'|| significance as code, w.gid from {table} w
+        WHERE issue <= :valid and expire > :valid and w.wfo in {wfos}
         """,
-                table=table,
+                table=f"warnings_{valid.year}",
+                wfos=WWA_WFOS,
             ),
             conn,
             params={"valid": valid},
             index_col=None,
         )
-    transform = transform_from_corner(
-        reference.IA_WEST, reference.IA_NORTH, 0.01, 0.01
-    )
-    df["i"] = 1
-    for vtec in df["code"].unique():
-        df2 = df[df["code"] == vtec]
-        shapes = (
-            (geom, value)
-            for geom, value in zip(df2.geometry, df2.i, strict=False)
-        )
-        stradd = f"{vtec},"
-        arr = features.rasterize(
-            shapes=shapes,
-            fill=0,
-            transform=transform,
-            out_shape=grids["wawa"].shape,
+        count("rows", len(active.index))
+        fingerprint = sorted(zip(active["code"], active["gid"], strict=True))
+        grids.update(
+            RESULTS.cached(
+                "wwa",
+                fingerprint,
+                RESULT_TTL["wwa"],
+                lambda: wwa_grid(conn, active),
+                # runtime assigned wawa bits differ between processes
+                persist=False,
+            )
         )
-        shp = grids["wawa"].shape
-        for i in range(shp[0]):
-            for j in range(shp[1]):
-                if arr[i, j] > 0:
-                    grids["wawa"][i, j] = grids["wawa"][i, j] + stradd
+
+
+def wwa_grid(conn, active):
+    """Set each warning's code over the cells of its UGC"""
+    index = ugcindex.get_index(conn)
+    return {"wawa": ugcindex.rasterize(index, active["code"], active["gid"])}
 
 
 def snowd(grids, valid, iarchive):
-    """Do the snowdepth grid"""
+    """Do the snowdepth grid, which only changes with the date"""
+    days = (valid.date(), (valid - timedelta(days=1)).date())
+    fingerprint = (days, DOMAIN["snwd"]["engine"])
+    grids.update(
+        RESULTS.cached(
+            "snowd", fingerprint, RESULT_TTL["snowd"], lambda: snowd_grid(days)
+        )
+    )
+
+
+def snowd_grid(days):
+    """Grid the COOP snow depth reports of these two dates"""
     with get_sqlalchemy_conn("iem") as conn:
         df = pd.read_sql(
             sql_helper("""
@@ -240,55 +263,21 @@ def snowd(grids, valid, iarchive):
             and snowd < 100 GROUP by lon, lat
             """),
             conn,
-            params={
-                "dt1": valid.date(),
-                "dt2": (valid - timedelta(days=1)).date(),
-            },
+            params={"dt1": days[0], "dt2": days[1]},
             index_col=None,
         )
 
-    nn = NearestNDInterpolator(
-        (df["lon"].values, df["lat"].values),
-        distance(df["snow"].values, "IN").value("MM"),
+    count("rows", len(df.index))
+    plan = get_plan(df["lon"].values, df["lat"].values, XI, YI)
+    return grid_stations(
+        plan, {"snwd": distance(df["snow"].values, "IN").value("MM")}
     )
-    grids["snwd"] = nn(XI, YI)
 
 
 def roadtmpc(grids, valid, iarchive):
     """Do the RWIS Road times grid"""
     if iarchive:
-        nt = NetworkTable(
-            [
-                "IA_RWIS",
-                "MN_RWIS",
-                "WI_RWIS",
-                "IL_RWIS",
-                "MO_RWIS",
-                "KS_RWIS",
-                "NE_RWIS",
-                "SD_RWIS",
-            ]
-        )
-        with get_sqlalchemy_conn("rwis") as conn:
-            df = pd.read_sql(
-                sql_helper("""
-                SELECT station, tfs0 as tsf0
-                from alldata WHERE valid >= :sts and valid < :ets and
-                tfs0 >= -50 and tfs0 < 150
-                """),
-                conn,
-                params={
-                    "sts": (valid - timedelta(minutes=30)),
-                    "ets": (valid + timedelta(minutes=30)),
-                },
-                index_col=None,
-            )
-        df["lat"] = df["station"].apply(
-            lambda x: nt.sts.get(x, {}).get("lat", 0)
-        )
-        df["lon"] = df["station"].apply(
-            lambda x: nt.sts.get(x, {}).get("lon", 0)
-        )
+        df = attach_latlon(archive_obs("rwis", valid), RWIS_NETWORKS)
     else:
         with get_sqlalchemy_conn("iem") as conn:
             df = pd.read_sql(
@@ -305,57 +294,50 @@ def roadtmpc(grids, valid, iarchive):
                 index_col=None,
             )
 
-    nn = NearestNDInterpolator(
-        (df["lon"].values, df["lat"].values),
-        temperature(df["tsf0"].values, "F").value("C"),
+    count("rows", len(df.index))
+    plan = get_plan(df["lon"].values, df["lat"].values, XI, YI)
+    grids.update(
+        grid_stations(
+            plan,
+            {"roadtmpc": temperature(df["tsf0"].values, "F").value("C")},
+        )
     )
-    grids["roadtmpc"] = nn(XI, YI)
 
 
 def srad(grids, valid, iarchive):
-    """Solar Radiation (W m**-2)"""
+    """Solar Radiation (W m**-2), only regridded for new hourly obs"""
+    if iarchive:
+        grids.update(srad_grid(valid, iarchive))
+        return
+    with get_sqlalchemy_conn("iem") as conn:
+        res = conn.execute(
+            sql_helper("""
+            SELECT date_trunc('hour', max(c.valid)) as latest
+            from current c JOIN stations t on (c.iemid = t.iemid)
+            WHERE c.valid > now() - '2 hours'::interval and
+            t.network in ('ISUSM')
+            """)
+        )
+        latest = res.scalar()
+    fingerprint = (latest, DOMAIN["srad"]["engine"])
+    grids.update(
+        RESULTS.cached(
+            "srad",
+            fingerprint,
+            RESULT_TTL["srad"],
+            lambda: srad_grid(valid, iarchive),
+        )
+    )
+
+
+def srad_grid(valid, iarchive):
+    """Grid the ISU Soil Moisture, or ISUAG, solar radiation"""
     if iarchive:
         # We have to split based on if we are prior to 1 Jan 2014
         if valid.year < 2014:
-            nt = NetworkTable("ISUAG")
-            # c800 is kilo calorie per meter squared per hour
-            with get_sqlalchemy_conn("isuag") as conn:
-                df = pd.read_sql(
-                    sql_helper("""
-                    SELECT station, c800 * 1.162 as srad
-                    from hourly
-                    WHERE valid >= :sts and valid < :ets and c800 >= 0
-                    """),
-                    conn,
-                    params={
-                        "sts": (valid - timedelta(minutes=30)),
-                        "ets": (valid + timedelta(minutes=30)),
-                    },
-                    index_col=None,
-                )
+            df = attach_latlon(archive_obs("isuag", valid), ["ISUAG"])
         else:
-            nt = NetworkTable("ISUSM")
-            # Not fully certain on this unit, but it appears to be ok
-            with get_sqlalchemy_conn("isuag") as pgconn:
-                df = pd.read_sql(
-                    sql_helper("""
-                    SELECT station, slrkj_tot_qc * 1000. / 3600. as srad
-                    from sm_hourly
-                    WHERE valid >= :sts and valid < :ets and slrkj_tot_qc >= 0
-                    """),
-                    pgconn,
-                    params={
-                        "sts": (valid - timedelta(minutes=30)),
-                        "ets": (valid + timedelta(minutes=30)),
-                    },
-                    index_col=None,
-                )
-        df["lat"] = df["station"].apply(
-            lambda x: nt.sts.get(x, {}).get("lat", 0)
-        )
-        df["lon"] = df["station"].apply(
-            lambda x: nt.sts.get(x, {}).get("lon", 0)
-        )
+            df = attach_latlon(archive_obs("isusm", valid), ["ISUSM"])
     else:
         with get_sqlalchemy_conn("iem") as conn:
             df = pd.read_sql(
@@ -370,43 +352,20 @@ def srad(grids, valid, iarchive):
                 index_col=None,
             )
     if len(df.index) < 5:
-        print(
-            (
-                "i5gridder abort len(data): %s for %s iarchive: %s"
-                % (len(df.index), valid, iarchive)
-            )
+        raise NoDataError(
+            "i5gridder abort len(data): %s for %s iarchive: %s"
+            % (len(df.index), valid, iarchive)
         )
-        sys.exit()
 
-    nn = NearestNDInterpolator(
-        (df["lon"].values, df["lat"].values), df["srad"].values
-    )
-    grids["srad"] = nn(XI, YI)
+    count("rows", len(df.index))
+    plan = get_plan(df["lon"].values, df["lat"].values, XI, YI)
+    return grid_stations(plan, {"srad": df["srad"].values})
 
 
 def simple(grids, valid, iarchive):
     """Simple gridder (stub for now)"""
     if iarchive:
-        with get_sqlalchemy_conn("asos") as conn:
-            df = pd.read_sql(
-                sql_helper("""
-    SELECT ST_x(geom) as lon, ST_y(geom) as lat,
-    tmpf, dwpf, sknt, drct, vsby
-    from alldata c JOIN stations t on
-    (c.station = t.id)
-    WHERE c.valid >= :sts and c.valid < :ets and
-    t.network in ('IA_ASOS', 'AWOS', 'MN_ASOS', 'WI_ASOS', 'IL_ASOS',
-    'MO_ASOS', 'NE_ASOS', 'KS_ASOS', 'SD_ASOS') and sknt is not null
-    and drct is not null and tmpf is not null and dwpf is not null
-    and vsby is not null
-                """),
-                conn,
-                params={
-                    "sts": (valid - timedelta(minutes=30)),
-                    "ets": (valid + timedelta(minutes=30)),
-                },
-                index_col=None,
-            )
+        df = archive_obs("asos", valid)
     else:
         with get_sqlalchemy_conn("iem") as conn:
             df = pd.read_sql(
@@ -425,57 +384,39 @@ def simple(grids, valid, iarchive):
             )
 
     if len(df.index) < 5:
-        print(
-            (
-                "i5gridder abort len(data): %s for %s iarchive: %s"
-                % (len(df.index), valid, iarchive)
-            )
+        raise NoDataError(
+            "i5gridder abort len(data): %s for %s iarchive: %s"
+            % (len(df.index), valid, iarchive)
         )
-        sys.exit()
-
-    nn = NearestNDInterpolator(
-        (df["lon"].values, df["lat"].values),
-        temperature(df["tmpf"].values, "F").value("C"),
-    )
-    grids["tmpc"] = nn(XI, YI)
-
-    nn = NearestNDInterpolator(
-        (df["lon"].values, df["lat"].values),
-        temperature(df["dwpf"].values, "F").value("C"),
-    )
-    grids["dwpc"] = nn(XI, YI)
-
-    nn = NearestNDInterpolator(
-        (df["lon"].values, df["lat"].values),
-        speed(df["sknt"].values, "KT").value("MPS"),
-    )
-    grids["smps"] = nn(XI, YI)
 
+    count("rows", len(df.index))
+    # Every variable shares the one station -> grid neighbour query
+    plan = get_plan(df["lon"].values, df["lat"].values, XI, YI)
     u, v = meteorology.uv(
         speed(df["sknt"].values, "KT"), direction(df["drct"].values, "DEG")
     )
-    nn = NearestNDInterpolator(
-        (df["lon"].values, df["lat"].values), u.value("MPS")
-    )
-    ugrid = nn(XI, YI)
-    nn = NearestNDInterpolator(
-        (df["lon"].values, df["lat"].values), v.value("MPS")
-    )
-    vgrid = nn(XI, YI)
-    drct = (
-        meteorology.drct(
-            speed(ugrid.ravel(), "MPS"), speed(vgrid.ravel(), "MPS")
+    u = u.value("MPS")
+    v = v.value("MPS")
+    grids.update(
+        grid_stations(
+            plan,
+            {
+                "tmpc": temperature(df["tmpf"].values, "F").value("C"),
+                "dwpc": temperature(df["dwpf"].values, "F").value("C"),
+                "smps": speed(df["sknt"].values, "KT").value("MPS"),
+                "vsby": distance(df["vsby"].values, "MI").value("KM"),
+            },
         )
-        .value("DEG")
-        .astype("i")
-    )
-    grids["drct"] = np.reshape(drct, (len(YAXIS), len(XAXIS)))
-
-    nn = NearestNDInterpolator(
-        (df["lon"].values, df["lat"].values),
-        distance(df["vsby"].values, "MI").value("KM"),
     )
-    grids["vsby"] = nn(XI, YI)
+    engine = DOMAIN["drct"]["engine"]
+    if engine == "nearest":
+        # u and v come from the same station, so the direction is computed
+        # per station, as meteorology.drct() does, rather than per grid cell
+        drct = plan.gather((np.arctan2(u, v) * 180.0 / np.pi) + 180)
+    else:
+        ugrid, vgrid = objan.analyze(plan, np.column_stack((u, v)), engine)
+        drct = (np.arctan2(ugrid, vgrid) * 180.0 / np.pi) + 180
+    grids["drct"] = drct.astype("i")
 
 
 def ptype(grids, valid, iarchive):
@@ -496,47 +437,14 @@ def ptype(grids, valid, iarchive):
     91    tropical/stratiform rain mix
     96    tropical/convective rain mix
     """
-    floor = datetime(2016, 1, 21)
-    floor = floor.replace(tzinfo=timezone.utc)
-    if valid < floor:
+    if valid < PTYPE_FLOOR:
         # Use hack for now
         grids["ptype"] = np.where(grids["tmpc"] < 0, 3, 10)
         return
 
-    fn = None
-    i = 0
-    while i < 10:
-        ts = valid - timedelta(minutes=i)
-        if ts.minute % 2 == 0:
-            testfn = mrms_util.fetch("PrecipFlag", ts, tmpdir="/tmp")
-            if testfn is not None:
-                fn = testfn
-                break
-        i += 1
-    if fn is None:
-        print("Warning, no PrecipFlag data found!")
-        return
-
-    fp = gzip.GzipFile(fn, "rb")
-    (_, tmpfn) = tempfile.mkstemp()
-    with open(tmpfn, "wb") as tmpfp:
-        tmpfp.write(fp.read())
-    grbs = pygrib.open(tmpfn)
-    if grbs.messages < 1:
-        print("i5gridder %s has %s messages?" % (tmpfn, grbs.messages))
-        return
-    grb = grbs[1]
-    os.unlink(fn)
-    os.unlink(tmpfn)
-
-    # 3500, 7000, starts in upper left
-    top = int((55.0 - reference.IA_NORTH) * 100.0)
-    bottom = int((55.0 - reference.IA_SOUTH) * 100.0)
-
-    right = int((reference.IA_EAST - -130.0) * 100.0) - 1
-    left = int((reference.IA_WEST - -130.0) * 100.0)
-
-    grids["ptype"] = np.flipud(grb["values"][top:bottom, left:right])
+    data = read_window("PrecipFlag", valid, XAXIS, YAXIS)
+    if data is not None:
+        grids["ptype"] = data
 
 
 def pcpn(grids, valid, _iarchive):
@@ -555,86 +463,213 @@ def pcpn(grids, valid, _iarchive):
         grib = grbs[1]
         lats, lons = grib.latlons()
         vals = grib.values
-        nn = NearestNDInterpolator(
-            (lons.flatten(), lats.flatten()), vals.flatten()
-        )
-        grids["pcpn"] = nn(XI, YI)
+        grids["pcpn"] = regrid(vals, get_index(lons, lats, XI, YI))
         return
-    fn = None
-    i = 0
-    while i < 10:
-        ts = valid - timedelta(minutes=i)
-        if ts.minute % 2 == 0:
-            testfn = mrms_util.fetch("PrecipRate", ts, tmpdir="/tmp")
-            if testfn is not None:
-                fn = testfn
-                break
-        i += 1
-    if fn is None:
-        print("Warning, no PrecipRate data found!")
+    values = read_window("PrecipRate", valid, XAXIS, YAXIS)
+    if values is None:
         return
-    fp = gzip.GzipFile(fn, "rb")
-    (_, tmpfn) = tempfile.mkstemp()
-    with open(tmpfn, "wb") as tmpfp:
-        tmpfp.write(fp.read())
-    with pygrib.open(tmpfn) as grbs:
-        values = grbs[1]["values"]
     # just set -3 (no coverage) to 0 for now
     values = np.where(values < 0, 0, values)
-    os.unlink(fn)
-    os.unlink(tmpfn)
+    # two minute accumulation is in mm/hr / 60 * 5
+    # stage IV is mm/hr
+    grids["pcpn"] = values / 12.0
 
-    # 3500, 7000, starts in upper left
-    top = int((55.0 - reference.IA_NORTH) * 100.0)
-    bottom = int((55.0 - reference.IA_SOUTH) * 100.0)
 
-    right = int((reference.IA_EAST - -130.0) * 100.0) - 1
-    left = int((reference.IA_WEST - -130.0) * 100.0)
+# The source stages, with the grids each one fills
+STAGES = [
+    (simple, ["tmpc", "dwpc", "smps", "drct", "vsby"]),
+    (wwa, ["wawa"]),
+    (ptype, ["ptype"]),
+    (pcpn, ["pcpn"]),
+    (snowd, ["snwd"]),
+    (roadtmpc, ["roadtmpc"]),
+    (srad, ["srad"]),
+]
 
-    # two minute accumulation is in mm/hr / 60 * 5
-    # stage IV is mm/hr
-    grids["pcpn"] = np.flipud(values[top:bottom, left:right]) / 12.0
-    # print("i5gridder: min(pcpn) is %.2f" % (np.min(grids['pcpn']),))
 
+def stage_deps(valid):
+    """Return which stages depend on the output of others for this time."""
+    if valid < PTYPE_FLOOR:
+        # ptype is derived from tmpc
+        return {"ptype": ["simple"]}
+    return {}
+
+
+def run_stages(grids, valid, iarchive, metrics, workers=1):
+    """Run the source stages, concurrently when workers > 1.
+
+    Stages run in STAGES order as soon as the stages they depend on are
+    done.  An exception only fails its own stage and those depending on it.
 
-def run(valid):
-    """Run for this timestamp (UTC)"""
+    Args:
+      grids (dict): the analysis grids to fill
+      valid (datetime): analysis time
+      iarchive (bool): is this an archive analysis
+      metrics (instrument.Metrics): records each stage
+      workers (int): number of threads running the stages
+
+    Returns:
+      dict of failed stage name to its exception
+    """
+    deps = stage_deps(valid)
+    failures = {}
+    done = set()
+    pending = [func for func, _ in STAGES]
+
+    def _timed(func):
+        with metrics.stage(func.__name__):
+            func(grids, valid, iarchive)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        running = {}
+        while pending or running:
+            for func in list(pending):
+                needs = deps.get(func.__name__, [])
+                failed = [n for n in needs if n in failures]
+                if failed:
+                    pending.remove(func)
+                    failures[func.__name__] = NoDataError(
+                        f"depends on failed stage {failed[0]}"
+                    )
+                elif all(n in done for n in needs):
+                    pending.remove(func)
+                    running[pool.submit(_timed, func)] = func.__name__
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                if future.exception() is not None:
+                    failures[name] = future.exception()
+                done.add(name)
+    return failures
+
+
+def run(
+    valid,
+    stream=None,
+    keep=False,
+    ncdir=None,
+    workers=1,
+    storedir=None,
+    cubedir=None,
+):
+    """Run for this timestamp (UTC)
+
+    Returns:
+      dict of failed stage names to their exception, nothing is written
+      when a stage fails, an `upload` failure when the output did not
+      reach S3
+    """
     grids = init_grids()
     floor = datetime.now(timezone.utc) - timedelta(hours=1)
     floor = floor.replace(tzinfo=timezone.utc)
     iarchive = valid < floor
-    simple(grids, valid, iarchive)
-    wwa(grids, valid, iarchive)
-    ptype(grids, valid, iarchive)
-    pcpn(grids, valid, iarchive)
-    snowd(grids, valid, iarchive)
-    roadtmpc(grids, valid, iarchive)
-    srad(grids, valid, iarchive)
-    # [suspenders] Prevent negative numbers, unsure why we sometimes get these
-    # from the data sources being used :/
-    for vname in ["pcpn", "snwd", "srad"]:
-        grids[vname] = np.where(grids[vname] >= 0, grids[vname], 0)
-    write_grids(grids, valid, iarchive)
+    metrics = instrument.Metrics(f"wx_{valid:%Y%m%d%H%M}")
+    with metrics.activate():
+        failures = run_stages(grids, valid, iarchive, metrics, workers)
+        if failures:
+            for func, variables in STAGES:
+                if func.__name__ in failures:
+                    LOG.error(
+                        "%s %s failed for %s: %s",
+                        valid,
+                        func.__name__,
+                        ",".join(variables),
+                        failures[func.__name__],
+                    )
+            metrics.log()
+            return failures
+        # [suspenders] Prevent negative numbers, unsure why we sometimes get
+        # these from the data sources being used :/
+        for vname in ["pcpn", "snwd", "srad"]:
+            grids[vname] = np.where(grids[vname] >= 0, grids[vname], 0)
+        if not write_grids(grids, valid, iarchive, stream, keep, metrics):
+            # the other outputs are still written, but the run is not done
+            LOG.error("%s upload failed", valid)
+            failures["upload"] = OSError(f"Failed to upload {valid}")
+        if ncdir is not None:
+            with instrument.stage("netcdf"):
+                write_analysis_nc(
+                    f"{ncdir}/wx_{valid:%Y%m%d%H%M}.nc",
+                    grids,
+                    valid,
+                    DOMAIN,
+                    XAXIS,
+                    YAXIS,
+                    PROGRAM_VERSION,
+                )
+        if storedir is not None:
+            with instrument.stage("store"):
+                write_store(storedir, grids, valid, list(DOMAIN))
+        if cubedir is not None and not cube.on_cadence(valid):
+            LOG.warning("%s is not a cube slot, not appending it", valid)
+        elif cubedir is not None:
+            with instrument.stage("cube"):
+                cube.append(cubedir, grids, valid, list(DOMAIN))
+    metrics.log()
+    return failures
 
 
 def main(argv):
     """Go Main Go"""
-    if len(argv) != 6:
-        print("Usage: python i5gridder.py YYYY mm dd HH MI")
-        return
+    parser = argparse.ArgumentParser(description="IEM weather analysis")
+    parser.add_argument("year", type=int)
+    parser.add_argument("month", type=int)
+    parser.add_argument("day", type=int)
+    parser.add_argument("hour", type=int)
+    parser.add_argument("minute", type=int)
+    parser.add_argument(
+        "--stream",
+        choices=list(EXTENSIONS),
+        help="stream compressed output directly to S3",
+    )
+    parser.add_argument(
+        "--keep",
+        action="store_true",
+        help="keep a local copy of the streamed output",
+    )
+    parser.add_argument(
+        "--ncdir", help="also write a NetCDF file to this directory"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of threads running the source stages",
+    )
+    parser.add_argument(
+        "--storedir", help="also write the grids to this query store"
+    )
+    parser.add_argument(
+        "--cubedir", help="also append the grids to this time-series cube"
+    )
+    args = parser.parse_args(argv[1:])
     valid = datetime(
-        int(argv[1]),
-        int(argv[2]),
-        int(argv[3]),
-        int(argv[4]),
-        int(argv[5]),
+        args.year,
+        args.month,
+        args.day,
+        args.hour,
+        args.minute,
         tzinfo=timezone.utc,
     )
-    run(valid)
+    if args.cubedir is not None and not cube.on_cadence(valid):
+        parser.error(f"--cubedir needs a minute multiple of {cube.INTERVAL}")
+    failures = run(
+        valid,
+        args.stream,
+        args.keep,
+        args.ncdir,
+        args.workers,
+        args.storedir,
+        args.cubedir,
+    )
+    # run() logged each failed stage, nothing was written
+    return 1 if failures else 0
 
 
 if __name__ == "__main__":
-    main(sys.argv)
+    sys.exit(main(sys.argv))
 
 
 def test_upload():
@@ -0,0 +1,295 @@
+"""Lightweight per stage metrics of a gridder run.
+
+Each stage records its wall time, the CPU time of the thread running it,
+the change in the process RSS over it and counts of what it handled, such
+as rows, points or bytes.  Stages with the same name accumulate, so a
+stage run once per forecast hour is reported as one total.  Concurrent
+stages share the process, so see each other's RSS changes.  The run as a
+whole reports the process lifetime peak RSS, which in a resident process
+such as i5daemon covers every cycle so far.
+
+    metrics = Metrics("wx_202401011200")
+    with metrics.stage("simple"):
+        count("rows", len(df.index))
+    metrics.log()
+
+Within `metrics.activate()`, the module level stage() records into that
+Metrics, so code need not be handed the object.  count() applies to the
+innermost stage of the running thread, else to the active Metrics.
+
+The metrics line is logged at INFO, which pyiem only shows interactively,
+so set IEMGRID_METRICS_FILE to also append it as JSON to that file.
+
+Set IEMGRID_PROFILE to `cprofile` or `tracemalloc` to also dump a profile
+of each stage into IEMGRID_PROFILE_DIR, default /tmp.  tracemalloc traces
+the whole process, so concurrent stages show up in each other's dumps.
+"""
+
+import cProfile
+import itertools
+import json
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from pyiem.util import logger
+
+LOG = logger()
+PROFILERS = ["cprofile", "tracemalloc"]
+_STAGE = ContextVar("stage", default=None)
+_METRICS = ContextVar("metrics", default=None)
+# Numbers the profile dumps of this process
+_DUMPS = itertools.count()
+
+
+def peak_rss_mb():
+    """Return the peak resident set size of this process in MB."""
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def rss_mb():
+    """Return the current resident set size of this process in MB."""
+    try:
+        with open("/proc/self/statm") as fh:
+            pages = int(fh.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return 0.0
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+class StageMetrics:
+    """What one named stage took and handled."""
+
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.rss_delta_mb = 0.0
+        self.counts = {}
+
+    def add(self, key, amount):
+        """Add to one of the counts."""
+        self.counts[key] = self.counts.get(key, 0) + amount
+
+    def update(self, other):
+        """Accumulate another record, or its as_dict(), into this one."""
+        if isinstance(other, StageMetrics):
+            other = other.as_dict()
+        other = dict(other)
+        self.calls += other.pop("calls")
+        self.wall += other.pop("wall")
+        self.cpu += other.pop("cpu")
+        self.rss_delta_mb += other.pop("rss_delta_mb")
+        for key, amount in other.items():
+            self.add(key, amount)
+
+    def as_dict(self):
+        """Return the record as a JSON friendly dict."""
+        return {
+            "calls": self.calls,
+            "wall": round(self.wall, 3),
+            "cpu": round(self.cpu, 3),
+            "rss_delta_mb": round(self.rss_delta_mb, 1),
+            **self.counts,
+        }
+
+
+@contextmanager
+def profiled(fnbase):
+    """Dump a profile of the enclosed code when IEMGRID_PROFILE is set."""
+    profiler = os.environ.get("IEMGRID_PROFILE")
+    if profiler not in PROFILERS:
+        yield
+        return
+    outdir = os.environ.get("IEMGRID_PROFILE_DIR", "/tmp")
+    fn = os.path.join(outdir, fnbase)
+    if profiler == "cprofile":
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            prof.dump_stats(f"{fn}.prof")
+        return
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    try:
+        yield
+    finally:
+        stats = tracemalloc.take_snapshot().statistics("lineno")
+        peak = tracemalloc.get_traced_memory()[1]
+        if started:
+            tracemalloc.stop()
+        with open(f"{fn}.tracemalloc.txt", "w") as fh:
+            fh.write(f"peak traced: {peak / 2**20:.1f} MiB\n")
+            for stat in stats[:50]:
+                fh.write(f"{stat}\n")
+
+
+class Metrics:
+    """Metrics of each stage of one run.
+
+    Args:
+      label (str): names the run in the log line and profile dumps
+    """
+
+    def __init__(self, label):
+        self.label = label
+        self.start = time.perf_counter()
+        self.counts = {}
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def _record(self, name):
+        with self._lock:
+            return self.stages.setdefault(name, StageMetrics())
+
+    @contextmanager
+    def stage(self, name):
+        """Record the enclosed code as this stage."""
+        rec = StageMetrics()
+        token = _STAGE.set(rec)
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        rss = rss_mb()
+        try:
+            fnbase = f"{self.label}_{name}_{os.getpid()}_{next(_DUMPS)}"
+            with profiled(fnbase):
+                yield rec
+        finally:
+            rec.calls = 1
+            rec.wall = time.perf_counter() - wall
+            rec.cpu = time.thread_time() - cpu
+            rec.rss_delta_mb = rss_mb() - rss
+            _STAGE.reset(token)
+            target = self._record(name)
+            with self._lock:
+                target.update(rec)
+
+    def add(self, key, amount):
+        """Add to one of the run level counts."""
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + amount
+
+    def merge(self, stages):
+        """Accumulate stages recorded elsewhere, such as another process.
+
+        Args:
+          stages (dict): stage name -> StageMetrics.as_dict()
+        """
+        for name, other in stages.items():
+            target = self._record(name)
+            with self._lock:
+                target.update(other)
+
+    @contextmanager
+    def activate(self):
+        """Make this the Metrics the module level stage() records into."""
+        token = _METRICS.set(self)
+        try:
+            yield self
+        finally:
+            _METRICS.reset(token)
+
+    def stage_dicts(self):
+        """Return stage name -> StageMetrics.as_dict()."""
+        with self._lock:
+            return {name: rec.as_dict() for name, rec in self.stages.items()}
+
+    def as_dict(self):
+        """Return the metrics as a JSON friendly dict."""
+        return {
+            "wall": round(time.perf_counter() - self.start, 3),
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            **self.counts,
+            "stages": self.stage_dicts(),
+        }
+
+    def to_json(self):
+        """Return the metrics as compact JSON."""
+        return json.dumps(self.as_dict(), separators=(",", ":"))
+
+    def log(self):
+        """Emit the machine readable metrics line."""
+        text = self.to_json()
+        LOG.info("METRICS %s %s", self.label, text)
+        fn = os.environ.get("IEMGRID_METRICS_FILE")
+        if fn is None:
+            return
+        try:
+            with open(fn, "a") as fh:
+                fh.write(f'{{"label":"{self.label}",{text[1:]}\n')
+        except OSError as exp:
+            LOG.warning("Failed to write metrics to %s: %s", fn, exp)
+
+
+@contextmanager
+def stage(name):
+    """Record the enclosed code as this stage of the active Metrics."""
+    metrics = _METRICS.get()
+    if metrics is None:
+        yield None
+        return
+    with metrics.stage(name) as rec:
+        yield rec
+
+
+def merge(stages):
+    """Accumulate stages recorded elsewhere into the active Metrics."""
+    metrics = _METRICS.get()
+    if metrics is not None:
+        metrics.merge(stages)
+
+
+def count(key, amount=1):
+    """Add to a count of the innermost running stage.
+
+    Outside of any stage, the count is of the active Metrics as a whole.
+    """
+    rec = _STAGE.get()
+    if rec is None:
+        rec = _METRICS.get()
+    if rec is not None:
+        rec.add(key, amount)
+
+
+def test_metrics(tmp_path, monkeypatch):
+    """Stages accumulate, counts land in the innermost stage."""
+    monkeypatch.setenv("IEMGRID_PROFILE", "cprofile")
+    monkeypatch.setenv("IEMGRID_PROFILE_DIR", str(tmp_path))
+    monkeypatch.setenv("IEMGRID_METRICS_FILE", str(tmp_path / "m.jsonl"))
+    metrics = Metrics("test")
+    count("rows", 5)
+    for _ in range(2):
+        with metrics.stage("grid"):
+            count("rows", 10)
+    with metrics.activate():
+        with stage("write"):
+            count("bytes", 100)
+        count("bytes", 5)
+    metrics.merge({"grid": {**metrics.stage_dicts()["grid"], "rows": 1}})
+    res = json.loads(metrics.to_json())["stages"]
+    assert res["grid"]["calls"] == 4
+    assert res["grid"]["rows"] == 21
+    assert res["write"]["bytes"] == 100
+    assert metrics.as_dict()["bytes"] == 5
+    assert len(list(tmp_path.glob("test_*.prof"))) == 3
+    metrics.log()
+    with open(tmp_path / "m.jsonl") as fh:
+        assert json.loads(fh.read())["label"] == "test"
+    with stage("nothing") as rec:
+        assert rec is None
+    # the memory a stage keeps is its own, not the process peak
+    with metrics.stage("allocate"):
+        kept = bytearray(64 * 2**20)
+    res = metrics.stage_dicts()
+    assert res["allocate"]["rss_delta_mb"] >= 60 > res["write"]["rss_delta_mb"]
+    del kept
@@ -0,0 +1,110 @@
+"""Read MRMS products over our analysis window.
+
+The gzipped GRIB file is decompressed and decoded in memory, once per
+product and timestamp, and the analysis window is located from the GRIB's
+own grid definition rather than hard-coded offsets.
+"""
+
+import gzip
+import os
+from datetime import timedelta
+
+import numpy as np
+import pygrib
+import pyiem.mrms as mrms_util
+from instrument import count
+from pyiem.util import logger
+
+LOG = logger()
+# Recently read windows, keyed by (product, valid)
+_CACHE = {}
+_CACHE_SIZE = 8
+
+
+def fetch_latest(product, valid, minutes=10):
+    """Fetch the most recent file of this product within minutes of valid.
+
+    Returns:
+      filename or None
+    """
+    for i in range(minutes):
+        ts = valid - timedelta(minutes=i)
+        if ts.minute % 2 != 0:
+            continue
+        fn = mrms_util.fetch(product, ts, tmpdir="/tmp")
+        if fn is not None:
+            return fn
+    return None
+
+
+def decode(fn):
+    """Decompress this gzipped GRIB file in memory, returning the message."""
+    with open(fn, "rb") as fh:
+        return pygrib.fromstring(gzip.decompress(fh.read()))
+
+
+def window_index(grb, xaxis, yaxis):
+    """Compute the GRIB rows and columns holding our analysis cells.
+
+    The analysis axes are the lower left corners of the cells, so we pick
+    the source cell containing each analysis cell center.
+
+    Returns:
+      (rows, cols) index arrays, so rows align with yaxis, cols with xaxis
+    """
+    lat0 = grb["latitudeOfFirstGridPointInDegrees"]
+    lon0 = grb["longitudeOfFirstGridPointInDegrees"]
+    lon0 = lon0 - 360.0 if lon0 > 180 else lon0
+    dlat = grb["jDirectionIncrementInDegrees"]
+    dlon = grb["iDirectionIncrementInDegrees"]
+    latc = np.asarray(yaxis) + (yaxis[1] - yaxis[0]) / 2.0
+    lonc = np.asarray(xaxis) + (xaxis[1] - xaxis[0]) / 2.0
+    if grb["jScansPositively"]:
+        rows = np.rint((latc - lat0) / dlat)
+    else:
+        rows = np.rint((lat0 - latc) / dlat)
+    cols = np.rint((lonc - lon0) / dlon)
+    rows = rows.astype(int)
+    cols = cols.astype(int)
+    if (
+        rows.min() < 0
+        or rows.max() >= grb["Nj"]
+        or cols.min() < 0
+        or cols.max() >= grb["Ni"]
+    ):
+        raise ValueError("Analysis window is outside of the GRIB grid")
+    return rows, cols
+
+
+def read_window(product, valid, xaxis, yaxis):
+    """Return this MRMS product over the analysis window, None if missing.
+
+    Args:
+      product (str): MRMS product name
+      valid (datetime): analysis time, the latest file within ten minutes
+        prior is used
+      xaxis (array): analysis grid longitudes
+      yaxis (array): analysis grid latitudes
+    """
+    key = (product, valid)
+    if key in _CACHE:
+        return _CACHE[key]
+    fn = fetch_latest(product, valid)
+    if fn is None:
+        print(f"Warning, no {product} data found!")
+        return None
+    count("bytes", os.path.getsize(fn))
+    try:
+        grb = decode(fn)
+        rows, cols = window_index(grb, xaxis, yaxis)
+        data = np.asarray(grb.values)[np.ix_(rows, cols)]
+        count("points", data.size)
+    except Exception as exp:
+        LOG.error("Failed to read %s: %s", fn, exp)
+        return None
+    finally:
+        os.unlink(fn)
+    if len(_CACHE) >= _CACHE_SIZE:
+        _CACHE.pop(next(iter(_CACHE)))
+    _CACHE[key] = data
+    return data
@@ -0,0 +1,150 @@
+"""Write analysis and forecast grids to compressed, chunked NetCDF4 files.
+
+This is a binary companion of the JSON feed for consumers wanting arrays.
+The wawa bitset is stored as is, described with CF `flag_masks`.
+"""
+
+import socket
+from datetime import timedelta, timezone
+
+import netCDF4
+import numpy as np
+import wawa
+from pyiem.util import logger
+
+LOG = logger()
+TIME_UNITS = "seconds since 1970-01-01 00:00:00 UTC"
+# Chunks of 4 x 4 tiles over the 324 x 660 grid
+CHUNKS = (81, 165)
+
+
+def _init(nc, xaxis, yaxis, revision):
+    """Setup the dimensions and coordinates common to both files."""
+    nc.Conventions = "CF-1.8"
+    nc.revision = str(revision)
+    nc.hostname = socket.gethostname()
+    nc.createDimension("y", len(yaxis))
+    nc.createDimension("x", len(xaxis))
+    lat = nc.createVariable("lat", np.float64, ("y",))
+    lat.units = "degrees_north"
+    lat.long_name = "Latitude of lower left cell corner"
+    lat[:] = yaxis
+    lon = nc.createVariable("lon", np.float64, ("x",))
+    lon.units = "degrees_east"
+    lon.long_name = "Longitude of lower left cell corner"
+    lon[:] = xaxis
+
+
+def _create(nc, label, meta, dims, chunks):
+    """Create the variable for this DOMAIN entry."""
+    if label == "wawa":
+        ncvar = nc.createVariable(
+            label, wawa.DTYPE, dims, zlib=True, chunksizes=chunks
+        )
+        ncvar.flag_masks = np.array(
+            [int(wawa.code_bit(code)) for code in wawa.BITS],
+            dtype=wawa.DTYPE,
+        )
+        ncvar.flag_meanings = " ".join(wawa.BITS)
+        ncvar.long_name = "Active NWS VTEC phenomena.significance bitset"
+        return ncvar
+    ncvar = nc.createVariable(
+        label,
+        np.float32,
+        dims,
+        zlib=True,
+        shuffle=True,
+        chunksizes=chunks,
+        fill_value=np.float32(np.nan),
+    )
+    ncvar.units = meta["units"]
+    return ncvar
+
+
+def write_analysis_nc(fn, grids, valid, domain, xaxis, yaxis, revision):
+    """Write the analysis grids for this valid time.
+
+    Args:
+      fn (str): NetCDF file to create
+      grids (dict): analysis grids
+      valid (datetime): analysis time
+      domain (dict): variable names to their units and formats
+      xaxis (array): longitudes of the grid
+      yaxis (array): latitudes of the grid
+      revision (str): program version
+    """
+    with netCDF4.Dataset(fn, "w") as nc:
+        _init(nc, xaxis, yaxis, revision)
+        nc.title = "IEM Weather Analysis"
+        ncvar = nc.createVariable("time", np.float64)
+        ncvar.units = TIME_UNITS
+        ncvar[:] = netCDF4.date2num(
+            valid.astimezone(timezone.utc).replace(tzinfo=None), TIME_UNITS
+        )
+        for label, meta in domain.items():
+            ncvar = _create(nc, label, meta, ("y", "x"), CHUNKS)
+            ncvar[:] = grids[label]
+    LOG.info("Wrote %s", fn)
+
+
+class ForecastNC:
+    """NetCDF file of forecast grids, written one forecast hour at a time.
+
+    Args:
+      fn (str): NetCDF file to create
+      valid (datetime): model initialization time
+      fhours (list): forecast hours that will be written
+      domain (dict): variable names to their units and formats
+      xaxis (array): longitudes of the grid
+      yaxis (array): latitudes of the grid
+      revision (str): program version
+    """
+
+    def __init__(self, fn, valid, fhours, domain, xaxis, yaxis, revision):
+        self.fn = fn
+        self.fhours = list(fhours)
+        self.domain = domain
+        self.nc = netCDF4.Dataset(fn, "w")
+        _init(self.nc, xaxis, yaxis, revision)
+        self.nc.title = "IEM Weather Forecast"
+        self.nc.createDimension("forecast_hour", len(self.fhours))
+        ncvar = self.nc.createVariable(
+            "forecast_hour", np.int16, ("forecast_hour",)
+        )
+        ncvar.units = "hours"
+        ncvar[:] = self.fhours
+        init = valid.astimezone(timezone.utc).replace(tzinfo=None)
+        ncvar = self.nc.createVariable("model_init_time", np.float64)
+        ncvar.units = TIME_UNITS
+        ncvar[:] = netCDF4.date2num(init, TIME_UNITS)
+        ncvar = self.nc.createVariable("time", np.float64, ("forecast_hour",))
+        ncvar.units = TIME_UNITS
+        ncvar[:] = netCDF4.date2num(
+            [init + timedelta(hours=f) for f in self.fhours], TIME_UNITS
+        )
+        for label, meta in domain.items():
+            _create(
+                self.nc,
+                label,
+                meta,
+                ("forecast_hour", "y", "x"),
+                (1, *CHUNKS),
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write_hour(self, fhour, d):
+        """Write the available grids for this forecast hour."""
+        i = self.fhours.index(fhour)
+        for label in self.domain:
+            if label in d:
+                self.nc.variables[label][i] = d[label]
+
+    def close(self):
+        """Close the file."""
+        self.nc.close()
+        LOG.info("Wrote %s", self.fn)
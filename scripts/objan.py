@@ -0,0 +1,160 @@
+"""Objective analysis of station observations onto the analysis grid.
+
+Each engine works from a regrid.StationPlan, so the KD-tree neighbour
+queries are made once per station set and shared by every variable.  The
+weighted engines only consider the k nearest stations to each grid point,
+optionally truncated to a radius, so their cost scales with grid points
+times k rather than grid points times stations.  Values may be a single
+(n_stations,) array or a stacked (n_stations, n_vars) matrix.
+
+Distances are in degrees, as are the station and grid coordinates.
+"""
+
+import numpy as np
+
+# Barnes convergence parameter for the passes after the first
+GAMMA = 0.3
+
+
+def _grid(plan, out):
+    """Reshape (n_points, n_vars) or (n_points,) output onto the grid."""
+    if out.ndim == 1:
+        return out.reshape(plan.shape)
+    return np.moveaxis(out, -1, 0).reshape((-1, *plan.shape))
+
+
+def _weighted(weights, idx, values):
+    """Weighted mean of the neighbouring station values."""
+    norm = weights.sum(axis=1)
+    if values.ndim == 1:
+        return (weights * values[idx]).sum(axis=1) / norm
+    return np.einsum("pk,pkv->pv", weights, values[idx]) / norm[:, None]
+
+
+def _truncate(dist, radius):
+    """Mask neighbours beyond radius, keeping at least the nearest."""
+    if radius is None:
+        return dist
+    dist = np.where(dist <= radius, dist, np.inf)
+    dist[:, 0] = np.minimum(dist[:, 0], radius)
+    return dist
+
+
+def nearest(plan, values):
+    """Nearest station value, the blocky Voronoi field."""
+    return plan.gather(values)
+
+
+def idw(plan, values, k=8, power=2.0, radius=None):
+    """Inverse distance weighted mean of the k nearest stations.
+
+    Args:
+      plan (regrid.StationPlan): station to grid neighbour plan
+      values (array): station values
+      k (int): number of neighbours considered
+      power (float): distance exponent
+      radius (float,optional): ignore stations further than this
+    """
+    values = np.asarray(values, dtype=np.float64)
+    dist, idx = plan.neighbours(k)
+    dist = _truncate(dist, radius)
+    # A grid point on top of a station takes its value
+    weights = 1.0 / np.maximum(dist, 1e-9) ** power
+    return _grid(plan, _weighted(weights, idx, values))
+
+
+def spacing(plan):
+    """Mean distance from each station to its nearest neighbouring one."""
+    dist, _ = plan.neighbours(2, stations=True)
+    return float(np.mean(dist[:, -1]))
+
+
+def barnes(plan, values, k=16, passes=2, kappa=None, gamma=GAMMA, radius=None):
+    """Multi-pass Barnes analysis over the k nearest stations.
+
+    Args:
+      plan (regrid.StationPlan): station to grid neighbour plan
+      values (array): station values
+      k (int): number of neighbours considered
+      passes (int): first pass plus this many minus one corrections
+      kappa (float,optional): weight parameter in degrees squared, by
+        default derived from the station spacing (Koch et al. 1983)
+      gamma (float): kappa multiplier for the correction passes
+      radius (float,optional): ignore stations further than this
+    """
+    values = np.asarray(values, dtype=np.float64)
+    gdist, gidx = plan.neighbours(k)
+    sdist, sidx = plan.neighbours(k, stations=True)
+    if kappa is None:
+        # the station neighbours hold the spacing, past each station itself
+        mean = np.mean(sdist[:, 1]) if sdist.shape[1] > 1 else spacing(plan)
+        kappa = 5.052 * (2.0 * mean / np.pi) ** 2
+    gdist2 = _truncate(gdist, radius) ** 2
+    sdist2 = _truncate(sdist, radius) ** 2
+    # Weights are relative to the nearest neighbour, so that points far
+    # from every station do not underflow to all zero weights
+    gdist2 = gdist2 - gdist2[:, :1]
+    sdist2 = sdist2 - sdist2[:, :1]
+    grid = np.zeros((len(gidx), *values.shape[1:]))
+    analysis = np.zeros_like(values)
+    residual = values
+    for i in range(passes):
+        scale = kappa if i == 0 else kappa * gamma
+        grid += _weighted(np.exp(-gdist2 / scale), gidx, residual)
+        if i + 1 < passes:
+            analysis += _weighted(np.exp(-sdist2 / scale), sidx, residual)
+            residual = values - analysis
+    return _grid(plan, grid)
+
+
+ENGINES = {"nearest": nearest, "idw": idw, "barnes": barnes}
+
+
+def analyze(plan, values, engine="nearest", **kwargs):
+    """Grid station values with the named engine."""
+    return ENGINES[engine](plan, values, **kwargs)
+
+
+def test_analyze():
+    """A constant field stays constant and stations are honoured."""
+    from regrid import StationPlan
+
+    lons = np.array([0.0, 1.0, 0.0, 1.0, 0.5])
+    lats = np.array([0.0, 0.0, 1.0, 1.0, 0.5])
+    xi, yi = np.meshgrid(np.arange(0, 1.01, 0.25), np.arange(0, 1.01, 0.25))
+    plan = StationPlan(lons, lats, xi, yi)
+    for engine in ENGINES:
+        res = analyze(plan, np.full(5, 7.0), engine)
+        assert res.shape == xi.shape
+        np.testing.assert_allclose(res, 7.0)
+    vals = np.column_stack((np.arange(5.0), np.arange(5.0) * 2))
+    res = analyze(plan, vals, "idw")
+    assert res.shape == (2, *xi.shape)
+    np.testing.assert_allclose(res[0, 2, 2], 4.0)
+    np.testing.assert_allclose(res[1], res[0] * 2)
+    res = analyze(plan, vals[:, 0], "barnes", passes=3)
+    assert abs(res[2, 2] - 4.0) < 1.0
+    assert np.mean(plan.neighbours(16, True)[0][:, 1]) == spacing(plan)
+
+
+def test_barnes_reuses_neighbours():
+    """A second Barnes analysis of a plan makes no new KD-tree query."""
+    from regrid import StationPlan
+
+    rng = np.random.default_rng(0)
+    xi, yi = np.meshgrid(np.arange(0, 1.01, 0.1), np.arange(0, 1.01, 0.1))
+    plan = StationPlan(rng.random(30), rng.random(30), xi, yi)
+    queries = []
+
+    class Tree:
+        n = plan.tree.n
+        data = plan.tree.data
+
+        def query(self, points, k=1):
+            queries.append((len(points), k))
+            return tree.query(points, k=k)
+
+    tree, plan.tree = plan.tree, Tree()
+    for _ in range(3):
+        barnes(plan, rng.random(30))
+    assert queries == [(xi.size, 16), (30, 16)]
@@ -0,0 +1,164 @@
+"""Archive observation queries with optional prefetching over a time range.
+
+In archive mode each analysis needs the observations within 30 minutes of
+its timestamp, so consecutive 5 minute analyses mostly re-read the same
+rows.  A backfill can instead prefetch a whole range with one query per
+source, optionally cached as Parquet, and each timestep then slices its
+window from the time sorted table.
+"""
+
+import os
+from datetime import timedelta
+
+import pandas as pd
+from dbpool import get_sqlalchemy_conn
+from pyiem.database import sql_helper
+from pyiem.util import logger
+
+LOG = logger()
+WINDOW = timedelta(minutes=30)
+# database and query for each archive source, returning a `valid` column
+QUERIES = {
+    "asos": (
+        "asos",
+        """
+    SELECT c.valid, ST_x(geom) as lon, ST_y(geom) as lat,
+    tmpf, dwpf, sknt, drct, vsby
+    from alldata c JOIN stations t on
+    (c.station = t.id)
+    WHERE c.valid >= :sts and c.valid < :ets and
+    t.network in ('IA_ASOS', 'AWOS', 'MN_ASOS', 'WI_ASOS', 'IL_ASOS',
+    'MO_ASOS', 'NE_ASOS', 'KS_ASOS', 'SD_ASOS') and sknt is not null
+    and drct is not null and tmpf is not null and dwpf is not null
+    and vsby is not null
+    """,
+    ),
+    "rwis": (
+        "rwis",
+        """
+    SELECT valid, station, tfs0 as tsf0
+    from alldata WHERE valid >= :sts and valid < :ets and
+    tfs0 >= -50 and tfs0 < 150
+    """,
+    ),
+    # c800 is kilo calorie per meter squared per hour
+    "isuag": (
+        "isuag",
+        """
+    SELECT valid, station, c800 * 1.162 as srad
+    from hourly
+    WHERE valid >= :sts and valid < :ets and c800 >= 0
+    """,
+    ),
+    # Not fully certain on this unit, but it appears to be ok
+    "isusm": (
+        "isuag",
+        """
+    SELECT valid, station, slrkj_tot_qc * 1000. / 3600. as srad
+    from sm_hourly
+    WHERE valid >= :sts and valid < :ets and slrkj_tot_qc >= 0
+    """,
+    ),
+}
+# Prefetched tables, keyed by source
+_TABLES = {}
+
+
+class ObsTable:
+    """Observations for a time range, sorted by time for window slicing."""
+
+    def __init__(self, df, sts, ets):
+        df = df.assign(valid=pd.to_datetime(df["valid"], utc=True))
+        self.df = df.sort_values("valid", kind="stable").reset_index(drop=True)
+        self.times = pd.DatetimeIndex(self.df["valid"])
+        self.sts = sts
+        self.ets = ets
+
+    def covers(self, sts, ets):
+        """Does this table hold every observation from sts to ets?"""
+        return self.sts <= sts and ets <= self.ets
+
+    def window(self, sts, ets):
+        """Return the observations with sts <= valid < ets."""
+        i0, i1 = self.times.searchsorted(
+            [pd.Timestamp(sts), pd.Timestamp(ets)], side="left"
+        )
+        return self.df.iloc[i0:i1].reset_index(drop=True)
+
+
+def fetch(source, sts, ets):
+    """Query the observations for this source with sts <= valid < ets."""
+    dbname, sql = QUERIES[source]
+    with get_sqlalchemy_conn(dbname) as conn:
+        return pd.read_sql(
+            sql_helper(sql),
+            conn,
+            params={"sts": sts, "ets": ets},
+            index_col=None,
+        )
+
+
+def prefetch(source, sts, ets, cachedir=None):
+    """Prefetch this source for analyses from sts through ets.
+
+    Args:
+      source (str): key of QUERIES
+      sts (datetime): first analysis time
+      ets (datetime): last analysis time
+      cachedir (str,optional): read/write the table as Parquet here
+    """
+    sts = sts - WINDOW
+    ets = ets + WINDOW
+    fn = None
+    if cachedir is not None:
+        fn = os.path.join(
+            cachedir, f"{source}_{sts:%Y%m%d%H%M}_{ets:%Y%m%d%H%M}.parquet"
+        )
+    if fn is not None and os.path.isfile(fn):
+        df = pd.read_parquet(fn)
+    else:
+        df = fetch(source, sts, ets)
+        if fn is not None:
+            try:
+                os.makedirs(cachedir, exist_ok=True)
+                # Write to a temp file first so others never see a partial
+                # table
+                tmpfn = f"{fn}.{os.getpid()}.tmp"
+                df.to_parquet(tmpfn)
+                os.replace(tmpfn, fn)
+            except OSError as exp:
+                LOG.warning("Failed to cache obs table %s: %s", fn, exp)
+    LOG.info(
+        "Prefetched %s rows of %s %s->%s", len(df.index), source, sts, ets
+    )
+    _TABLES[source] = ObsTable(df, sts, ets)
+
+
+def prefetch_all(sts, ets, cachedir=None):
+    """Prefetch every source the analyses from sts through ets need."""
+    for source in ["asos", "rwis"]:
+        prefetch(source, sts, ets, cachedir)
+    # srad switched networks on 1 Jan 2014
+    if sts.year < 2014:
+        prefetch("isuag", sts, ets, cachedir)
+    if ets.year >= 2014:
+        prefetch("isusm", sts, ets, cachedir)
+
+
+def clear():
+    """Drop all prefetched tables."""
+    _TABLES.clear()
+
+
+def archive_obs(source, valid):
+    """Return the observations within 30 minutes of valid.
+
+    A prefetched table is used when it covers the window, otherwise the
+    database is queried.
+    """
+    sts = valid - WINDOW
+    ets = valid + WINDOW
+    table = _TABLES.get(source)
+    if table is not None and table.covers(sts, ets):
+        return table.window(sts, ets)
+    return fetch(source, sts, ets)
@@ -0,0 +1,211 @@
+"""Nearest neighbour regridding onto the analysis grid.
+
+Building a KD-tree over a full model grid is expensive, so the source grid
+to analysis grid nearest neighbour index is computed once per source grid
+definition and cached on disk as a `.npy` file.  Regridding a field is then
+a single fancy-index gather.  Station observations are handled the same
+way by a StationPlan, built once per station set.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from pyiem.util import logger
+from scipy.spatial import cKDTree
+
+LOG = logger()
+CACHEDIR = os.environ.get("IEMGRID_CACHEDIR", "/mesonet/tmp/iemgrid")
+# In-process cache of computed indices, keyed by grid_key()
+_INDICES = {}
+# Recently used StationPlans, keyed by grid_key(), least recent first
+_PLANS = OrderedDict()
+_PLANS_SIZE = int(os.environ.get("IEMGRID_PLANS", 16))
+# Only this many of the most recent plans keep their k nearest neighbours,
+# which take tens of MB each
+_NEIGHBOUR_PLANS = int(os.environ.get("IEMGRID_NEIGHBOUR_PLANS", 4))
+# (k, to stations?) entries a plan keeps, Barnes uses two and the third
+# spares them when another engine or k runs on the same stations
+_NEIGHBOURS_SIZE = 3
+# Guards _PLANS, as the source stages get their plans from several threads
+_PLANS_LOCK = threading.Lock()
+# Target grid points shared by every plan, keyed by grid_key()
+_TARGETS = {}
+
+
+def grid_key(lons, lats, xi, yi):
+    """Compute a hash key for this source -> target grid combination."""
+    digest = hashlib.sha1()
+    for arr in (lons, lats, xi, yi):
+        arr = np.ascontiguousarray(arr, dtype=np.float64)
+        digest.update(str(arr.shape).encode("ascii"))
+        digest.update(arr.tobytes())
+    return digest.hexdigest()
+
+
+def build_index(lons, lats, xi, yi):
+    """Compute the flat source index nearest each target point."""
+    tree = cKDTree(np.column_stack((np.ravel(lons), np.ravel(lats))))
+    _, idx = tree.query(np.column_stack((np.ravel(xi), np.ravel(yi))))
+    return idx.astype(np.int32).reshape(np.shape(xi))
+
+
+def get_index(lons, lats, xi, yi, cachedir=None):
+    """Get the nearest neighbour index, building and caching it if needed.
+
+    Args:
+      lons (array): source grid longitudes
+      lats (array): source grid latitudes
+      xi (array): target grid longitudes
+      yi (array): target grid latitudes
+      cachedir (str,optional): where to store the index, defaults to CACHEDIR
+
+    Returns:
+      array of flat source indices with the shape of `xi`
+    """
+    key = grid_key(lons, lats, xi, yi)
+    if key in _INDICES:
+        return _INDICES[key]
+    cachedir = CACHEDIR if cachedir is None else cachedir
+    fn = os.path.join(cachedir, f"regrid_{key}.npy")
+    if os.path.isfile(fn):
+        idx = np.load(fn, mmap_mode="r")
+        _INDICES[key] = idx
+        return idx
+    LOG.info("Building regrid index %s", key)
+    idx = build_index(lons, lats, xi, yi)
+    try:
+        os.makedirs(cachedir, exist_ok=True)
+        # Write to a temp file first so others never see a partial index
+        tmpfn = f"{fn}.{os.getpid()}.tmp"
+        with open(tmpfn, "wb") as fh:
+            np.save(fh, idx)
+        os.replace(tmpfn, fn)
+    except OSError as exp:
+        LOG.warning("Failed to cache regrid index %s: %s", fn, exp)
+    _INDICES[key] = idx
+    return idx
+
+
+def regrid(vals, idx):
+    """Regrid source values onto the target grid using the given index."""
+    return np.asarray(vals).ravel()[idx]
+
+
+class StationPlan:
+    """Nearest station for each target grid point, for one station set.
+
+    The KD-tree is built and queried once, after which any number of
+    variables observed at these stations are gridded with one gather.
+
+    Args:
+      lons (array): station longitudes
+      lats (array): station latitudes
+      xi (array): target grid longitudes
+      yi (array): target grid latitudes
+    """
+
+    def __init__(self, lons, lats, xi, yi):
+        self.shape = np.shape(xi)
+        self.tree = cKDTree(np.column_stack((lons, lats)))
+        self.points = target_points(xi, yi)
+        _, self.index = self.tree.query(self.points)
+        # k nearest (distances, indices), keyed by (k, to stations?), least
+        # recently used first
+        self._neighbours = OrderedDict()
+        self._lock = threading.Lock()
+
+    def neighbours(self, k, stations=False):
+        """The k nearest stations to each grid point, or to each station.
+
+        Returns:
+          (distances, indices) arrays of shape (n_points, k)
+        """
+        k = min(k, self.tree.n)
+        key = (k, stations)
+        with self._lock:
+            if key in self._neighbours:
+                self._neighbours.move_to_end(key)
+                return self._neighbours[key]
+            points = self.tree.data if stations else self.points
+            dist, idx = self.tree.query(points, k=k)
+            if k == 1:
+                dist = dist[:, None]
+                idx = idx[:, None]
+            self._neighbours[key] = (dist, idx)
+            while len(self._neighbours) > _NEIGHBOURS_SIZE:
+                self._neighbours.popitem(last=False)
+        return dist, idx
+
+    def drop_neighbours(self):
+        """Free the cached k nearest neighbours."""
+        with self._lock:
+            self._neighbours.clear()
+
+    def gather(self, values):
+        """Grid station values.
+
+        Args:
+          values (array): (n_stations,) or stacked (n_stations, n_vars)
+
+        Returns:
+          grid of the target shape, or (n_vars, *shape) for stacked values
+        """
+        values = np.asarray(values)
+        out = values[self.index]
+        if values.ndim == 1:
+            return out.reshape(self.shape)
+        return np.moveaxis(out, -1, 0).reshape((-1, *self.shape))
+
+
+def target_points(xi, yi):
+    """Return the (n, 2) target grid points, shared between plans."""
+    key = grid_key([], [], xi, yi)
+    if key not in _TARGETS:
+        points = np.column_stack((np.ravel(xi), np.ravel(yi)))
+        points.setflags(write=False)
+        # there is one analysis grid, so only keep the latest
+        _TARGETS.clear()
+        _TARGETS[key] = points
+    return _TARGETS[key]
+
+
+def get_plan(lons, lats, xi, yi):
+    """Get the StationPlan for these stations, reusing recent plans."""
+    key = grid_key(lons, lats, xi, yi)
+    with _PLANS_LOCK:
+        plan = _PLANS.get(key)
+        if plan is not None:
+            _PLANS.move_to_end(key)
+            return plan
+    # built outside of the lock, a racing thread may build the same plan
+    plan = StationPlan(lons, lats, xi, yi)
+    with _PLANS_LOCK:
+        while _PLANS and len(_PLANS) >= _PLANS_SIZE:
+            _PLANS.popitem(last=False)
+        _PLANS[key] = plan
+        stale = list(_PLANS.values())[: len(_PLANS) - _NEIGHBOUR_PLANS]
+    for other in stale:
+        other.drop_neighbours()
+    return plan
+
+
+def test_plans(monkeypatch):
+    """Plans share their target points and drop old neighbours."""
+    monkeypatch.setitem(globals(), "_PLANS", OrderedDict())
+    monkeypatch.setitem(globals(), "_PLANS_SIZE", 3)
+    monkeypatch.setitem(globals(), "_NEIGHBOUR_PLANS", 1)
+    xi, yi = np.meshgrid(np.arange(4.0), np.arange(3.0))
+    plans = []
+    for i in range(4):
+        plan = get_plan([0.0, 2.0 + i, 3.0], [0.0, 1.0, 2.0], xi, yi)
+        for k in (1, 2, 3):
+            plan.neighbours(k)
+        assert len(plan._neighbours) == _NEIGHBOURS_SIZE
+        plans.append(plan)
+    assert len(_PLANS) == 3 and plans[0] not in _PLANS.values()
+    assert plans[3].points is plans[1].points
+    assert not plans[2]._neighbours and plans[3]._neighbours
+    assert get_plan([0.0, 3.0, 3.0], [0.0, 1.0, 2.0], xi, yi) is plans[1]
@@ -0,0 +1,168 @@
+"""Cache of analysis grids keyed by a fingerprint of their inputs.
+
+Some grids change far less often than the analysis runs: snow depth once
+a day, solar radiation once an hour and the warnings whenever a product is
+issued or expires.  A stage computes a cheap fingerprint of its inputs and
+only queries and grids them when the fingerprint has not been seen within
+its time to live.
+
+Entries are held in memory, least recently used first out once there are
+more than `maxsize`.  With a cache directory they are also written there
+as `.npz` files, so a fresh process, such as the next cron run, reuses
+them.  The on-disk entries of a stage are trimmed to `maxsize` as well.
+Stages whose grids only make sense within the process, such as the wawa
+bitsets with their runtime assigned bits, are cached with persist=False.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from pyiem.util import logger
+
+LOG = logger()
+CACHEDIR = os.environ.get("IEMGRID_RESULT_CACHEDIR")
+
+
+def digest(fingerprint):
+    """Return the hex digest of this fingerprint's repr."""
+    return hashlib.sha1(repr(fingerprint).encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """Grids of each stage, keyed by their input fingerprint.
+
+    Args:
+      maxsize (int): entries kept in memory, and on disk per stage, with 0
+        disabling the cache
+      cachedir (str,optional): also keep entries in this directory
+    """
+
+    def __init__(self, maxsize=16, cachedir=None):
+        self.maxsize = maxsize
+        self.cachedir = cachedir
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _filename(self, name, key):
+        return os.path.join(self.cachedir, f"{name}_{key}.npz")
+
+    def get(self, name, fingerprint, ttl, persist=True):
+        """Return copies of the cached grids, None when missing or stale.
+
+        Args:
+          name (str): the stage
+          fingerprint (object): its inputs, compared by repr
+          ttl (float): seconds an entry stays fresh
+          persist (bool): also look in the cache directory
+        """
+        if self.maxsize <= 0:
+            return None
+        key = (name, digest(fingerprint))
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] <= ttl:
+                self._entries.move_to_end(key)
+                return {k: v.copy() for k, v in entry[1].items()}
+        if self.cachedir is None or not persist:
+            return None
+        fn = self._filename(*key)
+        try:
+            if now - os.path.getmtime(fn) > ttl:
+                return None
+            with np.load(fn) as npz:
+                grids = {k: npz[k] for k in npz.files}
+        except (OSError, ValueError) as exp:
+            if os.path.exists(fn):
+                LOG.warning("Failed to read %s: %s", fn, exp)
+            return None
+        self._remember(key, os.path.getmtime(fn), grids)
+        return {k: v.copy() for k, v in grids.items()}
+
+    def _remember(self, key, stored, grids):
+        with self._lock:
+            self._entries[key] = (stored, grids)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def put(self, name, fingerprint, grids, persist=True):
+        """Cache these grids of a stage, persist to also write them to disk."""
+        if self.maxsize <= 0:
+            return
+        key = (name, digest(fingerprint))
+        grids = {k: np.array(v) for k, v in grids.items()}
+        self._remember(key, time.time(), grids)
+        if self.cachedir is None or not persist:
+            return
+        fn = self._filename(*key)
+        tmpfn = f"{fn}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.cachedir, exist_ok=True)
+            with open(tmpfn, "wb") as fh:
+                np.savez(fh, **grids)
+            os.replace(tmpfn, fn)
+            self._trim(name)
+        except OSError as exp:
+            LOG.warning("Failed to cache %s: %s", fn, exp)
+
+    def _trim(self, name):
+        """Remove the stage's oldest files beyond maxsize."""
+        files = [
+            os.path.join(self.cachedir, fn)
+            for fn in os.listdir(self.cachedir)
+            if fn.startswith(f"{name}_") and fn.endswith(".npz")
+        ]
+        files.sort(key=os.path.getmtime)
+        for fn in files[: -self.maxsize]:
+            os.unlink(fn)
+
+    def cached(self, name, fingerprint, ttl, func, persist=True):
+        """Return the cached grids, else compute them with func() and cache.
+
+        Args:
+          name (str): the stage
+          fingerprint (object): its inputs, compared by repr
+          ttl (float): seconds an entry stays fresh
+          func (callable): returns the dict of grids
+          persist (bool): also cache the grids in the cache directory
+        """
+        grids = self.get(name, fingerprint, ttl, persist)
+        if grids is not None:
+            LOG.info("%s unchanged, reusing cached grids", name)
+            return grids
+        grids = func()
+        self.put(name, fingerprint, grids, persist)
+        return grids
+
+
+def test_cache(tmp_path):
+    """Entries expire, are evicted and outlive the process on disk."""
+    cache = ResultCache(2, str(tmp_path))
+    calls = []
+
+    def _compute(value):
+        calls.append(value)
+        return {"snwd": np.full((2, 2), value)}
+
+    for day in (1, 1, 2, 3, 1):
+        res = cache.cached(
+            "snowd", ("2024-01", day), 3600, lambda d=day: _compute(d)
+        )
+        assert res["snwd"][0, 0] == day
+    # day 1 was evicted, by size, before its last use
+    assert calls == [1, 2, 3, 1]
+    assert len(list(tmp_path.glob("snowd_*.npz"))) == 2
+    # a new process finds the disk entries, unless too old
+    fresh = ResultCache(2, str(tmp_path))
+    assert fresh.get("snowd", ("2024-01", 3), 3600)["snwd"][0, 0] == 3
+    assert fresh.get("snowd", ("2024-01", 3), -1) is None
+    assert ResultCache(0).cached("x", 1, 60, lambda: {"a": 1}) == {"a": 1}
+    # grids not persisted stay within the process
+    cache.cached("wwa", 1, 60, lambda: {"wawa": np.ones(2)}, persist=False)
+    assert not list(tmp_path.glob("wwa_*.npz"))
+    assert cache.get("wwa", 1, 60, persist=False)["wawa"].sum() == 2
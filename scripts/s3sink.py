@@ -0,0 +1,236 @@
+"""Stream serialized output through compression into an S3 multipart upload.
+
+The gridders write their JSON documents into an S3Sink, which compresses
+the text as it arrives and uploads it in parts, so the full document never
+needs to land on local disk before being uploaded.
+"""
+
+import gzip
+import os
+import time
+from functools import lru_cache
+
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+from pyiem.util import logger
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+LOG = logger()
+BUCKET = "intrans-weather-feed"
+# S3 requires parts, except the last one, to be at least 5 MiB
+PART_SIZE = 8 * 1024 * 1024
+EXTENSIONS = {"gzip": ".gz", "zstd": ".zst"}
+CONTENT_TYPES = {"gzip": "application/gzip", "zstd": "application/zstd"}
+
+
+@lru_cache(maxsize=1)
+def get_s3_client():
+    """Return the S3 client for our upload profile, created once."""
+    session = boto3.Session(profile_name="ntrans")
+    return session.client("s3")
+
+
+class _GzipCompressor:
+    """Minimal streaming gzip compressor with the zstandard interface."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.gz = gzip.GzipFile(fileobj=self, mode="wb", mtime=0)
+
+    def write(self, data):
+        """Collect compressed bytes from GzipFile."""
+        self.buffer += data
+        return len(data)
+
+    def _take(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+    def compress(self, data):
+        """Compress data, returning whatever output is ready."""
+        self.gz.write(data)
+        return self._take()
+
+    def flush(self):
+        """Finish the stream, returning the remaining output."""
+        self.gz.close()
+        return self._take()
+
+
+def get_compressor(compression):
+    """Return a streaming compressor for gzip or zstd."""
+    if compression == "gzip":
+        return _GzipCompressor()
+    if compression == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd compression requires zstandard")
+        return zstandard.ZstdCompressor().compressobj()
+    raise ValueError(f"Unknown compression {compression}")
+
+
+class S3Sink:
+    """Text file-like object that streams into a S3 multipart upload.
+
+    Args:
+      name (str): object name, the compression extension is appended
+      compression (str): `gzip` or `zstd`
+      client (botocore client,optional): S3 client, defaults to ours
+      bucket (str,optional): S3 bucket name
+      localfn (str,optional): also write the compressed bytes here
+      part_size (int,optional): bytes buffered per uploaded part
+      retries (int,optional): attempts made for each part
+      backoff (float,optional): initial retry delay in seconds, doubling
+    """
+
+    def __init__(
+        self,
+        name,
+        compression="gzip",
+        client=None,
+        bucket=BUCKET,
+        localfn=None,
+        part_size=PART_SIZE,
+        retries=5,
+        backoff=1.0,
+    ):
+        self.compressor = get_compressor(compression)
+        self.client = get_s3_client() if client is None else client
+        self.bucket = bucket
+        self.key = f"{name}{EXTENSIONS[compression]}"
+        self.part_size = part_size
+        self.retries = retries
+        self.backoff = backoff
+        self.buffer = bytearray()
+        # compressed bytes written
+        self.nbytes = 0
+        self.parts = []
+        self.local = None if localfn is None else open(localfn, "wb")
+        LOG.info("Streaming to S3 as %s", self.key)
+        resp = self.client.create_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            ContentType=CONTENT_TYPES[compression],
+        )
+        self.upload_id = resp["UploadId"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, text):
+        """Compress and buffer this text, uploading full parts."""
+        self._push(self.compressor.compress(text.encode("utf-8")))
+        return len(text)
+
+    def _push(self, data):
+        self.nbytes += len(data)
+        if self.local is not None:
+            self.local.write(data)
+        self.buffer += data
+        if len(self.buffer) >= self.part_size:
+            self._upload_part()
+
+    def _upload_part(self):
+        partnum = len(self.parts) + 1
+        body = bytes(self.buffer)
+        for attempt in range(self.retries):
+            try:
+                resp = self.client.upload_part(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self.upload_id,
+                    PartNumber=partnum,
+                    Body=body,
+                )
+                break
+            except (BotoCoreError, ClientError) as exp:
+                if attempt == self.retries - 1:
+                    raise
+                delay = self.backoff * 2**attempt
+                LOG.warning(
+                    "Part %s of %s failed: %s, retry in %.1fs",
+                    partnum,
+                    self.key,
+                    exp,
+                    delay,
+                )
+                time.sleep(delay)
+        self.parts.append({"ETag": resp["ETag"], "PartNumber": partnum})
+        self.buffer.clear()
+
+    def close(self):
+        """Flush the compressor and complete the upload, else abort it."""
+        try:
+            self._push(self.compressor.flush())
+            # the last part is allowed to be small, but there must be one
+            if self.buffer or not self.parts:
+                self._upload_part()
+            if self.local is not None:
+                self.local.close()
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": self.parts},
+            )
+        except Exception:
+            # orphaned parts are billed until aborted
+            try:
+                self.abort()
+            except Exception as exp:
+                LOG.warning("Failed to abort upload of %s: %s", self.key, exp)
+            raise
+
+    def abort(self):
+        """Abort the upload, leaving nothing behind on S3."""
+        LOG.warning("Aborting upload of %s", self.key)
+        if self.local is not None:
+            self.local.close()
+        self.client.abort_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+        )
+
+
+def test_s3sink(tmp_path):
+    """Test a multipart streaming upload against moto."""
+    import pytest
+    from botocore.exceptions import ClientError
+
+    moto = pytest.importorskip("moto")
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        # random hex compresses poorly, so we get more than one part
+        text = os.urandom(6 * 1024 * 1024).hex()
+        localfn = tmp_path / "test.json.gz"
+        with S3Sink(
+            "test.json",
+            client=client,
+            localfn=localfn,
+            part_size=5 * 1024 * 1024,
+        ) as sink:
+            for i in range(0, len(text), 100_000):
+                sink.write(text[i : i + 100_000])
+        assert len(sink.parts) > 1
+        obj = client.get_object(Bucket=BUCKET, Key="test.json.gz")
+        payload = obj["Body"].read()
+        assert gzip.decompress(payload).decode("utf-8") == text
+        assert localfn.read_bytes() == payload
+        # a failed completion aborts, leaving no parts behind
+        sink = S3Sink("fail.json", client=client, part_size=5 * 1024 * 1024)
+        sink.write(text[:1000])
+        sink.parts.append({"PartNumber": 99, "ETag": "bogus"})
+        with pytest.raises(ClientError):
+            sink.close()
+        uploads = client.list_multipart_uploads(Bucket=BUCKET)
+        assert not uploads.get("Uploads")
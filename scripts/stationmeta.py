@@ -0,0 +1,75 @@
+"""Cached station metadata, for locating archive observations.
+
+The station locations for a list of networks are loaded once per process
+and optionally snapshotted to disk as Parquet, both honouring a TTL.
+"""
+
+import os
+import time
+
+import pandas as pd
+from pyiem.network import Table as NetworkTable
+from pyiem.util import logger
+
+LOG = logger()
+# Snapshots are only written when this is set
+CACHEDIR = os.environ.get("IEMGRID_CACHEDIR")
+TTL = 86400
+# In-process cache of (load time, DataFrame), keyed by sorted networks
+_CACHE = {}
+
+
+def load_stations(networks):
+    """Load the station id, lon and lat for these networks."""
+    nt = NetworkTable(list(networks))
+    return pd.DataFrame(
+        [(sid, meta["lon"], meta["lat"]) for sid, meta in nt.sts.items()],
+        columns=["station", "lon", "lat"],
+    )
+
+
+def get_stations(networks, cachedir=None, ttl=TTL):
+    """Return the stations for these networks, from cache when fresh.
+
+    Args:
+      networks (list): network identifiers
+      cachedir (str,optional): snapshot directory, defaults to CACHEDIR
+      ttl (int,optional): seconds a cached copy remains valid
+    """
+    key = tuple(sorted(networks))
+    now = time.time()
+    if key in _CACHE and now - _CACHE[key][0] < ttl:
+        return _CACHE[key][1]
+    cachedir = CACHEDIR if cachedir is None else cachedir
+    fn = None
+    if cachedir is not None:
+        fn = os.path.join(cachedir, f"stations_{'_'.join(key)}.parquet")
+    if fn is not None and os.path.isfile(fn):
+        mtime = os.path.getmtime(fn)
+        if now - mtime < ttl:
+            _CACHE[key] = (mtime, pd.read_parquet(fn))
+            return _CACHE[key][1]
+    df = load_stations(key).drop_duplicates("station")
+    if fn is not None:
+        try:
+            os.makedirs(cachedir, exist_ok=True)
+            tmpfn = f"{fn}.{os.getpid()}.tmp"
+            df.to_parquet(tmpfn)
+            os.replace(tmpfn, fn)
+        except OSError as exp:
+            LOG.warning("Failed to snapshot %s: %s", fn, exp)
+    _CACHE[key] = (now, df)
+    return df
+
+
+def attach_latlon(df, networks, cachedir=None):
+    """Merge the station lon and lat onto df, dropping unknown stations."""
+    stations = get_stations(networks, cachedir)
+    res = df.merge(stations, on="station", how="inner")
+    if len(res.index) < len(df.index):
+        LOG.info(
+            "Dropped %s obs from stations not in %s",
+            len(df.index) - len(res.index),
+            ",".join(networks),
+        )
+    return res
@@ -0,0 +1,195 @@
+"""Index of the analysis cells covered by each UGC.
+
+The UGC county and zone polygons rarely change, yet rasterizing them is
+the bulk of the wwa stage.  Each ugcs.gid is rasterized once, within the
+window of its bounds, and the covered cells kept in a compressed sparse
+row index: the flat cells of the i-th gid are
+`cells[indptr[i]:indptr[i + 1]]`.  The wawa grid is then a gather of the
+cells of the active (code, ugc gid) pairs, with no geometry involved.
+
+A changed geometry is a new ugcs row, so the count and largest gid of the
+rows within the grid identify the revision.  The index of each revision
+is built once and cached on disk as a `.npz` file, like the regrid index.
+"""
+
+import os
+
+import numpy as np
+import wawa
+from geopandas import GeoDataFrame
+from griddef import GRID
+from pyiem.database import sql_helper
+from pyiem.util import logger
+from rasterio import features
+from rasterio.transform import Affine
+from regrid import CACHEDIR
+
+LOG = logger()
+# In-process cache of UGCIndex, keyed by revision
+_INDICES = {}
+ENVELOPE = (
+    f"ST_MakeEnvelope({GRID.west}, {GRID.south}, {GRID.east}, "
+    f"{GRID.north}, 4326)"
+)
+
+
+class UGCIndex:
+    """Flat analysis cells covered by each ugcs.gid.
+
+    Args:
+      gids (array): sorted ugcs.gid values
+      indptr (array): offsets into cells of each gid, one more than gids
+      cells (array): flat cell indices, gid - 1 of the analysis grid
+    """
+
+    def __init__(self, gids, indptr, cells):
+        self.gids = gids
+        self.indptr = indptr
+        self.cells = cells
+
+    def lookup(self, gids):
+        """Return the flat cells covered by any of these ugcs.gid values."""
+        gids = np.asarray(gids, dtype=self.gids.dtype)
+        pos = np.searchsorted(self.gids, gids)
+        found = pos < self.gids.size
+        found[found] = self.gids[pos[found]] == gids[found]
+        if not found.all():
+            # zones outside of the grid are routinely active
+            LOG.debug("%s ugc gids not indexed", (~found).sum())
+        pos = pos[found]
+        if pos.size == 0:
+            return np.empty(0, dtype=self.cells.dtype)
+        return np.concatenate(
+            [self.cells[self.indptr[i] : self.indptr[i + 1]] for i in pos]
+        )
+
+    def save(self, fn):
+        """Write the index, atomically, to this .npz file."""
+        tmpfn = f"{fn}.{os.getpid()}.tmp"
+        with open(tmpfn, "wb") as fh:
+            np.savez(fh, gids=self.gids, indptr=self.indptr, cells=self.cells)
+        os.replace(tmpfn, fn)
+
+    @classmethod
+    def load(cls, fn):
+        """Read the index from this .npz file."""
+        with np.load(fn) as npz:
+            return cls(npz["gids"], npz["indptr"], npz["cells"])
+
+
+def geometry_cells(geom, grid=GRID):
+    """Return the flat cells whose center is within this geometry."""
+    west, south, east, north = geom.bounds
+    col0 = max(int(np.floor((west - grid.west) / grid.dx)), 0)
+    col1 = min(int(np.ceil((east - grid.west) / grid.dx)), grid.nx)
+    # rows of the north up raster window
+    row0 = max(int(np.floor((grid.north - north) / grid.dy)), 0)
+    row1 = min(int(np.ceil((grid.north - south) / grid.dy)), grid.ny)
+    if col1 <= col0 or row1 <= row0:
+        return np.empty(0, dtype=np.int32)
+    arr = features.rasterize(
+        shapes=[(geom, 1)],
+        fill=0,
+        transform=grid.transform * Affine.translation(col0, row0),
+        out_shape=(row1 - row0, col1 - col0),
+    )
+    rows, cols = np.nonzero(arr)
+    # rasterize starts in the upper left, our grids the lower left
+    rows = grid.ny - 1 - (rows + row0)
+    return (rows * grid.nx + cols + col0).astype(np.int32)
+
+
+def revision(conn):
+    """Return (count, largest gid) of the ugcs rows within the grid."""
+    return tuple(
+        conn.execute(
+            sql_helper(
+                "SELECT count(*), max(gid) from ugcs WHERE geom && {env}",
+                env=ENVELOPE,
+            )
+        ).one()
+    )
+
+
+def build_index(conn):
+    """Rasterize every ugcs row within the grid into a UGCIndex."""
+    df = GeoDataFrame.from_postgis(
+        sql_helper(
+            "SELECT gid, geom from ugcs WHERE geom && {env} ORDER by gid",
+            env=ENVELOPE,
+        ),
+        conn,
+        index_col=None,
+    )
+    parts = [geometry_cells(geom) for geom in df.geometry]
+    indptr = np.zeros(len(parts) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([part.size for part in parts])
+    cells = np.concatenate(parts) if parts else np.empty(0, dtype=np.int32)
+    return UGCIndex(df["gid"].to_numpy(np.int64), indptr, cells)
+
+
+def get_index(conn, cachedir=None):
+    """Get the UGCIndex of the current revision, building it if needed.
+
+    Args:
+      conn: connection to the postgis database
+      cachedir (str,optional): where to store the index, defaults to the
+        regrid CACHEDIR
+
+    Returns:
+      UGCIndex
+    """
+    rev = revision(conn)
+    if rev in _INDICES:
+        return _INDICES[rev]
+    cachedir = CACHEDIR if cachedir is None else cachedir
+    fn = os.path.join(cachedir, f"ugcindex_{rev[0]}_{rev[1]}.npz")
+    if os.path.isfile(fn):
+        index = UGCIndex.load(fn)
+        _INDICES[rev] = index
+        return index
+    LOG.info("Building ugc index %s", rev)
+    index = build_index(conn)
+    try:
+        os.makedirs(cachedir, exist_ok=True)
+        index.save(fn)
+    except OSError as exp:
+        LOG.warning("Failed to cache ugc index %s: %s", fn, exp)
+    _INDICES[rev] = index
+    return index
+
+
+def rasterize(index, codes, gids):
+    """Return the wawa grid of these active warnings.
+
+    Args:
+      index (UGCIndex): the ugc index
+      codes (array): VTEC code of each active warning
+      gids (array): ugcs.gid of each active warning
+
+    Returns:
+      wawa bitset array with the analysis grid shape
+    """
+    grid = GRID.zeros(wawa.DTYPE)
+    flat = grid.reshape(-1)
+    codes = np.asarray(codes)
+    gids = np.asarray(gids)
+    for code in np.unique(codes):
+        flat[index.lookup(gids[codes == code])] |= wawa.code_bit(code)
+    return grid
+
+
+def test_lookup(tmp_path):
+    """Cells of several gids are gathered, unknown gids skipped."""
+    index = UGCIndex(
+        np.array([3, 7, 9]),
+        np.array([0, 2, 2, 5]),
+        np.array([10, 11, 20, 21, 22], dtype=np.int32),
+    )
+    index.save(str(tmp_path / "ugc.npz"))
+    index = UGCIndex.load(str(tmp_path / "ugc.npz"))
+    assert index.lookup([9, 3, 5, 100]).tolist() == [20, 21, 22, 10, 11]
+    assert index.lookup([7]).size == 0
+    grid = rasterize(index, ["TO.W", "SV.W", "TO.W"], [3, 9, 9]).reshape(-1)
+    tornado, severe = wawa.code_bit("TO.W"), wawa.code_bit("SV.W")
+    assert grid[[10, 20, 12]].tolist() == [tornado, tornado | severe, 0]
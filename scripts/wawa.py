@@ -0,0 +1,163 @@
+"""Bitset encoding of the NWS watch, warning, advisory (wawa) grid.
+
+Each VTEC phenomena.significance code is assigned a bit, in the stable order
+of WWA_CODES then RESERVED_CODES, and a grid cell holds the bitwise OR of
+its active codes.  The bitset is only converted into the list of codes when
+serialized.
+
+Only a code outside of both is assigned one of the few spare bits, in
+whichever order a process sees them, so bitsets kept beyond the process
+are saved along with their code_table() and decoded with it.
+"""
+
+import json
+from functools import lru_cache
+
+import numpy as np
+from pyiem.util import logger
+
+LOG = logger()
+DTYPE = np.uint64
+# Legacy integer codes of the VTEC phenomena.significance we expect
+WWA_CODES = {
+    "AS.Y": 5,  # Air Stagnation Advisory
+    "EH.A": 6,  # Excessive Heat Watch
+    "EC.W": 50,  # Extreme Cold Warning
+    "FA.A": 51,  # Areal Flood Watch
+    "EH.W": 52,  # Excessive Heat Warning
+    "XH.W": 52,  # Excessive Heat Warning
+    "HT.Y": 53,  # Heat Advisory
+    "FZ.W": 54,  # Freeze Warning
+    "FR.Y": 55,  # Freeze Advisory
+    "FW.A": 56,  # Fire Weather Watch
+    "FW.W": 57,  # Fire Weather Warning
+    "FZ.A": 58,  # Freeze Watch
+    "HZ.W": 129,  # Hard Freeze Warning
+    "WS.A": 130,  # Winter Storm Watch
+    "BZ.A": 140,  # Blizzard Watch
+    "SV.A": 145,  # Severe Thunderstorm Watch
+    "TO.A": 146,  # Tornado Watch
+    "FL.A": 147,  # Flood Watch
+    "FL.S": 148,  # Flood Statement
+    "WC.A": 149,  # Wind Chill Watch
+    "FL.Y": 150,  # Flood Advisory
+    "HW.A": 167,  # High Wind Watch
+    "WC.W": 168,  # Wind Chill Warning
+    "FL.W": 169,  # Flood Warning
+    "BS.Y": 170,  # Blowing Snow Advisory
+    "WI.Y": 171,  # Wind Advisory
+    "WC.Y": 172,  # Wind Chill Advisory
+    "FA.W": 173,  # Areal Flood Warning
+    "FA.Y": 174,  # Areal Flood Advisory
+    "FF.A": 175,  # Flas Flood Advisory
+    "FF.W": 176,  # Flash Flood Warning
+    "FG.Y": 177,  # Fog Advisory
+    "HW.W": 224,  # High Wind Warning
+    "SN.Y": 225,  # Snow Advisory
+    "SB.Y": 226,  # Snow and Blowing Snow Advisory
+    "WW.Y": 227,  # Winter Weather Advisory
+    "SV.W": 228,  # Severe Thunderstorm Warning
+    "HS.W": 229,  # Heavy Snow Warning
+    "WS.W": 230,  # Winter Storm Warning
+    "ZF.Y": 231,  # Freezing Fog Advisory
+    "ZR.Y": 232,  # Freezing Rain Advisory
+    "BZ.W": 240,  # Blizzard Warning
+    "TO.W": 241,  # Tornado Warning
+    "IS.W": 242,  # Ice Storm Warning
+}
+
+# Further current codes, with their bits reserved after those of WWA_CODES
+RESERVED_CODES = [
+    "CW.Y",  # Cold Weather Advisory
+    "EC.A",  # Extreme Cold Watch
+    "XH.A",  # Extreme Heat Watch
+    "SQ.W",  # Snow Squall Warning
+    "DS.W",  # Dust Storm Warning
+    "DS.Y",  # Dust Advisory
+    "DU.Y",  # Blowing Dust Advisory
+    "EW.W",  # Extreme Wind Warning
+    "HZ.A",  # Hard Freeze Watch
+    "LE.A",  # Lake Effect Snow Watch
+    "LE.W",  # Lake Effect Snow Warning
+    "LE.Y",  # Lake Effect Snow Advisory
+    "LW.Y",  # Lake Wind Advisory
+    "SM.Y",  # Dense Smoke Advisory
+    "AF.Y",  # Ashfall Advisory
+    "FF.S",  # Flash Flood Statement
+    "HY.Y",  # Hydrologic Advisory
+]
+
+# Bit position for each code, unexpected codes are appended at runtime
+BITS = {code: i for i, code in enumerate([*WWA_CODES, *RESERVED_CODES])}
+
+
+def code_bit(code):
+    """Return the bitset value for this VTEC code."""
+    if code not in BITS:
+        if len(BITS) >= np.iinfo(DTYPE).bits:
+            raise ValueError(f"No wawa bits left for code {code}")
+        LOG.warning(
+            "Assigning wawa bit %s to unexpected code %s", len(BITS), code
+        )
+        BITS[code] = len(BITS)
+    return DTYPE(1 << BITS[code])
+
+
+def code_table():
+    """Return the codes in bit order, to be saved along with bitsets."""
+    return sorted(BITS, key=BITS.get)
+
+
+def bitset_codes(bitset, table=None):
+    """Return the list of codes set within this bitset.
+
+    Args:
+      bitset (int): the bitset
+      table (list,optional): the code_table() the bitset was encoded with,
+        defaults to that of this process
+    """
+    bitset = int(bitset)
+    if table is None:
+        return [code for code, i in BITS.items() if bitset & (1 << i)]
+    return [code for i, code in enumerate(table) if bitset & (1 << i)]
+
+
+def remap(bitsets, table, target):
+    """Re-encode bitsets encoded with one code table with another.
+
+    Args:
+      bitsets (array): the bitsets, encoded with table
+      table (list): their code table
+      target (list): the code table wanted, holding every code of table
+
+    Returns:
+      array of bitsets encoded with target
+    """
+    bitsets = np.asarray(bitsets, dtype=DTYPE)
+    if target[: len(table)] == table:
+        return bitsets
+    res = np.zeros_like(bitsets)
+    for i, code in enumerate(table):
+        bit = (bitsets >> DTYPE(i)) & DTYPE(1)
+        res |= bit << DTYPE(target.index(code))
+    return res
+
+
+@lru_cache(maxsize=4096)
+def bitset_json(bitset):
+    """Return the JSON list of codes for this bitset, as serialized."""
+    return json.dumps(bitset_codes(bitset) or [""])
+
+
+def test_code_table():
+    """Reserved codes have fixed bits, saved tables decode their bitsets."""
+    assert len(BITS) <= np.iinfo(DTYPE).bits
+    assert code_table()[: len(WWA_CODES)] == list(WWA_CODES)
+    assert code_bit("CW.Y") == 1 << len(WWA_CODES)
+    table = ["SQ.W", "TO.W"]
+    assert bitset_codes(3, table) == table
+    assert remap([1, 3], table, ["TO.W", "SQ.W"]).tolist() == [2, 3]
+    assert bitset_codes(code_bit("SQ.W") | code_bit("TO.W")) == [
+        "TO.W",
+        "SQ.W",
+    ]
@@ -1,7 +1,9 @@
 """Mess around with wx grid definitions"""
 
-import numpy as np
-import pyiem.reference as reference
+from griddef import GRID
+from serializer import gid_strings, write_records
+
+CELL = '<cell gid="%s">32.2</cell>\n'
 
 with open("weather_data.xml", "w", encoding="ascii") as fh:
     fh.write(
@@ -19,15 +21,7 @@ with open("weather_data.xml", "w", encoding="ascii") as fh:
  valid="2015-11-24T16:00:00Z">
     """
     )
-    i = 1
-    for _rownum, _lat in enumerate(
-        np.arange(reference.IA_SOUTH, reference.IA_NORTH, 0.01)
-    ):
-        for _colnum, _lon in enumerate(
-            np.arange(reference.IA_WEST, reference.IA_EAST, 0.01)
-        ):
-            fh.write(f'<cell gid="{i}">32.2</cell>\n')
-            i += 1
+    write_records(fh, CELL, [gid_strings(GRID.size)], sep="")
 
     fh.write(
         """
@@ -37,14 +31,6 @@ with open("weather_data.xml", "w", encoding="ascii") as fh:
     """
     )
 
-    i = 1
-    for _rownum, _lat in enumerate(
-        np.arange(reference.IA_SOUTH, reference.IA_NORTH, 0.01)
-    ):
-        for _colnum, _lon in enumerate(
-            np.arange(reference.IA_WEST, reference.IA_EAST, 0.01)
-        ):
-            fh.write(f'<cell gid="{i}">32.2</cell>\n')
-            i += 1
+    write_records(fh, CELL, [gid_strings(GRID.size)], sep="")
 
     fh.write("""</variable>\n</wx>""")